@@ -0,0 +1,546 @@
+"""
+VouTop Media Proxy - Benchmark y prueba de carga
+
+Levanta un origen local de pruebas (imágenes y vídeos sintéticos, respuestas
+lentas, enormes y con error) y el proxy en procesos separados, y lo ataca
+con un generador de carga concurrente. Para cada escenario mide throughput,
+latencias p50/p95/p99, ratio de aciertos de caché (X-Cache), peticiones que
+llegaron al origen y memoria residente (RSS) del proceso del proxy.
+
+Instalación:
+    pip install fastapi uvicorn httpx
+
+Ejecución:
+    python python-fastapi-proxy-bench.py
+    python python-fastapi-proxy-bench.py --scenarios hot-set,thundering-herd \\
+        --requests 5000 --concurrency 64 --output bench-$(git rev-parse --short HEAD).json
+
+    # Compara con una ejecución anterior (throughput y latencias)
+    python python-fastapi-proxy-bench.py --compare bench-anterior.json
+
+El host de pruebas (bench.test) se añade a la whitelist del proxy, su DNS se
+fija a una IP pública de documentación (203.0.113.10) para superar el control
+SSRF y el transporte del cliente redirige las conexiones al origen local por
+HTTP. El IP pinning del cliente real no interviene en las mediciones.
+"""
+
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, JSONResponse, StreamingResponse
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+import httpx
+
+# ============================================================================
+# CONFIGURACIÓN
+# ============================================================================
+
+PROXY_PATH = Path(__file__).with_name('python-fastapi-proxy.py')
+
+BENCH_HOST = 'media.bench.test'
+BENCH_DOMAIN = 'bench.test'
+BENCH_PUBLIC_IP = '203.0.113.10'  # TEST-NET-3: pública a ojos del filtro SSRF
+
+IMAGE_SIZE = 48 * 1024
+VIDEO_SIZE = 2 * 1024 * 1024
+SLOW_DELAY = 0.2
+STARTUP_TIMEOUT = 15.0
+
+HIT_STATUSES = ('HIT', 'STALE', 'COALESCED', 'REVALIDATED')
+
+SCENARIOS = ['hot-set', 'long-tail', 'thundering-herd', 'oversize']
+
+
+def load_proxy_module():
+    """Importa el proxy desde su fichero (el nombre con guiones no es importable)"""
+    spec = importlib.util.spec_from_file_location('media_proxy', PROXY_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# ============================================================================
+# ORIGEN LOCAL DE PRUEBAS
+# ============================================================================
+
+def create_upstream_app(max_file_size: int) -> FastAPI:
+    """
+    Origen sintético:
+    - /img/{name}     imagen de IMAGE_SIZE bytes (con ETag)
+    - /video/{name}   vídeo de VIDEO_SIZE bytes
+    - /slow/{name}    imagen servida tras SLOW_DELAY segundos
+    - /large/{name}   declara un Content-Length mayor que MAX_FILE_SIZE
+    - /chunked/{name} sin Content-Length; sigue enviando más allá del límite
+    - /error/{name}   500
+    - /__stats        peticiones recibidas por ruta
+    """
+    app = FastAPI()
+    hits: Counter = Counter()
+    payloads: Dict[int, bytes] = {}
+
+    def payload(size: int) -> bytes:
+        if size not in payloads:
+            payloads[size] = random.Random(size).randbytes(size)
+        return payloads[size]
+
+    def media(name: str, size: int, media_type: str) -> Response:
+        return Response(
+            content=payload(size),
+            media_type=media_type,
+            headers={'ETag': f'"{name}-{size}"', 'Cache-Control': 'public, max-age=3600'},
+        )
+
+    @app.middleware('http')
+    async def count_requests(request: Request, call_next):
+        hits[request.url.path.split('/')[1]] += 1
+        return await call_next(request)
+
+    @app.get('/img/{name}')
+    async def image(name: str):
+        return media(name, IMAGE_SIZE, 'image/jpeg')
+
+    @app.get('/video/{name}')
+    async def video(name: str):
+        return media(name, VIDEO_SIZE, 'video/mp4')
+
+    @app.get('/slow/{name}')
+    async def slow(name: str):
+        await asyncio.sleep(SLOW_DELAY)
+        return media(name, IMAGE_SIZE, 'image/jpeg')
+
+    @app.get('/large/{name}')
+    async def large(name: str):
+        return media(name, max_file_size + 1, 'image/png')
+
+    @app.get('/chunked/{name}')
+    async def chunked(name: str):
+        chunk = payload(64 * 1024)
+
+        async def body():
+            for _ in range(max_file_size // len(chunk) + 16):
+                yield chunk
+
+        return StreamingResponse(body(), media_type='video/mp4')
+
+    @app.get('/error/{name}')
+    async def error(name: str):
+        return Response(status_code=500)
+
+    @app.get('/__stats')
+    async def stats():
+        return JSONResponse(dict(hits))
+
+    return app
+
+
+def run_upstream(port: int, max_file_size: int):
+    """Proceso del origen local"""
+    import uvicorn
+    uvicorn.run(create_upstream_app(max_file_size), host='127.0.0.1', port=port,
+                log_level='warning', access_log=False)
+
+
+# ============================================================================
+# PROXY INSTRUMENTADO
+# ============================================================================
+
+class LocalUpstreamTransport(httpx.AsyncBaseTransport):
+    """Envía las peticiones a bench.test al origen local por HTTP, con el pool real"""
+
+    def __init__(self, port: int, limits: httpx.Limits):
+        self._port = port
+        self._transport = httpx.AsyncHTTPTransport(limits=limits)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.url.host.endswith(BENCH_DOMAIN):
+            request.headers['Host'] = request.url.host
+            request.url = request.url.copy_with(scheme='http', host='127.0.0.1', port=self._port)
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def install_bench_upstream(proxy, upstream_port: int):
+    """Abre el proxy al host de pruebas: whitelist, DNS fijado y transporte local"""
+    config = proxy.config
+    proxy.whitelist = proxy.Whitelist.build(
+        {'allowed_domains': list(config.ALLOWED_DOMAINS) + [BENCH_DOMAIN]},
+        source='bench',
+    )
+    proxy.dns_resolver._cache[BENCH_HOST] = ((BENCH_PUBLIC_IP,), float('inf'))
+
+    limits = httpx.Limits(
+        max_connections=config.POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=config.POOL_MAX_KEEPALIVE,
+        keepalive_expiry=config.KEEPALIVE_EXPIRY,
+    )
+    proxy.create_http_client = lambda: httpx.AsyncClient(
+        transport=LocalUpstreamTransport(upstream_port, limits),
+        timeout=config.TIMEOUT,
+        follow_redirects=True,
+        headers={'User-Agent': config.USER_AGENT},
+    )
+
+
+def run_proxy(port: int, upstream_port: int, cache_dir: str, disk_cache: bool):
+    """Proceso del proxy; cada escenario arranca uno nuevo con cachés vacíos"""
+    import uvicorn
+    os.environ['MEDIA_PROXY_CACHE_DIR'] = cache_dir
+    proxy = load_proxy_module()
+    proxy.config.DISK_CACHE_ENABLED = disk_cache
+    install_bench_upstream(proxy, upstream_port)
+    uvicorn.run(proxy.app, host='127.0.0.1', port=port, log_level='warning', access_log=False)
+
+
+class ServerProcess:
+    """Servidor uvicorn en un proceso hijo; espera a que responda antes de devolver"""
+
+    def __init__(self, target, port: int, *args, ready_path: str = '/health'):
+        ctx = multiprocessing.get_context('spawn')
+        self.port = port
+        self.process = ctx.Process(target=target, args=(port, *args), daemon=True)
+        self.ready_path = ready_path
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    def __enter__(self) -> "ServerProcess":
+        self.process.start()
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                httpx.get(self.base_url + self.ready_path, timeout=1.0)
+                return self
+            except httpx.TransportError:
+                if not self.process.is_alive():
+                    break
+                time.sleep(0.1)
+        self.process.terminate()
+        raise RuntimeError(f'El servidor en el puerto {self.port} no arrancó')
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join(timeout=5)
+
+    def memory(self) -> Dict[str, Optional[int]]:
+        """RSS actual y pico (VmHWM) en bytes; None fuera de Linux"""
+        result = {'rss_bytes': None, 'peak_rss_bytes': None}
+        try:
+            with open(f'/proc/{self.process.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        result['rss_bytes'] = int(line.split()[1]) * 1024
+                    elif line.startswith('VmHWM:'):
+                        result['peak_rss_bytes'] = int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return result
+
+
+# ============================================================================
+# GENERADOR DE CARGA
+# ============================================================================
+
+def media_url(route: str, name: str) -> str:
+    return f'https://{BENCH_HOST}/{route}/{name}'
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """Percentil por rango más cercano"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class LoadResult:
+    """Acumula latencias, estados HTTP y X-Cache de una ejecución"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.statuses: Counter = Counter()
+        self.cache: Counter = Counter()
+        self.bytes = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def record(self, started: float, response: Optional[httpx.Response], size: int = 0):
+        self.latencies.append(time.perf_counter() - started)
+        if response is None:
+            self.errors += 1
+            return
+        self.statuses[response.status_code] += 1
+        self.cache[response.headers.get('x-cache', 'NONE')] += 1
+        self.bytes += size
+
+    def summary(self) -> Dict:
+        latencies = sorted(self.latencies)
+        ok = self.statuses.get(200, 0) + self.statuses.get(206, 0)
+        hits = sum(n for status, n in self.cache.items() if status.startswith(HIT_STATUSES))
+        return {
+            'requests': len(latencies),
+            'elapsed_s': round(self.elapsed, 3),
+            'throughput_rps': round(len(latencies) / self.elapsed, 1) if self.elapsed else 0.0,
+            'throughput_mb_s': round(self.bytes / self.elapsed / 1e6, 2) if self.elapsed else 0.0,
+            'latency_ms': {
+                name: round(value * 1000, 2) if value is not None else None
+                for name, value in (
+                    ('p50', percentile(latencies, 50)),
+                    ('p95', percentile(latencies, 95)),
+                    ('p99', percentile(latencies, 99)),
+                    ('max', latencies[-1] if latencies else None),
+                )
+            },
+            'hit_ratio': round(hits / ok, 4) if ok else 0.0,
+            'status': {str(k): v for k, v in sorted(self.statuses.items())},
+            'x_cache': dict(sorted(self.cache.items())),
+            'transport_errors': self.errors,
+        }
+
+
+async def fetch(client: httpx.AsyncClient, url: str, result: LoadResult):
+    """Una petición al proxy leyendo el cuerpo completo, como haría un navegador"""
+    started = time.perf_counter()
+    try:
+        async with client.stream('GET', '/api/media-proxy', params={'url': url}) as response:
+            size = 0
+            async for chunk in response.aiter_raw():
+                size += len(chunk)
+        result.record(started, response, size)
+    except httpx.HTTPError:
+        result.record(started, None)
+
+
+async def run_load(base_url: str, urls: Iterator[str], concurrency: int) -> LoadResult:
+    """Carga cerrada: `concurrency` clientes consumen el iterador de URLs"""
+    result = LoadResult()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60.0) as client:
+        async def worker():
+            for url in urls:
+                await fetch(client, url, result)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        result.elapsed = time.perf_counter() - started
+    return result
+
+
+async def run_bursts(base_url: str, bursts: List[str], concurrency: int) -> LoadResult:
+    """Ráfagas: `concurrency` peticiones simultáneas a la misma URL nueva"""
+    result = LoadResult()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60.0) as client:
+        started = time.perf_counter()
+        for url in bursts:
+            await asyncio.gather(*(fetch(client, url, result) for _ in range(concurrency)))
+        result.elapsed = time.perf_counter() - started
+    return result
+
+
+# ============================================================================
+# ESCENARIOS
+# ============================================================================
+
+def zipf_weights(n: int, s: float) -> List[float]:
+    return [1.0 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def scenario_urls(name: str, total: int, concurrency: int, rng: random.Random) -> Dict:
+    """
+    Devuelve cómo ejecutar cada escenario:
+    - hot-set: 20 imágenes populares, casi todo debería salir del caché
+    - long-tail: 5000 objetos con popularidad Zipf (s=1.1), mezcla de imágenes y vídeos
+    - thundering-herd: ráfagas simultáneas a URLs lentas sin cachear (mide el coalescing)
+    - oversize: ficheros que superan MAX_FILE_SIZE, con y sin Content-Length, y errores 500
+    """
+    if name == 'hot-set':
+        urls = [media_url('img', f'hot-{i}.jpg') for i in range(20)]
+        return {'mode': 'load', 'urls': [rng.choice(urls) for _ in range(total)]}
+
+    if name == 'long-tail':
+        population = [
+            media_url('video', f'tail-{i}.mp4') if i % 10 == 9 else media_url('img', f'tail-{i}.jpg')
+            for i in range(5000)
+        ]
+        return {'mode': 'load',
+                'urls': rng.choices(population, weights=zipf_weights(len(population), 1.1), k=total)}
+
+    if name == 'thundering-herd':
+        bursts = max(1, total // concurrency)
+        return {'mode': 'bursts', 'urls': [media_url('slow', f'herd-{i}.jpg') for i in range(bursts)]}
+
+    if name == 'oversize':
+        urls = [
+            media_url(route, f'big-{i}')
+            for i in range(max(1, total // 3))
+            for route in ('large', 'chunked', 'error')
+        ]
+        rng.shuffle(urls)
+        return {'mode': 'load', 'urls': urls}
+
+    raise ValueError(f'Escenario desconocido: {name}')
+
+
+def upstream_hits(upstream: ServerProcess) -> Dict[str, int]:
+    hits = httpx.get(upstream.base_url + '/__stats', timeout=5.0).json()
+    hits.pop('__stats', None)
+    return hits
+
+
+def run_scenario(name: str, args, upstream: ServerProcess) -> Dict:
+    rng = random.Random(args.seed)
+    plan = scenario_urls(name, args.requests, args.concurrency, rng)
+    cache_dir = tempfile.mkdtemp(prefix='voutop-bench-')
+
+    try:
+        with ServerProcess(run_proxy, free_port(), upstream.port, cache_dir,
+                           not args.no_disk_cache) as proxy:
+            idle = proxy.memory()
+            before = upstream_hits(upstream)
+
+            if plan['mode'] == 'bursts':
+                result = asyncio.run(run_bursts(proxy.base_url, plan['urls'], args.concurrency))
+            else:
+                result = asyncio.run(run_load(proxy.base_url, iter(plan['urls']), args.concurrency))
+
+            after = upstream_hits(upstream)
+            memory = proxy.memory()
+            stats = httpx.get(proxy.base_url + '/api/media-proxy/stats', timeout=5.0).json()
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    summary = result.summary()
+    origin_requests = sum(after.values()) - sum(before.values())
+    summary.update({
+        'origin_requests': origin_requests,
+        'memory': {'idle_rss_bytes': idle['rss_bytes'], **memory},
+        'proxy': {key: stats.get(key) for key in ('cache', 'singleflight', 'disk_cache', 'revalidation')},
+    })
+    if plan['mode'] == 'bursts':
+        summary['origin_requests_per_burst'] = round(origin_requests / len(plan['urls']), 2)
+    return summary
+
+
+# ============================================================================
+# INFORME
+# ============================================================================
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=PROXY_PATH.parent,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_mb(value: Optional[int]) -> str:
+    return f'{value / 1024 / 1024:.0f}MB' if value else '-'
+
+
+def print_summary(name: str, summary: Dict):
+    latency = summary['latency_ms']
+    print(f"\n📊 {name}")
+    print(f"   {summary['requests']} peticiones en {summary['elapsed_s']}s → "
+          f"{summary['throughput_rps']} req/s, {summary['throughput_mb_s']} MB/s")
+    print(f"   Latencia p50 {latency['p50']}ms · p95 {latency['p95']}ms · p99 {latency['p99']}ms")
+    print(f"   Hit ratio {summary['hit_ratio']:.1%} · origen {summary['origin_requests']} peticiones"
+          + (f" ({summary['origin_requests_per_burst']}/ráfaga)" if 'origin_requests_per_burst' in summary else ''))
+    print(f"   Estados {summary['status']} · cortes {summary['transport_errors']} · RSS {format_mb(summary['memory']['rss_bytes'])} "
+          f"(pico {format_mb(summary['memory']['peak_rss_bytes'])})")
+
+
+def compare(previous: Dict, current: Dict):
+    """Diferencias de throughput y latencia frente a un informe anterior"""
+    print(f"\n🔍 Comparación con {previous.get('revision') or 'ejecución anterior'}")
+    for name, summary in current['scenarios'].items():
+        old = previous.get('scenarios', {}).get(name)
+        if not old:
+            continue
+
+        def delta(new_value, old_value) -> str:
+            if not old_value or new_value is None:
+                return '-'
+            return f'{(new_value - old_value) / old_value:+.1%}'
+
+        print(f"   {name}: req/s {delta(summary['throughput_rps'], old['throughput_rps'])} · "
+              f"p95 {delta(summary['latency_ms']['p95'], old['latency_ms']['p95'])} · "
+              f"p99 {delta(summary['latency_ms']['p99'], old['latency_ms']['p99'])} · "
+              f"hit ratio {summary['hit_ratio'] - old['hit_ratio']:+.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del proxy de medios de VouTop')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'Escenarios separados por comas ({", ".join(SCENARIOS)})')
+    parser.add_argument('--requests', type=int, default=2000, help='Peticiones por escenario')
+    parser.add_argument('--concurrency', type=int, default=32, help='Clientes simultáneos')
+    parser.add_argument('--seed', type=int, default=1, help='Semilla de la mezcla de URLs')
+    parser.add_argument('--no-disk-cache', action='store_true', help='Desactiva el caché en disco (L2)')
+    parser.add_argument('--output', default='media-proxy-bench.json', help='Informe JSON')
+    parser.add_argument('--compare', help='Informe JSON anterior con el que comparar')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'Escenarios desconocidos: {", ".join(unknown)}')
+
+    max_file_size = load_proxy_module().config.MAX_FILE_SIZE
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+            'disk_cache': not args.no_disk_cache,
+        },
+        'scenarios': {},
+    }
+
+    print(f"🚀 Benchmark del proxy ({report['revision'] or 'sin git'}): "
+          f"{args.requests} peticiones × {args.concurrency} clientes")
+    with ServerProcess(run_upstream, free_port(), max_file_size, ready_path='/__stats') as upstream:
+        for name in names:
+            report['scenarios'][name] = run_scenario(name, args, upstream)
+            print_summary(name, report['scenarios'][name])
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\n💾 Informe guardado en {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,24 +5,68 @@ Sistema completo de proxy de medios con validación, caché y seguridad
 
 Instalación:
     pip install fastapi uvicorn httpx redis pillow python-multipart
+    pip install "httpx[http2]"   # Opcional: HTTP/2 hacia los orígenes
+    pip install aiodns           # Opcional: caché DNS con los TTL de los registros
 
 Ejecución:
     uvicorn python-fastapi-proxy:app --reload --port 8000
     
+    # Varios workers comparten el caché en disco del host
+    MEDIA_PROXY_CACHE_DIR=/var/cache/voutop-media uvicorn python-fastapi-proxy:app --workers 4
+    
 Uso:
     GET /api/media-proxy?url=https://i.imgur.com/abc123.jpg
+    GET /api/media-proxy?url=...&w=64&h=64&fit=cover&format=webp
+    POST /api/media-proxy/batch (body: {"urls": [...], "thumbnails": true})
     POST /api/validate-iframe (body: {"url": "https://youtube.com/..."})
 """
 
 from fastapi import FastAPI, Query, HTTPException, Request
-from fastapi.responses import Response, JSONResponse
+from fastapi.responses import Response, JSONResponse, StreamingResponse, FileResponse, PlainTextResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, List, Optional, Tuple
-from urllib.parse import urlparse
+from typing import AsyncIterable, AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote, urlparse
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from pathlib import Path
 import httpx
+import httpcore
 import hashlib
-from datetime import datetime, timedelta
+import io
+import ipaddress
+import json
+import os
+import secrets
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
 import asyncio
+import base64
+
+try:
+    import h2  # noqa: F401  (lo usa httpx para HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    from PIL import Image, ImageOps
+    Image.init()
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+try:
+    import aiodns  # Opcional: resolución con TTL real de los registros
+except ImportError:
+    aiodns = None
 
 # ============================================================================
 # CONFIGURACIÓN
@@ -91,92 +135,1280 @@ class MediaProxyConfig:
         'omny.fm'
     ]
     
+    # Whitelist externa (JSON) que se recarga en caliente al cambiar el fichero:
+    # {"allowed_domains": [...], "allowed_iframe_hosts": [...],
+    #  "allowed_mime_types": {"images": [...], ...}}; las claves ausentes
+    # usan los valores de esta clase
+    WHITELIST_FILE = os.environ.get('MEDIA_PROXY_WHITELIST_FILE')
+    WHITELIST_RELOAD_INTERVAL = 10  # segundos entre comprobaciones del fichero
+    
     MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
     CACHE_MAX_AGE = 7 * 24 * 60 * 60  # 7 días
+    CACHE_STALE_WHILE_REVALIDATE = 24 * 60 * 60  # Tras expirar: se sirve y se refresca en segundo plano
+    CACHE_STALE_RETAIN = 30 * 24 * 60 * 60  # Entradas con validadores se conservan para revalidar
+    CACHE_MAX_BYTES = 128 * 1024 * 1024  # Presupuesto de memoria del caché por worker
+    CACHE_MAX_OBJECT_SIZE = 5 * 1024 * 1024  # Objetos más grandes se sirven sin cachear
+    STREAM_CHUNK_SIZE = 64 * 1024  # Tamaño de bloque al reenviar al cliente
+    STREAM_PREBUFFER_SIZE = 1024 * 1024  # Sin Content-Length se lee esto antes de enviar cabeceras
+    RANGE_MAX_PARTS = 16  # Peticiones Range con más partes se sirven completas
+    
+    # Redimensionado y transcodificación (?w=&h=&fit=&q=&format=)
+    TRANSFORM_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+    TRANSFORM_MAX_DIMENSION = 4096
+    TRANSFORM_MAX_PIXELS = 50_000_000  # Originales más grandes no se decodifican
+    TRANSFORM_DEFAULT_QUALITY = 80
+    TRANSFORMABLE_MIME_TYPES = {'image/jpeg', 'image/jpg', 'image/png', 'image/webp', 'image/bmp'}
+    
+    # Precarga en lote (POST /api/media-proxy/batch)
+    BATCH_MAX_URLS = 50
+    BATCH_CONCURRENCY = 8  # Fetches simultáneos de todos los lotes del worker
+    BATCH_PER_HOST = 4  # Fetches simultáneos por host de origen
+    BATCH_THUMBNAIL_SIZE = 64  # px del lado de las miniaturas en línea
+    BATCH_INLINE_MAX_BYTES = 8 * 1024  # Miniaturas más grandes no se incrustan
+    
+    # Caché en disco (L2), compartido por todos los workers del host
+    DISK_CACHE_ENABLED = True
+    DISK_CACHE_DIR = Path(os.environ.get(
+        'MEDIA_PROXY_CACHE_DIR',
+        os.path.join(tempfile.gettempdir(), 'voutop-media-cache')
+    ))
+    DISK_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2GB
+    DISK_WRITE_BUFFER = 1024 * 1024  # Bytes acumulados antes de cada escritura (en un hilo)
+    DISK_ACCESS_RESOLUTION = 60  # segundos; un hit solo reescribe last_access si es más antiguo
     TIMEOUT = 8  # segundos
+    COALESCE_TIMEOUT = 15  # segundos que espera una petición agrupada al fetch en curso
+    
+    # Cliente HTTP compartido (un pool de conexiones por worker)
+    POOL_MAX_CONNECTIONS = 100  # Conexiones totales hacia orígenes
+    POOL_MAX_KEEPALIVE = 20  # Conexiones ociosas que se conservan
+    KEEPALIVE_EXPIRY = 30  # segundos antes de cerrar una conexión ociosa
+    HTTP2 = True  # Solo se activa si está instalado httpx[http2]
     USER_AGENT = 'VouTop-MediaProxy/1.0 (https://voutop.app)'
+    
+    # DNS (prevención SSRF): TTL usado si el resolver no informa el de los registros
+    DNS_CACHE_TTL = 60
+    DNS_MIN_TTL = 5
+    DNS_MAX_TTL = 3600
+    DNS_NEGATIVE_TTL = 10  # Fallos de resolución
+    
+    # Redes a las que el proxy nunca se conecta
+    BLOCKED_NETWORKS = [
+        '0.0.0.0/8',
+        '10.0.0.0/8',
+        '100.64.0.0/10',  # CGNAT
+        '127.0.0.0/8',
+        '169.254.0.0/16',  # Link-local (metadata de AWS/GCP)
+        '172.16.0.0/12',
+        '192.0.0.0/24',
+        '192.168.0.0/16',
+        '198.18.0.0/15',
+        '224.0.0.0/4',  # Multicast
+        '240.0.0.0/4',  # Reservado y broadcast
+        '::/128',
+        '::1/128',
+        'fc00::/7',  # Unique local
+        'fe80::/10',  # Link-local
+        'ff00::/8',  # Multicast
+    ]
 
 
 config = MediaProxyConfig()
 
 
+# ============================================================================
+# MÉTRICAS (FORMATO PROMETHEUS)
+# ============================================================================
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+LabelValues = Tuple[str, ...]
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Contador monótono con etiquetas (inc es una suma en un dict)"""
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[LabelValues, float] = {}
+    
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    """
+    Histograma con buckets fijos: observe hace una búsqueda binaria y una
+    suma; los acumulados que pide Prometheus se calculan al exportar
+    """
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series: Dict[LabelValues, List] = {}
+    
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+    
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_labels = format_labels(self.labelnames, labels, 'le="' + le + '"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+class CallbackMetric:
+    """Métrica leída al exportar de un estado que ya existe (cachés, pools...)"""
+    
+    def __init__(self, name: str, documentation: str, kind: str, labelnames: Tuple[str, ...],
+                 collect):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = labelnames
+        self.collect = collect
+    
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames))
+    
+    def callback(self, name: str, documentation: str, kind: str, collect,
+                 labelnames: Tuple[str, ...] = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, kind, labelnames, collect))
+    
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram(
+    'media_proxy_stage_seconds',
+    'Duración de cada etapa: validation, dns, cache_lookup, upstream_connect, '
+    'upstream_tls, upstream_ttfb, upstream_download, transform, response_write',
+    ('stage',)
+)
+REQUEST_SECONDS = metrics.histogram(
+    'media_proxy_request_seconds', 'Duración total de la petición', ('route',)
+)
+REQUESTS = metrics.counter(
+    'media_proxy_requests_total', 'Peticiones por ruta, estado y resultado de caché (X-Cache)',
+    ('route', 'status', 'cache')
+)
+REJECTIONS = metrics.counter(
+    'media_proxy_rejections_total', 'Peticiones de medios rechazadas por código de estado', ('reason',)
+)
+RESPONSE_BYTES = metrics.counter(
+    'media_proxy_response_bytes_total', 'Bytes de cuerpo servidos según su origen', ('source',)
+)
+
+
+def observe_stage(stage: str, started: float):
+    """Registra la duración de una etapa desde started (time.perf_counter())"""
+    STAGE_SECONDS.observe(time.perf_counter() - started, stage)
+
+
 # ============================================================================
 # CACHÉ EN MEMORIA
 # ============================================================================
 
+class CachedObject(NamedTuple):
+    """Objeto cacheado en memoria (content) o en disco (path)"""
+    content: Optional[bytes]
+    path: Optional[Path]
+    content_type: str
+    size: int
+    etag: str  # ETag propio del proxy (hash del contenido)
+    upstream_etag: Optional[str]
+    last_modified: Optional[str]
+    stored_at: float  # time.time() de la descarga o última revalidación
+    
+    def age(self) -> float:
+        return time.time() - self.stored_at
+    
+    def is_fresh(self) -> bool:
+        return self.age() <= config.CACHE_MAX_AGE
+    
+    def can_revalidate(self) -> bool:
+        return bool(self.upstream_etag or self.last_modified)
+
+
+def content_etag(digest: str) -> str:
+    """ETag fuerte a partir del sha256 del cuerpo (igual en memoria y en disco)"""
+    return f'"{digest[:32]}"'
+
+
+def is_retained(stored_at: float, revalidatable: bool) -> bool:
+    """
+    Si una entrada expirada sigue mereciendo la pena: dentro de la ventana
+    stale-while-revalidate siempre; después, solo si tiene validadores
+    para una revalidación condicional
+    """
+    age = time.time() - stored_at
+    if age <= config.CACHE_MAX_AGE + config.CACHE_STALE_WHILE_REVALIDATE:
+        return True
+    return revalidatable and age <= config.CACHE_MAX_AGE + config.CACHE_STALE_RETAIN
+
+
 class MemoryCache:
-    """Caché simple en memoria con expiración"""
+    """
+    Caché LRU en memoria con presupuesto en bytes y expiración
+
+    OrderedDict mantiene el orden de uso: get/set mueven la entrada al final
+    y la expulsión saca del principio, todo en O(1). Las entradas expiradas
+    no se borran mientras puedan servirse como stale o revalidarse.
+    """
     
-    def __init__(self):
-        self._cache: Dict[str, Tuple[bytes, str, datetime]] = {}
-        self._max_size = 100
+    def __init__(self, max_bytes: int = config.CACHE_MAX_BYTES):
+        self._cache: "OrderedDict[str, CachedObject]" = OrderedDict()
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
     
-    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
-        """Obtiene un item del caché si no ha expirado"""
-        if key not in self._cache:
+    def get(self, key: str) -> Optional[CachedObject]:
+        """Obtiene un item del caché, fresco o todavía aprovechable"""
+        entry = self._cache.get(key)
+        if entry is None:
+            self.misses += 1
             return None
         
-        content, content_type, timestamp = self._cache[key]
-        
         # Verificar expiración
-        if datetime.now() - timestamp > timedelta(seconds=config.CACHE_MAX_AGE):
-            del self._cache[key]
+        if not is_retained(entry.stored_at, entry.can_revalidate()):
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        
+        self._cache.move_to_end(key)
+        if entry.is_fresh():
+            self.hits += 1
+        else:
+            self.stale_hits += 1
+        return entry
+    
+    def set(self, key: str, content: bytes, content_type: str,
+            upstream_etag: Optional[str] = None, last_modified: Optional[str] = None) -> Optional[CachedObject]:
+        """Guarda un item en el caché, expulsando los menos usados si no cabe"""
+        size = len(content)
+        if size > self._max_bytes:
             return None
         
-        return (content, content_type)
-    
-    def set(self, key: str, content: bytes, content_type: str):
-        """Guarda un item en el caché"""
-        # Limpiar si el caché está lleno
-        if len(self._cache) >= self._max_size:
-            oldest_key = min(self._cache.keys(), key=lambda k: self._cache[k][2])
-            del self._cache[oldest_key]
+        if key in self._cache:
+            self._remove(key)
         
-        self._cache[key] = (content, content_type, datetime.now())
+        while self._cache and self._bytes + size > self._max_bytes:
+            oldest_key = next(iter(self._cache))
+            self._remove(oldest_key)
+            self.evictions += 1
+        
+        entry = CachedObject(
+            content, None, content_type, size,
+            content_etag(hashlib.sha256(content).hexdigest()),
+            upstream_etag, last_modified, time.time()
+        )
+        self._cache[key] = entry
+        self._bytes += size
+        return entry
+    
+    def refresh(self, key: str):
+        """Marca la entrada como recién validada (respuesta 304 del origen)"""
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache[key] = entry._replace(stored_at=time.time())
+    
+    def _remove(self, key: str):
+        entry = self._cache.pop(key)
+        self._bytes -= entry.size
     
     def size(self) -> int:
-        """Retorna el tamaño actual del caché"""
+        """Retorna el número de entradas en caché"""
         return len(self._cache)
     
+    def size_bytes(self) -> int:
+        """Retorna los bytes ocupados por el contenido cacheado"""
+        return self._bytes
+    
+    def stats(self) -> Dict[str, float]:
+        """Contadores de uso del caché"""
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self._cache),
+            "bytes": self._bytes,
+            "max_bytes": self._max_bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+    
     def clear_expired(self):
-        """Limpia items expirados"""
-        now = datetime.now()
+        """Limpia items que ya no pueden servirse ni revalidarse"""
         expired = [
-            k for k, (_, _, timestamp) in self._cache.items()
-            if now - timestamp > timedelta(seconds=config.CACHE_MAX_AGE)
+            k for k, entry in self._cache.items()
+            if not is_retained(entry.stored_at, entry.can_revalidate())
         ]
         for key in expired:
-            del self._cache[key]
+            self._remove(key)
+            self.expirations += 1
 
 
 cache = MemoryCache()
 
+metrics.callback(
+    'media_proxy_memory_cache_lookups_total', 'Consultas al caché en memoria por resultado', 'counter',
+    lambda: {('hit',): cache.hits, ('stale',): cache.stale_hits, ('miss',): cache.misses}, ('result',)
+)
+metrics.callback(
+    'media_proxy_memory_cache_bytes', 'Bytes ocupados por el caché en memoria', 'gauge',
+    lambda: cache.size_bytes()
+)
+metrics.callback(
+    'media_proxy_memory_cache_evictions_total', 'Expulsiones LRU del caché en memoria', 'counter',
+    lambda: cache.evictions
+)
+
+
+# ============================================================================
+# CACHÉ EN DISCO (L2)
+# ============================================================================
+
+class DiskCache:
+    """
+    Caché persistente en disco, compartido entre workers y reinicios
+
+    Los cuerpos se guardan direccionados por contenido (sha256) en
+    objects/ab/abcdef...; el índice SQLite (modo WAL) mapea cada clave de
+    caché a su objeto con content type, tamaño, validadores del origen
+    (ETag y Last-Modified), expiración y último acceso para la expulsión
+    LRU. Cada fichero se escribe en un temporal y se publica con
+    os.replace, así que un crash nunca deja objetos a medias.
+    
+    Los bytes ocupados por los objetos se llevan en la tabla usage,
+    actualizada en la misma transacción que las entradas, para no sumar
+    todo el índice en cada escritura.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            content_type TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            expires_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access);
+        CREATE INDEX IF NOT EXISTS entries_digest ON entries(digest);
+        CREATE TABLE IF NOT EXISTS usage (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            bytes INTEGER NOT NULL
+        );
+    """
+    
+    EVICT_BATCH = 64  # Entradas LRU leídas por consulta al expulsar
+    
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+    
+    def _db(self) -> sqlite3.Connection:
+        """Conexión del proceso actual (cada worker abre la suya)"""
+        if self._conn is None:
+            (self.root / 'objects').mkdir(parents=True, exist_ok=True)
+            (self.root / 'tmp').mkdir(exist_ok=True)
+            conn = sqlite3.connect(
+                str(self.root / 'index.sqlite'),
+                timeout=5,
+                isolation_level=None,
+                check_same_thread=False
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.SCHEMA)
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(entries)')}
+            if 'last_modified' not in columns:
+                # Índices creados antes de guardar Last-Modified
+                conn.execute('ALTER TABLE entries ADD COLUMN last_modified TEXT')
+            # Índices anteriores a la tabla usage: se suma una sola vez
+            conn.execute(
+                'INSERT OR IGNORE INTO usage (id, bytes) '
+                'SELECT 1, COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM entries)'
+            )
+            self._conn = conn
+        return self._conn
+    
+    @contextmanager
+    def _transaction(self):
+        """Transacción de escritura: el índice y usage se comparten entre workers"""
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+    
+    def used_bytes(self) -> int:
+        return self._db().execute('SELECT bytes FROM usage WHERE id = 1').fetchone()[0]
+    
+    def _object_path(self, digest: str) -> Path:
+        return self.root / 'objects' / digest[:2] / digest
+    
+    def get(self, key: str) -> Optional[CachedObject]:
+        """Entrada para la clave, fresca o todavía aprovechable; None si no está"""
+        now = time.time()
+        with self._lock:
+            row = self._db().execute(
+                'SELECT digest, content_type, size, etag, last_modified, expires_at, last_access '
+                'FROM entries WHERE key = ?',
+                (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            digest, content_type, size, etag, last_modified, expires_at, last_access = row
+            stored_at = expires_at - config.CACHE_MAX_AGE
+            path = self._object_path(digest)
+            if not is_retained(stored_at, bool(etag or last_modified)) or not path.exists():
+                # Expirada, o el objeto se perdió (borrado a mano o por otro worker)
+                with self._transaction() as db:
+                    if db.execute('DELETE FROM entries WHERE key = ? AND digest = ?',
+                                  (key, digest)).rowcount:
+                        self._drop_unreferenced(digest, size)
+                self.misses += 1
+                return None
+            if now - last_access >= config.DISK_ACCESS_RESOLUTION:
+                # Para el LRU basta con resolución gruesa: la mayoría de hits
+                # solo leen y no compiten por el bloqueo de escritura del WAL
+                self._db().execute('UPDATE entries SET last_access = ? WHERE key = ?', (now, key))
+        self.hits += 1
+        return CachedObject(
+            None, path, content_type, size, content_etag(digest),
+            etag, last_modified, stored_at
+        )
+    
+    def refresh(self, key: str):
+        """Marca la entrada como recién validada (respuesta 304 del origen)"""
+        with self._lock:
+            self._db().execute(
+                'UPDATE entries SET expires_at = ? WHERE key = ?',
+                (time.time() + config.CACHE_MAX_AGE, key)
+            )
+    
+    def open_writer(self) -> "DiskWriter":
+        """Temporal donde se va copiando un cuerpo mientras se reenvía"""
+        self._db()
+        return DiskWriter(self)
+    
+    def commit(self, key: str, tmp_path: Path, digest: str, size: int,
+               content_type: str, etag: Optional[str], last_modified: Optional[str]):
+        """Publica un temporal ya escrito y lo registra en el índice (bloqueante)"""
+        final_path = self._object_path(digest)
+        if final_path.exists():
+            # Mismo contenido ya guardado bajo otra URL
+            os.unlink(tmp_path)
+        else:
+            final_path.parent.mkdir(exist_ok=True)
+            os.replace(tmp_path, final_path)
+        
+        now = time.time()
+        with self._lock, self._transaction() as db:
+            previous = db.execute('SELECT digest, size FROM entries WHERE key = ?', (key,)).fetchone()
+            is_new = db.execute(
+                'SELECT 1 FROM entries WHERE digest = ? LIMIT 1', (digest,)
+            ).fetchone() is None
+            db.execute(
+                'INSERT OR REPLACE INTO entries '
+                '(key, digest, content_type, size, etag, last_modified, expires_at, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, digest, content_type, size, etag, last_modified,
+                 now + config.CACHE_MAX_AGE, now)
+            )
+            if is_new:
+                db.execute('UPDATE usage SET bytes = bytes + ? WHERE id = 1', (size,))
+            if previous is not None and previous[0] != digest:
+                # La URL cambió de contenido: el objeto anterior puede quedar huérfano
+                self._drop_unreferenced(*previous)
+            self.writes += 1
+            self._evict(db)
+    
+    def _evict(self, db: sqlite3.Connection):
+        """Expulsa las entradas menos usadas, por lotes, hasta quedar dentro del presupuesto"""
+        total = self.used_bytes()
+        while total > self.max_bytes:
+            batch = db.execute(
+                'SELECT key, digest, size FROM entries ORDER BY last_access LIMIT ?',
+                (self.EVICT_BATCH,)
+            ).fetchall()
+            if not batch:
+                break
+            for key, digest, size in batch:
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.evictions += 1
+                if self._drop_unreferenced(digest, size):
+                    total -= size
+                if total <= self.max_bytes:
+                    break
+    
+    def _drop_unreferenced(self, digest: str, size: int) -> bool:
+        """Borra el objeto si ninguna clave lo usa ya (dentro de una transacción)"""
+        in_use = self._db().execute(
+            'SELECT 1 FROM entries WHERE digest = ? LIMIT 1', (digest,)
+        ).fetchone()
+        if in_use:
+            return False
+        self._db().execute('UPDATE usage SET bytes = MAX(bytes - ?, 0) WHERE id = 1', (size,))
+        try:
+            os.unlink(self._object_path(digest))
+        except FileNotFoundError:
+            pass
+        return True
+    
+    def clear_expired(self):
+        """Limpia entradas que ya no pueden servirse ni revalidarse y temporales huérfanos"""
+        now = time.time()
+        stale_limit = now - config.CACHE_STALE_WHILE_REVALIDATE
+        retain_limit = now - config.CACHE_STALE_RETAIN
+        with self._lock, self._transaction() as db:
+            expired = db.execute(
+                'SELECT key, digest, size FROM entries WHERE expires_at < ? '
+                'AND (expires_at < ? OR (etag IS NULL AND last_modified IS NULL))',
+                (stale_limit, retain_limit)
+            ).fetchall()
+            for key, digest, size in expired:
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self._drop_unreferenced(digest, size)
+        for tmp in (self.root / 'tmp').glob('*'):
+            if tmp.stat().st_mtime < now - 3600:
+                tmp.unlink(missing_ok=True)
+    
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
+    def stats(self) -> Dict[str, float]:
+        """Contadores de uso e índice del caché en disco"""
+        with self._lock:
+            entries = self._db().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            total = self.used_bytes()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+
+class DiskWriter:
+    """
+    Copia en un temporal del caché en disco, con hash incremental. Los
+    bloques se acumulan hasta DISK_WRITE_BUFFER y se escriben (y hashean)
+    en el threadpool, nunca en el event loop
+    """
+    
+    def __init__(self, disk: DiskCache):
+        self._disk = disk
+        fd, name = tempfile.mkstemp(dir=disk.root / 'tmp')
+        self._file = os.fdopen(fd, 'wb')
+        self._path = Path(name)
+        self._hash = hashlib.sha256()
+        self._pending: List[bytes] = []
+        self._pending_size = 0
+        self.size = 0
+    
+    async def write(self, chunk: bytes):
+        self._pending.append(chunk)
+        self._pending_size += len(chunk)
+        self.size += len(chunk)
+        if self._pending_size >= config.DISK_WRITE_BUFFER:
+            await run_in_threadpool(self._flush)
+    
+    def _flush(self):
+        """Escribe lo acumulado (bloqueante)"""
+        data = b''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self._file.write(data)
+        self._hash.update(data)
+    
+    def _finish(self) -> str:
+        self._flush()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        return self._hash.hexdigest()
+    
+    async def commit(self, key: str, content_type: str, etag: Optional[str],
+                     last_modified: Optional[str]):
+        """fsync + publicación atómica fuera del event loop"""
+        def publish():
+            digest = self._finish()
+            self._disk.commit(key, self._path, digest, self.size, content_type, etag, last_modified)
+        await run_in_threadpool(publish)
+    
+    def abort(self):
+        if not self._file.closed:
+            self._file.close()
+        self._path.unlink(missing_ok=True)
+
+
+disk_cache: Optional[DiskCache] = (
+    DiskCache(config.DISK_CACHE_DIR, config.DISK_CACHE_MAX_BYTES)
+    if config.DISK_CACHE_ENABLED else None
+)
+
+if disk_cache is not None:
+    metrics.callback(
+        'media_proxy_disk_cache_lookups_total', 'Consultas al caché en disco por resultado', 'counter',
+        lambda: {('hit',): disk_cache.hits, ('miss',): disk_cache.misses}, ('result',)
+    )
+    metrics.callback(
+        'media_proxy_disk_cache_evictions_total', 'Expulsiones LRU del caché en disco', 'counter',
+        lambda: disk_cache.evictions
+    )
+
+
+# ============================================================================
+# DNS Y PREVENCIÓN SSRF
+# ============================================================================
+
+BLOCKED_NETWORKS = {
+    version: tuple(
+        network for network in map(ipaddress.ip_network, config.BLOCKED_NETWORKS)
+        if network.version == version
+    )
+    for version in (4, 6)
+}
+
+
+def is_blocked_address(address: str) -> bool:
+    """IP dentro de alguna red bloqueada (IPv4 mapeadas en IPv6 incluidas)"""
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return any(ip in network for network in BLOCKED_NETWORKS[ip.version])
+
+
+class DnsResolver:
+    """
+    Resolución DNS asíncrona con caché por TTL
+
+    Con aiodns se consultan los registros A y AAAA y se respeta su TTL; sin
+    él se usa getaddrinfo del loop (en un hilo, sin bloquear) y DNS_CACHE_TTL.
+    Las consultas concurrentes al mismo host comparten una sola resolución y
+    los fallos se cachean DNS_NEGATIVE_TTL segundos.
+    """
+    
+    def __init__(self):
+        self._cache: Dict[str, Tuple[Tuple[str, ...], float]] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._aiodns = None
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+    
+    async def resolve(self, host: str) -> Tuple[str, ...]:
+        """Todas las IPs del host; OSError si no resuelve"""
+        host = host.lower().rstrip('.')
+        try:
+            return (str(ipaddress.ip_address(host.strip('[]'))),)
+        except ValueError:
+            pass
+        
+        cached = self._cache.get(host)
+        if cached is not None and cached[1] > time.monotonic():
+            self.hits += 1
+            return self._addresses_or_error(host, cached[0])
+        
+        pending = self._pending.get(host)
+        if pending is not None:
+            self.hits += 1
+            return self._addresses_or_error(host, await asyncio.shield(pending))
+        
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[host] = future
+        addresses: Tuple[str, ...] = ()
+        try:
+            addresses, ttl = await self._lookup(host)
+        except Exception:
+            self.failures += 1
+            ttl = config.DNS_NEGATIVE_TTL
+        finally:
+            # Si esta petición se cancela, las que esperaban reciben un fallo
+            del self._pending[host]
+            future.set_result(addresses)
+        
+        ttl = min(max(ttl, config.DNS_MIN_TTL), config.DNS_MAX_TTL)
+        self._cache[host] = (addresses, time.monotonic() + ttl)
+        return self._addresses_or_error(host, addresses)
+    
+    @staticmethod
+    def _addresses_or_error(host: str, addresses: Tuple[str, ...]) -> Tuple[str, ...]:
+        if not addresses:
+            raise OSError(f"No se pudo resolver {host}")
+        return addresses
+    
+    async def _lookup(self, host: str) -> Tuple[Tuple[str, ...], float]:
+        if aiodns is not None:
+            if self._aiodns is None:
+                self._aiodns = aiodns.DNSResolver()
+            answers = await asyncio.gather(
+                self._aiodns.query(host, 'A'),
+                self._aiodns.query(host, 'AAAA'),
+                return_exceptions=True
+            )
+            records = [
+                record for answer in answers if not isinstance(answer, Exception)
+                for record in answer
+            ]
+            if not records:
+                raise OSError(f"Sin registros A/AAAA para {host}")
+            addresses = tuple(dict.fromkeys(record.host for record in records))
+            return addresses, min(record.ttl for record in records)
+        
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        addresses = tuple(dict.fromkeys(info[4][0] for info in infos))
+        return addresses, config.DNS_CACHE_TTL
+    
+    def clear_expired(self):
+        now = time.monotonic()
+        for host in [h for h, (_, expires) in self._cache.items() if expires <= now]:
+            del self._cache[host]
+    
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "aiodns" if aiodns is not None else "getaddrinfo",
+            "entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+dns_resolver = DnsResolver()
+
+metrics.callback(
+    'media_proxy_dns_lookups_total', 'Resoluciones DNS por resultado', 'counter',
+    lambda: {('hit',): dns_resolver.hits, ('miss',): dns_resolver.misses,
+             ('failure',): dns_resolver.failures},
+    ('result',)
+)
+
+
+class PinnedNetworkBackend(httpcore.AsyncNetworkBackend):
+    """
+    Backend de red de httpcore que conecta a las IPs ya validadas por
+    dns_resolver en lugar de volver a resolver el nombre. Cierra la ventana
+    de DNS rebinding entre la comprobación SSRF y la conexión, y aplica la
+    misma comprobación a las redirecciones. TLS sigue usando el hostname
+    original para SNI y la validación del certificado.
+    """
+    
+    def __init__(self, backend: Optional[httpcore.AsyncNetworkBackend] = None):
+        self._backend = backend or httpcore.AnyIOBackend()
+    
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            addresses = await dns_resolver.resolve(host)
+        except OSError as e:
+            raise httpcore.ConnectError(str(e))
+        if any(is_blocked_address(address) for address in addresses):
+            raise httpcore.ConnectError(f"IP privada bloqueada: {host}")
+        
+        last_error: Optional[Exception] = None
+        for address in addresses:
+            try:
+                return await self._backend.connect_tcp(
+                    address, port, timeout, local_address, socket_options
+                )
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                last_error = e
+        raise last_error
+    
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise httpcore.ConnectError("Sockets Unix no permitidos")
+    
+    async def sleep(self, seconds: float):
+        await self._backend.sleep(seconds)
+
+
+# ============================================================================
+# CLIENTE HTTP COMPARTIDO
+# ============================================================================
+
+class UpstreamMetrics:
+    """Métricas por host de origen: peticiones, errores, en curso y latencia"""
+    
+    def __init__(self):
+        self._hosts: Dict[str, Dict[str, float]] = {}
+    
+    def _host(self, host: str) -> Dict[str, float]:
+        if host not in self._hosts:
+            self._hosts[host] = {
+                "requests": 0, "errors": 0, "in_flight": 0, "total_ms": 0.0
+            }
+        return self._hosts[host]
+    
+    def start(self, host: str) -> float:
+        metrics = self._host(host)
+        metrics["requests"] += 1
+        metrics["in_flight"] += 1
+        return time.perf_counter()
+    
+    def finish(self, host: str, started: float, error: bool = False):
+        metrics = self._host(host)
+        metrics["in_flight"] -= 1
+        metrics["total_ms"] += (time.perf_counter() - started) * 1000
+        if error:
+            metrics["errors"] += 1
+    
+    def series(self, field: str) -> Dict[LabelValues, float]:
+        return {(host,): m[field] for host, m in self._hosts.items()}
+    
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {
+            host: {
+                "requests": m["requests"],
+                "errors": m["errors"],
+                "in_flight": m["in_flight"],
+                "avg_ms": round(m["total_ms"] / m["requests"], 2) if m["requests"] else 0.0,
+            }
+            for host, m in self._hosts.items()
+        }
+
+
+upstream_metrics = UpstreamMetrics()
+
+metrics.callback(
+    'media_proxy_upstream_requests_total', 'Peticiones al origen por host', 'counter',
+    lambda: upstream_metrics.series('requests'), ('host',)
+)
+metrics.callback(
+    'media_proxy_upstream_errors_total', 'Errores del origen (timeout, 4xx/5xx, red) por host', 'counter',
+    lambda: upstream_metrics.series('errors'), ('host',)
+)
+metrics.callback(
+    'media_proxy_upstream_in_flight', 'Peticiones al origen en curso por host', 'gauge',
+    lambda: upstream_metrics.series('in_flight'), ('host',)
+)
+
+
+# Errores de httpcore -> errores de httpx, del más específico al más general
+HTTPCORE_ERRORS = (
+    (httpcore.ConnectTimeout, httpx.ConnectTimeout),
+    (httpcore.ReadTimeout, httpx.ReadTimeout),
+    (httpcore.WriteTimeout, httpx.WriteTimeout),
+    (httpcore.PoolTimeout, httpx.PoolTimeout),
+    (httpcore.TimeoutException, httpx.TimeoutException),
+    (httpcore.ConnectError, httpx.ConnectError),
+    (httpcore.ReadError, httpx.ReadError),
+    (httpcore.WriteError, httpx.WriteError),
+    (httpcore.NetworkError, httpx.NetworkError),
+    (httpcore.ProxyError, httpx.ProxyError),
+    (httpcore.UnsupportedProtocol, httpx.UnsupportedProtocol),
+    (httpcore.LocalProtocolError, httpx.LocalProtocolError),
+    (httpcore.RemoteProtocolError, httpx.RemoteProtocolError),
+    (httpcore.ProtocolError, httpx.ProtocolError),
+)
+
+
+@contextmanager
+def httpcore_errors():
+    """Traduce las excepciones de httpcore a las de httpx que espera el resto del código"""
+    try:
+        yield
+    except Exception as e:
+        for source, target in HTTPCORE_ERRORS:
+            if isinstance(e, source):
+                raise target(str(e)) from e
+        raise
+
+
+class PinnedResponseStream(httpx.AsyncByteStream):
+    """Cuerpo de una respuesta de httpcore expuesto como stream de httpx"""
+    
+    def __init__(self, stream: AsyncIterable[bytes]):
+        self._stream = stream
+    
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        with httpcore_errors():
+            async for chunk in self._stream:
+                yield chunk
+    
+    async def aclose(self):
+        if hasattr(self._stream, 'aclose'):
+            await self._stream.aclose()
+
+
+class PinnedHTTPTransport(httpx.AsyncBaseTransport):
+    """
+    Transporte de httpx sobre un httpcore.AsyncConnectionPool propio creado
+    con PinnedNetworkBackend: todas las conexiones al origen pasan por las
+    IPs validadas. El pool es público (self.pool) para las métricas
+    """
+    
+    def __init__(self, http2: bool = False, limits: httpx.Limits = httpx.Limits()):
+        self.pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            http1=True,
+            http2=http2,
+            network_backend=PinnedNetworkBackend(),
+        )
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path,
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with httpcore_errors():
+            core_response = await self.pool.handle_async_request(core_request)
+        
+        return httpx.Response(
+            status_code=core_response.status,
+            headers=core_response.headers,
+            stream=PinnedResponseStream(core_response.stream),
+            extensions=core_response.extensions,
+        )
+    
+    async def aclose(self):
+        await self.pool.aclose()
+
+
+http_client: Optional[httpx.AsyncClient] = None
+http_transport: Optional[PinnedHTTPTransport] = None
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """Cliente con pool de conexiones y keep-alive, compartido por todas las peticiones"""
+    global http_transport
+    transport = http_transport = PinnedHTTPTransport(
+        http2=config.HTTP2 and HTTP2_AVAILABLE,
+        limits=httpx.Limits(
+            max_connections=config.POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=config.POOL_MAX_KEEPALIVE,
+            keepalive_expiry=config.KEEPALIVE_EXPIRY,
+        ),
+    )
+    
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=config.TIMEOUT,
+        follow_redirects=True,
+        headers={'User-Agent': config.USER_AGENT},
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Devuelve el cliente de la aplicación (lo crea si aún no existe)"""
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = create_http_client()
+    return http_client
+
+
+def pool_connections_by_host() -> Dict[str, Dict[str, int]]:
+    """
+    Conexiones abiertas por host en el pool de httpcore (activas y ociosas).
+    Sin pool propio (cliente sustituido, p. ej. en el bench) se devuelve un
+    diccionario vacío
+    """
+    result: Dict[str, Dict[str, int]] = {}
+    if http_transport is None:
+        return result
+    for connection in http_transport.pool.connections:
+        origin = getattr(connection, '_origin', None)
+        host = origin.host.decode() if origin is not None else 'unknown'
+        counts = result.setdefault(host, {"open": 0, "idle": 0})
+        counts["open"] += 1
+        if connection.is_idle():
+            counts["idle"] += 1
+    return result
+
+
+# ============================================================================
+# SINGLE-FLIGHT (AGRUPACIÓN DE MISSES CONCURRENTES)
+# ============================================================================
+
+SharedBody = Optional[CachedObject]
+
+
+class SingleFlight:
+    """
+    Un único fetch en curso por clave de caché.
+    
+    La primera petición que falla el caché es la líder y descarga el recurso;
+    las que llegan mientras tanto esperan su futuro y reciben el mismo objeto
+    (o el mismo error). Si el cuerpo no cabía en memoria el futuro se resuelve
+    con None y cada espera lo busca en disco o hace su propio fetch.
+    """
+    
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+    
+    def join(self, key: str) -> Optional[asyncio.Future]:
+        """Futuro del fetch en curso para la clave, o None si no hay ninguno"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        return future
+    
+    def is_running(self, key: str) -> bool:
+        return key in self._inflight
+    
+    def lead(self, key: str) -> asyncio.Future:
+        """Registra a la petición actual como líder del fetch de la clave"""
+        future = asyncio.get_running_loop().create_future()
+        # Marca la excepción como consumida aunque nadie la espere
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        self.leaders += 1
+        return future
+    
+    def resolve(self, key: str, future: Optional[asyncio.Future], body: SharedBody = None,
+                error: Optional[Exception] = None):
+        """
+        Entrega el resultado del líder (future, el de su lead) a las
+        peticiones agrupadas. Como release, solo quita la clave si sigue
+        siendo de este líder: uno que llega tarde (tras un timeout) no debe
+        borrar el fetch de su sucesor. Sin futuro (no es líder) no hace nada
+        """
+        if future is None:
+            return
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(body)
+    
+    def release(self, key: str, future: asyncio.Future):
+        """
+        Cierre del líder pase lo que pase. Si el cuerpo nunca se llegó a
+        iterar (cliente desconectado antes) nadie resolvió el futuro: se
+        resuelve con None para que las peticiones agrupadas hagan su propio
+        fetch ya, en lugar de tras COALESCE_TIMEOUT. Solo quita la clave si
+        sigue siendo de este líder
+        """
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.done():
+            future.set_result(None)
+    
+    async def wait(self, key: str, future: asyncio.Future) -> SharedBody:
+        """Espera al líder; shield evita que un timeout cancele el futuro compartido"""
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), config.COALESCE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            # Un líder colgado no debe bloquear a las peticiones siguientes
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+            raise HTTPException(status_code=504, detail="Timeout esperando fetch en curso")
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+        }
+
+
+singleflight = SingleFlight()
+
+metrics.callback(
+    'media_proxy_coalesced_requests_total', 'Misses que esperaron a un fetch en curso', 'counter',
+    lambda: singleflight.coalesced
+)
+
 
 # ============================================================================
 # VALIDADORES
 # ============================================================================
 
+class SuffixMatcher:
+    """
+    Conjunto de dominios que admite el propio dominio y sus subdominios.
+    
+    Se guarda cada dominio en un set y se prueban los sufijos del hostname
+    etiqueta a etiqueta (a.b.c → a.b.c, b.c, c): O(etiquetas) por consulta,
+    independiente del tamaño de la whitelist. '*.fbcdn.net' equivale a
+    'fbcdn.net', igual que antes.
+    """
+    
+    def __init__(self, domains: List[str]):
+        self._suffixes = frozenset(
+            domain.lower().removeprefix('*.').strip('.') for domain in domains
+        )
+    
+    def __len__(self) -> int:
+        return len(self._suffixes)
+    
+    def matches(self, hostname: str) -> bool:
+        hostname = hostname.lower().rstrip('.')
+        suffixes = self._suffixes
+        while True:
+            if hostname in suffixes:
+                return True
+            dot = hostname.find('.')
+            if dot < 0:
+                return False
+            hostname = hostname[dot + 1:]
+
+
+class Whitelist(NamedTuple):
+    """Whitelist compilada; se reemplaza entera al recargar"""
+    domains: SuffixMatcher
+    iframe_hosts: SuffixMatcher
+    mime_types: frozenset
+    source: str
+    mtime: float
+    
+    @classmethod
+    def build(cls, settings: Dict, source: str = 'config', mtime: float = 0.0) -> "Whitelist":
+        mime_types = settings.get('allowed_mime_types', config.ALLOWED_MIME_TYPES)
+        return cls(
+            SuffixMatcher(settings.get('allowed_domains', config.ALLOWED_DOMAINS)),
+            SuffixMatcher(settings.get('allowed_iframe_hosts', config.ALLOWED_IFRAME_HOSTS)),
+            frozenset(mime.lower() for group in mime_types.values() for mime in group),
+            source,
+            mtime,
+        )
+
+
+whitelist = Whitelist.build({})
+
+
+def reload_whitelist(force: bool = False) -> bool:
+    """
+    Recompila la whitelist desde WHITELIST_FILE si cambió su mtime.
+    Un fichero inválido deja la whitelist anterior en vigor
+    """
+    global whitelist
+    path = config.WHITELIST_FILE
+    if not path:
+        return False
+    try:
+        mtime = os.stat(path).st_mtime
+        if not force and mtime == whitelist.mtime:
+            return False
+        with open(path, encoding='utf-8') as f:
+            settings = json.load(f)
+        whitelist = Whitelist.build(settings, source=path, mtime=mtime)
+    except (OSError, ValueError, AttributeError, TypeError) as e:
+        print(f"⚠️  Whitelist {path} no recargada: {e}")
+        return False
+    print(f"[Whitelist] Recargada desde {path}: {len(whitelist.domains)} dominios, "
+          f"{len(whitelist.iframe_hosts)} hosts de iframe")
+    return True
+
+
 def is_domain_allowed(url: str) -> bool:
     """Verifica si el dominio está en la whitelist"""
     try:
         hostname = urlparse(url).hostname
         if not hostname:
             return False
-        
-        hostname = hostname.lower()
-        
-        for domain in config.ALLOWED_DOMAINS:
-            # Soporte para wildcards: *.fbcdn.net
-            if domain.startswith('*.'):
-                base_domain = domain[2:]
-                if hostname == base_domain or hostname.endswith(f'.{base_domain}'):
-                    return True
-            else:
-                # Match exacto o subdominio
-                if hostname == domain or hostname.endswith(f'.{domain}'):
-                    return True
-        
-        return False
+        return whitelist.domains.matches(hostname)
     except Exception:
         return False
 
@@ -184,39 +1416,16 @@ def is_domain_allowed(url: str) -> bool:
 def is_mime_allowed(content_type: str) -> bool:
     """Verifica si el tipo MIME está permitido"""
     mime = content_type.lower().split(';')[0].strip()
-    
-    all_types = (
-        config.ALLOWED_MIME_TYPES['images'] +
-        config.ALLOWED_MIME_TYPES['videos'] +
-        config.ALLOWED_MIME_TYPES['audios']
-    )
-    
-    return mime in all_types
+    return mime in whitelist.mime_types
 
 
-def is_private_ip(hostname: str) -> bool:
-    """Verifica si es una IP privada (prevención SSRF)"""
-    import socket
-    
-    try:
-        ip = socket.gethostbyname(hostname)
-        
-        # IPs privadas y localhost
-        private_ranges = [
-            '127.',
-            '10.',
-            '172.16.', '172.17.', '172.18.', '172.19.',
-            '172.20.', '172.21.', '172.22.', '172.23.',
-            '172.24.', '172.25.', '172.26.', '172.27.',
-            '172.28.', '172.29.', '172.30.', '172.31.',
-            '192.168.',
-            '169.254.',  # AWS metadata
-            '0.0.0.0'
-        ]
-        
-        return any(ip.startswith(prefix) for prefix in private_ranges)
-    except Exception:
-        return False
+async def is_private_ip(hostname: str) -> bool:
+    """
+    Verifica si el host resuelve a alguna IP privada (prevención SSRF).
+    Se comprueban todos los registros A/AAAA; OSError si no resuelve
+    """
+    addresses = await dns_resolver.resolve(hostname)
+    return any(is_blocked_address(address) for address in addresses)
 
 
 def is_iframe_host_allowed(url: str) -> bool:
@@ -226,12 +1435,7 @@ def is_iframe_host_allowed(url: str) -> bool:
         if not hostname:
             return False
         
-        hostname = hostname.lower()
-        
-        return any(
-            hostname == host or hostname.endswith(f'.{host}')
-            for host in config.ALLOWED_IFRAME_HOSTS
-        )
+        return whitelist.iframe_hosts.matches(hostname)
     except Exception:
         return False
 
@@ -272,7 +1476,192 @@ def sanitize_iframe_url(url: str) -> str:
         ''  # Eliminar fragment si contiene javascript:
     ))
     
-    return safe_url
+    return safe_url
+
+
+# ============================================================================
+# TRANSFORMACIÓN DE IMÁGENES
+# ============================================================================
+
+# formato pedido -> (formato de Pillow, MIME de salida)
+OUTPUT_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+    'avif': ('AVIF', 'image/avif'),
+}
+# MIME declarado por el origen -> único decodificador de Pillow que se prueba
+SOURCE_FORMATS = {
+    'image/jpeg': 'JPEG',
+    'image/jpg': 'JPEG',
+    'image/png': 'PNG',
+    'image/webp': 'WEBP',
+    'image/bmp': 'BMP',
+}
+FIT_MODES = ('contain', 'cover', 'fill')
+
+
+def output_format_available(name: str) -> bool:
+    return PIL_AVAILABLE and OUTPUT_FORMATS[name][0] in Image.SAVE
+
+
+class TransformSpec(NamedTuple):
+    """Variante pedida de una imagen; output_format='source' conserva jpeg/png del original"""
+    width: Optional[int]
+    height: Optional[int]
+    fit: str
+    quality: int
+    output_format: str
+    negotiated: bool  # formato elegido por Accept (la respuesta lleva Vary: Accept)
+    
+    def key(self) -> str:
+        return f'w={self.width}&h={self.height}&fit={self.fit}&q={self.quality}&f={self.output_format}'
+
+
+def build_transform_spec(w: Optional[int], h: Optional[int], fit: Optional[str],
+                         q: Optional[int], output_format: Optional[str],
+                         accept: str) -> Optional[TransformSpec]:
+    """
+    Valida los parámetros de transformación; None si no se pidió ninguna
+    (o Pillow no está instalado y se sirve el original)
+    """
+    if w is None and h is None and output_format is None and q is None:
+        return None
+    if not PIL_AVAILABLE:
+        return None
+    
+    fit = (fit or 'contain').lower()
+    if fit not in FIT_MODES:
+        raise HTTPException(status_code=400, detail=f"fit debe ser uno de {', '.join(FIT_MODES)}")
+    
+    negotiated = output_format is None
+    if negotiated:
+        # Mejor formato que acepte el cliente; si ninguno, el del original
+        output_format = next(
+            (name for name in ('avif', 'webp')
+             if f'image/{name}' in accept and output_format_available(name)),
+            'source'
+        )
+    else:
+        output_format = output_format.lower()
+        if output_format == 'jpg':
+            output_format = 'jpeg'
+        if output_format not in OUTPUT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Formato no soportado: {output_format}")
+        if not output_format_available(output_format):
+            raise HTTPException(status_code=400, detail=f"Formato no disponible en este servidor: {output_format}")
+    
+    return TransformSpec(w, h, fit, q or config.TRANSFORM_DEFAULT_QUALITY, output_format, negotiated)
+
+
+def target_box(size: Tuple[int, int], spec: TransformSpec) -> Tuple[int, int]:
+    """Caja de destino sin ampliar nunca el original"""
+    width, height = size
+    box_w = spec.width or round(width * spec.height / height)
+    box_h = spec.height or round(height * spec.width / width)
+    scale = min(1.0, width / box_w, height / box_h)
+    return max(1, round(box_w * scale)), max(1, round(box_h * scale))
+
+
+def transform_image(content: bytes, spec: TransformSpec, source_type: str,
+                    max_pixels: int) -> Optional[Tuple[bytes, str]]:
+    """
+    Redimensiona y recodifica una imagen (se ejecuta en el pool de procesos).
+    Devuelve None si la imagen debe servirse tal cual (p. ej. animada, o si
+    los bytes no son del tipo que declaró el origen: solo se ejecuta el
+    decodificador de ese tipo, nunca los demás plugins de Pillow)
+    """
+    expected = SOURCE_FORMATS.get(source_type)
+    if expected is None:
+        return None
+    try:
+        img = Image.open(io.BytesIO(content), formats=(expected,))
+    except Image.UnidentifiedImageError:
+        return None
+    
+    with img:
+        if img.format != expected:
+            return None
+        if img.width * img.height > max_pixels:
+            raise ValueError(f"Imagen demasiado grande para transformar: {img.width}x{img.height}")
+        if getattr(img, 'is_animated', False):
+            return None
+        
+        img = ImageOps.exif_transpose(img)
+        if spec.width or spec.height:
+            box = target_box(img.size, spec)
+            if spec.fit == 'cover' and spec.width and spec.height:
+                img = ImageOps.fit(img, box, Image.Resampling.LANCZOS)
+            elif spec.fit == 'fill' and spec.width and spec.height:
+                img = img.resize(box, Image.Resampling.LANCZOS)
+            else:
+                img.thumbnail(box, Image.Resampling.LANCZOS)
+        
+        name = spec.output_format
+        if name == 'source':
+            name = 'png' if source_type == 'image/png' else 'jpeg'
+        pil_format, mime = OUTPUT_FORMATS[name]
+        
+        if pil_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+            # JPEG no tiene alfa: se aplana sobre blanco
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel('A'))
+        elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        
+        options = {
+            'JPEG': {'quality': spec.quality, 'optimize': True, 'progressive': True},
+            'WEBP': {'quality': spec.quality, 'method': 4},
+            'AVIF': {'quality': spec.quality},
+            'PNG': {'optimize': True},
+        }[pil_format]
+        out = io.BytesIO()
+        img.save(out, pil_format, **options)
+        return out.getvalue(), mime
+
+
+transform_pool: Optional[ProcessPoolExecutor] = None
+transform_stats = {"variants": 0, "passthrough": 0, "errors": 0, "total_ms": 0.0}
+
+
+def get_transform_pool() -> ProcessPoolExecutor:
+    global transform_pool
+    if transform_pool is None:
+        transform_pool = ProcessPoolExecutor(max_workers=config.TRANSFORM_WORKERS)
+    return transform_pool
+
+
+def discard_transform_pool(broken: ProcessPoolExecutor):
+    """
+    Retira un pool roto (un worker murió, p. ej. por un segfault de Pillow);
+    la siguiente transformación crea uno nuevo. Si otra petición ya lo
+    reemplazó no se toca el actual
+    """
+    global transform_pool
+    if transform_pool is broken:
+        transform_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_transform(content: bytes, spec: TransformSpec,
+                        content_type: str) -> Optional[Tuple[bytes, str]]:
+    """
+    transform_image en el pool de procesos. Si el pool está roto se recrea y
+    se reintenta una vez; si vuelve a romperse la imagen se da por imposible
+    """
+    for attempt in range(2):
+        pool = get_transform_pool()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                pool, transform_image,
+                content, spec, content_type, config.TRANSFORM_MAX_PIXELS
+            )
+        except BrokenProcessPool:
+            discard_transform_pool(pool)
+            print(f"⚠️  Pool de transformación roto; se recrea (intento {attempt + 1})")
+    transform_stats["errors"] += 1
+    raise HTTPException(status_code=422, detail="No se pudo procesar la imagen: el worker de transformación terminó")
 
 
 # ============================================================================
@@ -294,6 +1683,68 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+METRIC_ROUTES = {
+    '/api/media-proxy', '/api/media-proxy/batch', '/api/media-proxy/stats',
+    '/api/validate-iframe', '/health', '/metrics'
+}
+MEDIA_ROUTES = {'/api/media-proxy', '/api/media-proxy/batch'}
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI que mide cada petición: duración total, escritura de la
+    respuesta (desde las cabeceras hasta el último bloque), estado, X-Cache
+    y bytes servidos desde caché u origen
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        
+        started = time.perf_counter()
+        state = {'status': 500, 'cache': '', 'write_started': None, 'bytes': 0}
+        
+        async def send_with_metrics(message):
+            if message['type'] == 'http.response.start':
+                state['status'] = message['status']
+                state['write_started'] = time.perf_counter()
+                for name, value in message.get('headers', []):
+                    if name.lower() == b'x-cache':
+                        state['cache'] = value.decode('latin-1')
+            elif message['type'] == 'http.response.body':
+                state['bytes'] += len(message.get('body', b''))
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            self.record(scope.get('path', ''), state, started)
+    
+    @staticmethod
+    def record(path: str, state: Dict, started: float):
+        route = path if path in METRIC_ROUTES else 'other'
+        status = state['status']
+        cache_status = state['cache'].lower() or 'none'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route)
+        REQUESTS.inc(route, str(status), cache_status)
+        if state['write_started'] is not None:
+            observe_stage('response_write', state['write_started'])
+        if route in MEDIA_ROUTES:
+            if 400 <= status < 500:
+                REJECTIONS.inc(str(status))
+            if state['bytes']:
+                source = 'origin' if cache_status.startswith('miss') else (
+                    'cache' if cache_status != 'none' else 'other'
+                )
+                RESPONSE_BYTES.inc(source, amount=state['bytes'])
+
+
+app.add_middleware(MetricsMiddleware)
+
 
 # ============================================================================
 # ENDPOINTS
@@ -302,6 +1753,12 @@ app.add_middleware(
 @app.get("/api/media-proxy")
 async def media_proxy(
     url: str = Query(..., description="URL del recurso a proxear"),
+    w: Optional[int] = Query(None, ge=1, le=config.TRANSFORM_MAX_DIMENSION, description="Ancho máximo"),
+    h: Optional[int] = Query(None, ge=1, le=config.TRANSFORM_MAX_DIMENSION, description="Alto máximo"),
+    fit: Optional[str] = Query(None, description="contain (defecto), cover o fill"),
+    q: Optional[int] = Query(None, ge=1, le=100, description="Calidad de compresión"),
+    output_format: Optional[str] = Query(None, alias="format",
+                                         description="webp, avif, jpeg o png; sin él se negocia por Accept"),
     request: Request = None
 ):
     """
@@ -309,8 +1766,61 @@ async def media_proxy(
     
     Ejemplo:
         /api/media-proxy?url=https://i.imgur.com/abc123.jpg
+        /api/media-proxy?url=https://i.imgur.com/abc123.jpg&w=64&h=64&fit=cover
     """
     
+    # 1-5. Validar URL, whitelist, HTTPS y SSRF
+    parsed = await validate_media_url(url)
+    
+    # 6. Verificar caché (memoria y, si no está fresca allí, disco)
+    cache_key = hashlib.md5(url.encode()).hexdigest()
+    
+    accept = request.headers.get('accept', '') if request is not None else ''
+    spec = build_transform_spec(w, h, fit, q, output_format, accept)
+    if spec is not None:
+        return await transformed_response(url, parsed, cache_key, spec, request)
+    
+    started = time.perf_counter()
+    entry = cache.get(cache_key)
+    if entry is None or not entry.is_fresh():
+        on_disk = await disk_lookup(cache_key)
+        if on_disk is not None and (entry is None or on_disk.is_fresh()):
+            entry = on_disk
+    observe_stage('cache_lookup', started)
+    
+    if entry is not None:
+        if entry.is_fresh():
+            return cached_response(entry, 'HIT', request)
+        if entry.age() <= config.CACHE_MAX_AGE + config.CACHE_STALE_WHILE_REVALIDATE:
+            # Stale-while-revalidate: se sirve ya y se refresca en segundo plano
+            schedule_revalidation(url, parsed, cache_key, entry)
+            return cached_response(entry, 'STALE', request)
+    
+    # 7. Si ya hay un fetch de esta URL en curso, esperar su resultado
+    inflight = singleflight.join(cache_key)
+    if inflight is not None:
+        shared = await singleflight.wait(cache_key, inflight)
+        if shared is None:
+            # El cuerpo no cabía en memoria: puede estar ya en disco; si no, fetch propio
+            shared = await disk_lookup(cache_key)
+        if shared is not None and shared.is_fresh():
+            return cached_response(shared, 'COALESCED', request)
+        return await fetch_upstream(url, parsed, cache_key, request, lead=False)
+    
+    # 8. Un solo rango de un objeto no cacheado: se pide solo ese rango al origen
+    range_header = request.headers.get('range') if request is not None else None
+    if entry is None and is_single_range(range_header):
+        return await fetch_upstream_range(url, parsed, range_header)
+    
+    # 9. Descargar (condicional si hay una entrada expirada con validadores)
+    return await fetch_upstream(url, parsed, cache_key, request, lead=True, stale=entry)
+
+
+async def validate_media_url(url: str):
+    """Validaciones previas a cualquier fetch; HTTPException si la URL no se admite"""
+    
+    started = time.perf_counter()
+    
     # 1. Validar URL
     if not url:
         raise HTTPException(status_code=400, detail="Parámetro 'url' requerido")
@@ -337,79 +1847,849 @@ async def media_proxy(
             detail="Solo se permiten URLs con protocolo HTTPS"
         )
     
-    # 5. Prevenir SSRF
-    if is_private_ip(parsed.netloc):
+    observe_stage('validation', started)
+    
+    # 5. Prevenir SSRF (la conexión usará estas mismas IPs, ver PinnedNetworkBackend)
+    started = time.perf_counter()
+    try:
+        blocked = await is_private_ip(parsed.hostname or '')
+    except OSError:
+        raise HTTPException(status_code=502, detail=f"No se pudo resolver: {parsed.hostname}")
+    finally:
+        observe_stage('dns', started)
+    if blocked:
         raise HTTPException(
             status_code=403,
             detail="IP privada bloqueada"
         )
     
-    # 6. Verificar caché
-    cache_key = hashlib.md5(url.encode()).hexdigest()
-    cached = cache.get(cache_key)
+    return parsed
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comparación débil de If-None-Match (RFC 9110 §13.1.2)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(','))
+    return any(tag.removeprefix('W/') == etag for tag in candidates)
+
+
+def cached_response(entry: CachedObject, cache_status: str, request: Optional[Request],
+                    vary: Optional[str] = None) -> Response:
+    """Respuesta servida desde memoria o disco, o 304 si el cliente ya la tiene"""
+    if entry.path is not None:
+        cache_status = f'{cache_status}-DISK'
+    headers = proxy_headers(None, cache_status)
+    headers['ETag'] = entry.etag
+    if vary:
+        headers['Vary'] = vary
+    
+    if request is not None and etag_matches(request.headers.get('if-none-match'), entry.etag):
+        return Response(status_code=304, headers=headers)
+    
+    ranges = requested_ranges(request, entry)
+    if ranges is not None:
+        return range_response(entry, ranges, headers)
+    
+    if entry.content is not None:
+        return Response(content=entry.content, media_type=entry.content_type, headers=headers)
+    return FileResponse(entry.path, media_type=entry.content_type, headers=headers)
+
+
+def parse_range_header(value: Optional[str], size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Rangos (inicio, fin inclusivo) de una cabecera Range, ordenados y sin
+    solapes. None si la cabecera falta, está mal formada o tiene demasiadas
+    partes (se sirve el objeto completo); lista vacía si ningún rango cabe
+    en el objeto (416)
+    """
+    if not value:
+        return None
+    unit, _, spec = value.partition('=')
+    parts = spec.split(',')
+    if unit.strip().lower() != 'bytes' or not spec.strip() or len(parts) > config.RANGE_MAX_PARTS:
+        return None
+    
+    ranges = []
+    for part in parts:
+        first, dash, last = part.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                # Sufijo: los últimos N bytes
+                suffix = int(last)
+                if suffix > 0 and size > 0:
+                    ranges.append((max(0, size - suffix), size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if start < size:
+            end = size - 1 if end is None else end
+            ranges.append((start, min(end, size - 1)))
+    
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def is_single_range(value: Optional[str]) -> bool:
+    """Cabecera Range de una sola parte, que se puede reenviar tal cual al origen"""
+    return bool(value) and ',' not in value and parse_range_header(value, 1 << 62) is not None
+
+
+def requested_ranges(request: Optional[Request], entry: CachedObject) -> Optional[List[Tuple[int, int]]]:
+    """Rangos a servir de una entrada cacheada; None para responder completo"""
+    if request is None:
+        return None
+    if_range = request.headers.get('if-range')
+    if if_range is not None and if_range.strip() != entry.etag:
+        # If-Range con otro ETag (o con fecha): el cliente tiene otra versión
+        return None
+    return parse_range_header(request.headers.get('range'), entry.size)
+
+
+async def iter_entry_bytes(entry: CachedObject, start: int, end: int):
+    """Bytes [start, end] de una entrada, en bloques y sin cargar el fichero entero"""
+    if entry.content is not None:
+        for offset in range(start, end + 1, config.STREAM_CHUNK_SIZE):
+            yield entry.content[offset:min(offset + config.STREAM_CHUNK_SIZE, end + 1)]
+        return
     
-    if cached:
-        content, content_type = cached
+    with open(entry.path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await run_in_threadpool(f.read, min(config.STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def range_response(entry: CachedObject, ranges: List[Tuple[int, int]],
+                   headers: Dict[str, str]) -> Response:
+    """206 con uno o varios rangos (multipart/byteranges), o 416 si ninguno es válido"""
+    if not ranges:
         return Response(
-            content=content,
+            status_code=416,
+            headers={**headers, 'Content-Range': f'bytes */{entry.size}'}
+        )
+    
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end}/{entry.size}'
+        headers['Content-Length'] = str(end - start + 1)
+        return StreamingResponse(
+            iter_entry_bytes(entry, start, end),
+            status_code=206,
+            media_type=entry.content_type,
+            headers=headers
+        )
+    
+    boundary = secrets.token_hex(12)
+    part_headers = [
+        (f'--{boundary}\r\nContent-Type: {entry.content_type}\r\n'
+         f'Content-Range: bytes {start}-{end}/{entry.size}\r\n\r\n').encode()
+        for start, end in ranges
+    ]
+    closing = f'\r\n--{boundary}--\r\n'.encode()
+    
+    async def multipart():
+        for index, ((start, end), head) in enumerate(zip(ranges, part_headers)):
+            yield (b'\r\n' if index else b'') + head
+            async for chunk in iter_entry_bytes(entry, start, end):
+                yield chunk
+        yield closing
+    
+    headers['Content-Length'] = str(
+        sum(len(head) for head in part_headers) + 2 * (len(ranges) - 1) + len(closing)
+        + sum(end - start + 1 for start, end in ranges)
+    )
+    return StreamingResponse(
+        multipart(),
+        status_code=206,
+        media_type=f'multipart/byteranges; boundary={boundary}',
+        headers=headers
+    )
+
+
+class UpstreamStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse cuyo background (cerrar el origen, liberar el
+    single-flight) corre siempre una vez, también si el cliente se
+    desconecta antes de recibir nada y Starlette no llega a ejecutarlo
+    """
+    
+    async def __call__(self, scope, receive, send):
+        background, self.background = self.background, None
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if background is not None:
+                await background()
+
+
+async def finish_upstream(response: httpx.Response, cache_key: str = '',
+                          flight: Optional[asyncio.Future] = None):
+    """Tras enviar (o abandonar) una respuesta del origen: liberar a los agrupados y cerrarla"""
+    if flight is not None:
+        singleflight.release(cache_key, flight)
+    await response.aclose()
+
+
+async def fetch_upstream_range(url: str, parsed, range_header: str) -> Response:
+    """
+    Reenvía un rango al origen sin descargar el resto del objeto.
+    La respuesta parcial no se cachea; si el origen ignora Range y devuelve
+    200 se sirve (y cachea) completo como un miss normal
+    """
+    response, content_type, content_length = await open_upstream(
+        url, parsed, {'Range': range_header}
+    )
+    body, content_length = await read_head(response, content_length)
+    cache_key = hashlib.md5(url.encode()).hexdigest()
+    if response.status_code != 206:
+        return UpstreamStreamingResponse(
+            stream_upstream(response, cache_key, content_type, content_length, body=body),
             media_type=content_type,
-            headers={
-                'Cache-Control': f'public, max-age={config.CACHE_MAX_AGE}',
-                'X-Cache': 'HIT',
-                'Access-Control-Allow-Origin': '*'
-            }
+            headers=proxy_headers(content_length, cache_status='MISS'),
+            background=BackgroundTask(finish_upstream, response)
         )
     
-    # 7. Fetch del recurso externo
-    async with httpx.AsyncClient(
-        timeout=config.TIMEOUT,
-        follow_redirects=True
-    ) as client:
+    headers = proxy_headers(content_length, cache_status='MISS')
+    headers['Content-Range'] = response.headers.get('content-range', '')
+    return UpstreamStreamingResponse(
+        stream_upstream(response, cache_key, content_type, content_length, cacheable=False, body=body),
+        status_code=206,
+        media_type=content_type,
+        headers=headers,
+        background=BackgroundTask(finish_upstream, response)
+    )
+
+
+async def disk_lookup(cache_key: str) -> Optional[CachedObject]:
+    """Entrada del caché en disco, o None si no está (o no hay disco)"""
+    if disk_cache is None:
+        return None
+    try:
+        return await run_in_threadpool(disk_cache.get, cache_key)
+    except sqlite3.Error as e:
+        print(f"[DiskCache] Error leyendo índice: {e}")
+        return None
+
+
+def conditional_headers(entry: Optional[CachedObject]) -> Dict[str, str]:
+    """Validadores del origen para una petición condicional"""
+    headers = {}
+    if entry is not None:
+        if entry.upstream_etag:
+            headers['If-None-Match'] = entry.upstream_etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+    return headers
+
+
+async def refresh_entry(cache_key: str, entry: CachedObject) -> CachedObject:
+    """El origen confirmó (304) que la entrada sigue vigente: renovar en ambos niveles"""
+    cache.refresh(cache_key)
+    if disk_cache is not None:
         try:
-            response = await client.get(
-                url,
-                headers={
-                    'User-Agent': config.USER_AGENT,
-                    'Accept': 'image/*,video/*,audio/*'
-                }
+            await run_in_threadpool(disk_cache.refresh, cache_key)
+        except sqlite3.Error as e:
+            print(f"[DiskCache] Error renovando entrada: {e}")
+    revalidation_stats["not_modified"] += 1
+    return entry._replace(stored_at=time.time())
+
+
+revalidation_stats = {"not_modified": 0, "modified": 0, "background": 0, "errors": 0}
+revalidation_tasks: Dict[str, asyncio.Task] = {}
+
+
+def schedule_revalidation(url: str, parsed, cache_key: str, entry: CachedObject):
+    """Lanza (una sola vez por clave) la revalidación en segundo plano"""
+    if cache_key in revalidation_tasks or singleflight.is_running(cache_key):
+        return
+    revalidation_stats["background"] += 1
+    task = asyncio.create_task(revalidate_in_background(url, parsed, cache_key, entry))
+    revalidation_tasks[cache_key] = task
+    task.add_done_callback(lambda _: revalidation_tasks.pop(cache_key, None))
+
+
+async def revalidate_in_background(url: str, parsed, cache_key: str, entry: CachedObject):
+    """GET condicional: 304 renueva la entrada; 200 la reemplaza con el cuerpo nuevo"""
+    try:
+        response, content_type, content_length = await open_upstream(
+            url, parsed, conditional_headers(entry)
+        )
+        if response.status_code == 304:
+            await response.aclose()
+            await refresh_entry(cache_key, entry)
+            return
+        revalidation_stats["modified"] += 1
+        async for _ in stream_upstream(response, cache_key, content_type, content_length, committed=False):
+            pass
+    except Exception as e:
+        revalidation_stats["errors"] += 1
+        print(f"[Revalidate] {url}: {e}")
+
+
+async def fetch_upstream(url: str, parsed, cache_key: str, request: Optional[Request],
+                         lead: bool, stale: Optional[CachedObject] = None) -> Response:
+    """
+    Descarga el recurso del origen y lo reenvía en streaming.
+    
+    Con lead=True la petición es la líder del single-flight: los errores
+    previos al streaming se propagan a las peticiones agrupadas y el cuerpo
+    se les entrega al terminar (ver stream_upstream). Con una entrada stale
+    la petición es condicional y un 304 sirve la copia local renovada.
+    """
+    flight = singleflight.lead(cache_key) if lead else None
+    try:
+        response, content_type, content_length = await open_upstream(
+            url, parsed, conditional_headers(stale)
+        )
+        if response.status_code != 304:
+            body, content_length = await read_head(response, content_length)
+    except HTTPException as e:
+        singleflight.resolve(cache_key, flight, error=e)
+        raise
+    except BaseException:
+        singleflight.resolve(cache_key, flight)
+        raise
+    
+    if response.status_code == 304:
+        await response.aclose()
+        if stale is None:
+            # Sin copia local que renovar: un 304 aquí es un error del origen
+            error = HTTPException(status_code=502, detail="Error upstream: 304 sin petición condicional")
+            singleflight.resolve(cache_key, flight, error=error)
+            raise error
+        fresh = await refresh_entry(cache_key, stale)
+        singleflight.resolve(cache_key, flight, fresh)
+        return cached_response(fresh, 'REVALIDATED', request)
+    if stale is not None:
+        revalidation_stats["modified"] += 1
+    
+    # Reenviar en streaming; se copia al caché solo si cabe
+    return UpstreamStreamingResponse(
+        stream_upstream(response, cache_key, content_type, content_length, flight, body=body),
+        media_type=content_type,
+        headers=proxy_headers(content_length, cache_status='MISS'),
+        background=BackgroundTask(finish_upstream, response, cache_key, flight)
+    )
+
+
+TRACE_STAGES = {
+    'connection.connect_tcp': 'upstream_connect',
+    'connection.start_tls': 'upstream_tls',
+}
+
+
+def upstream_trace():
+    """
+    Callback de trazas de httpcore: tiempos de conexión TCP y TLS (solo en
+    conexiones nuevas) y TTFB desde el envío de cabeceras hasta recibir las
+    de la respuesta
+    """
+    marks: Dict[str, float] = {}
+    
+    async def trace(event: str, info: Dict):
+        name, _, phase = event.rpartition('.')
+        if phase == 'started':
+            marks[name] = time.perf_counter()
+            return
+        if phase != 'complete':
+            return
+        if name in TRACE_STAGES and name in marks:
+            observe_stage(TRACE_STAGES[name], marks[name])
+        elif name.endswith('.receive_response_headers'):
+            sent = marks.get(name.replace('receive_response_headers', 'send_request_headers'))
+            if sent is not None:
+                observe_stage('upstream_ttfb', sent)
+    
+    return trace
+
+
+async def open_upstream(url: str, parsed, extra_headers: Optional[Dict[str, str]] = None
+                        ) -> Tuple[httpx.Response, str, Optional[int]]:
+    """
+    Abre la respuesta del origen y valida cabeceras antes de leer el cuerpo.
+    Un 304 solo es válido si se enviaron validadores (extra_headers)
+    """
+    client = get_http_client()
+    host = parsed.hostname or parsed.netloc
+    started = upstream_metrics.start(host)
+    try:
+        request_upstream = client.build_request(
+            'GET',
+            url,
+            # Sin compresión: el cuerpo se reenvía y cachea tal cual, así que
+            # Content-Length y MAX_FILE_SIZE se refieren a los bytes servidos
+            headers={
+                'Accept': 'image/*,video/*,audio/*',
+                'Accept-Encoding': 'identity',
+                **(extra_headers or {})
+            },
+            extensions={'trace': upstream_trace()}
+        )
+        response = await client.send(request_upstream, stream=True)
+        if response.status_code == 416 and 'Range' in (extra_headers or {}):
+            await response.aclose()
+            upstream_metrics.finish(host, started)
+            raise HTTPException(
+                status_code=416,
+                detail="Rango no satisfacible",
+                headers={'Content-Range': response.headers.get('content-range', 'bytes */*')}
             )
+        if response.status_code != 304:
             response.raise_for_status()
-            
-        except httpx.TimeoutException:
-            raise HTTPException(status_code=504, detail="Timeout al obtener recurso")
-        except httpx.HTTPError as e:
-            raise HTTPException(status_code=502, detail=f"Error upstream: {str(e)}")
+        
+    except httpx.TimeoutException:
+        upstream_metrics.finish(host, started, error=True)
+        raise HTTPException(status_code=504, detail="Timeout al obtener recurso")
+    except httpx.HTTPError as e:
+        upstream_metrics.finish(host, started, error=True)
+        if isinstance(e, httpx.HTTPStatusError):
+            await e.response.aclose()
+        raise HTTPException(status_code=502, detail=f"Error upstream: {str(e)}")
+    upstream_metrics.finish(host, started)
+    
+    if response.status_code == 304:
+        if extra_headers:
+            return response, '', None
+        await response.aclose()
+        raise HTTPException(status_code=502, detail="Error upstream: 304 sin petición condicional")
     
-    # 8. Validar Content-Type
+    # Validar Content-Type (solo cabeceras: aún no se ha leído el cuerpo)
     content_type = response.headers.get('content-type', '')
     if not is_mime_allowed(content_type):
+        await response.aclose()
         raise HTTPException(
             status_code=415,
             detail=f"Tipo de contenido no permitido: {content_type}"
         )
     
-    # 9. Validar tamaño
-    content = response.content
-    if len(content) > config.MAX_FILE_SIZE:
+    # Validar tamaño declarado antes de descargar nada (en un 206, el total del objeto)
+    content_length = parse_content_length(response.headers.get('content-length'))
+    if response.headers.get('content-encoding', 'identity').lower() != 'identity':
+        # El origen comprimió pese a Accept-Encoding: identity. httpx entrega
+        # el cuerpo descomprimido, así que el tamaño declarado no vale
+        if response.status_code == 206:
+            await response.aclose()
+            raise HTTPException(status_code=502, detail="Error upstream: rango con Content-Encoding")
+        content_length = None
+    declared_size = content_length
+    if response.status_code == 206:
+        declared_size = parse_content_length(response.headers.get('content-range', '').rpartition('/')[2])
+    if declared_size is not None and declared_size > config.MAX_FILE_SIZE:
+        await response.aclose()
+        raise_too_large()
+    
+    return response, content_type, content_length
+
+
+async def read_head(response: httpx.Response, content_length: Optional[int]
+                    ) -> Tuple[AsyncIterator[bytes], Optional[int]]:
+    """
+    Sin Content-Length declarado, lee hasta STREAM_PREBUFFER_SIZE antes de
+    enviar cabeceras: si el cuerpo termina antes se sirve con su tamaño
+    exacto. Retorna (iterador del cuerpo completo, tamaño si se conoce)
+    """
+    chunks = response.aiter_bytes(config.STREAM_CHUNK_SIZE)
+    if content_length is not None:
+        return chunks, content_length
+    
+    head: List[bytes] = []
+    size = 0
+    try:
+        while size <= config.STREAM_PREBUFFER_SIZE:
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return replay_chunks(head, None), size
+            head.append(chunk)
+            size += len(chunk)
+            if size > config.MAX_FILE_SIZE:
+                raise_too_large()
+    except httpx.HTTPError as e:
+        await response.aclose()
+        raise HTTPException(status_code=502, detail=f"Error upstream: {str(e)}")
+    except BaseException:
+        await response.aclose()
+        raise
+    return replay_chunks(head, chunks), None
+
+
+async def replay_chunks(head: List[bytes], rest: Optional[AsyncIterator[bytes]]):
+    """Bloques ya leídos por read_head seguidos del resto del cuerpo"""
+    for chunk in head:
+        yield chunk
+    if rest is not None:
+        async for chunk in rest:
+            yield chunk
+
+
+def parse_content_length(value: Optional[str]) -> Optional[int]:
+    """Content-Length como entero, o None si falta o no es válido"""
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def raise_too_large():
+    raise HTTPException(
+        status_code=413,
+        detail=f"Archivo muy grande (máx {config.MAX_FILE_SIZE / 1024 / 1024}MB)"
+    )
+
+
+def proxy_headers(content_length: Optional[int], cache_status: str) -> Dict[str, str]:
+    """Cabeceras comunes de las respuestas del proxy"""
+    headers = {
+        'Cache-Control': f'public, max-age={config.CACHE_MAX_AGE}',
+        'X-Cache': cache_status,
+        'Access-Control-Allow-Origin': '*',
+        'X-Content-Type-Options': 'nosniff',
+        'Accept-Ranges': 'bytes'
+    }
+    if content_length is not None:
+        headers['Content-Length'] = str(content_length)
+    return headers
+
+
+async def transformed_response(url: str, parsed, cache_key: str, spec: TransformSpec,
+                               request: Optional[Request]) -> Response:
+    """Sirve una variante redimensionada/recodificada (ver load_variant)"""
+    entry, cache_status = await load_variant(url, parsed, cache_key, spec)
+    vary = 'Accept' if spec.negotiated and cache_status != 'BYPASS' else None
+    return cached_response(entry, cache_status, request, vary)
+
+
+async def load_variant(url: str, parsed, cache_key: str,
+                       spec: TransformSpec) -> Tuple[CachedObject, str]:
+    """
+    Variante cacheada bajo su propia clave (URL + parámetros + formato) en
+    memoria y disco. El original se toma del caché o se descarga (y cachea)
+    una sola vez; la transformación corre en el pool de procesos. Si la
+    imagen no se puede transformar se devuelve el original ('BYPASS')
+    """
+    variant_key = hashlib.md5(f'{url}|{spec.key()}'.encode()).hexdigest()
+    
+    entry = await lookup_fresh(variant_key)
+    if entry is not None:
+        return entry, 'HIT'
+    
+    inflight = singleflight.join(variant_key)
+    if inflight is not None:
+        shared = await singleflight.wait(variant_key, inflight)
+        if shared is not None:
+            return shared, 'COALESCED'
+    
+    flight = singleflight.lead(variant_key)
+    try:
+        original, _ = await load_original(url, parsed, cache_key)
+        source_type = original.content_type.split(';')[0].strip().lower()
+        if source_type not in config.TRANSFORMABLE_MIME_TYPES:
+            transform_stats["passthrough"] += 1
+            singleflight.resolve(variant_key, flight)
+            return original, 'BYPASS'
+        
+        content = original.content
+        if content is None:
+            content = await run_in_threadpool(original.path.read_bytes)
+        
+        started = time.perf_counter()
+        result = await run_transform(content, spec, source_type)
+        transform_stats["total_ms"] += (time.perf_counter() - started) * 1000
+        observe_stage('transform', started)
+        if result is None:
+            transform_stats["passthrough"] += 1
+            singleflight.resolve(variant_key, flight)
+            return original, 'BYPASS'
+        
+        body, content_type = result
+        transform_stats["variants"] += 1
+        variant = cache.set(variant_key, body, content_type) or CachedObject(
+            body, None, content_type, len(body),
+            content_etag(hashlib.sha256(body).hexdigest()), None, None, time.time()
+        )
+        await store_on_disk(variant_key, body, content_type)
+        singleflight.resolve(variant_key, flight, variant)
+        return variant, 'MISS'
+    
+    except HTTPException as e:
+        singleflight.resolve(variant_key, flight, error=e)
+        raise
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        transform_stats["errors"] += 1
+        error = HTTPException(status_code=422, detail=f"No se pudo procesar la imagen: {e}")
+        singleflight.resolve(variant_key, flight, error=error)
+        raise error
+    except BaseException:
+        singleflight.resolve(variant_key, flight)
+        raise
+
+
+async def lookup_fresh(cache_key: str) -> Optional[CachedObject]:
+    """Entrada fresca en memoria o, si no, en disco"""
+    started = time.perf_counter()
+    entry = cache.get(cache_key)
+    if entry is None or not entry.is_fresh():
+        entry = await disk_lookup(cache_key)
+    observe_stage('cache_lookup', started)
+    if entry is not None and entry.is_fresh():
+        return entry
+    return None
+
+
+async def load_original(url: str, parsed, cache_key: str,
+                        keep_body: bool = True) -> Tuple[CachedObject, str]:
+    """
+    Original fresco desde memoria o disco; si no, se descarga completo y se
+    cachea, compartiendo el fetch con las peticiones concurrentes
+    (single-flight). Con keep_body=False no se retiene en memoria un cuerpo
+    que no quepa en el caché (solo interesan tamaño y tipo)
+    """
+    entry = await lookup_fresh(cache_key)
+    if entry is not None:
+        return entry, 'HIT'
+    
+    inflight = singleflight.join(cache_key)
+    if inflight is not None:
+        shared = await singleflight.wait(cache_key, inflight) or await lookup_fresh(cache_key)
+        if shared is not None:
+            return shared, 'COALESCED'
+    
+    flight = singleflight.lead(cache_key) if inflight is None else None
+    try:
+        response, content_type, content_length = await open_upstream(url, parsed)
+    except HTTPException as e:
+        singleflight.resolve(cache_key, flight, error=e)
+        raise
+    except BaseException:
+        singleflight.resolve(cache_key, flight)
+        raise
+    
+    chunks: List[bytes] = []
+    received = 0
+    async for chunk in stream_upstream(response, cache_key, content_type, content_length, flight,
+                                       committed=False):
+        received += len(chunk)
+        if keep_body:
+            chunks.append(chunk)
+    
+    entry = await lookup_fresh(cache_key)
+    if entry is not None:
+        return entry, 'MISS'
+    body = b''.join(chunks) if keep_body else None
+    return CachedObject(
+        body, None, content_type, received,
+        content_etag(hashlib.sha256(body).hexdigest()) if body is not None else '',
+        None, None, time.time()
+    ), 'MISS'
+
+
+async def store_on_disk(cache_key: str, body: bytes, content_type: str):
+    """Guarda un cuerpo ya completo en el caché en disco (errores solo se registran)"""
+    writer = open_disk_writer()
+    if writer is None:
+        return
+    try:
+        await writer.write(body)
+        await writer.commit(cache_key, content_type, None, None)
+    except (OSError, sqlite3.Error) as e:
+        print(f"[DiskCache] Error guardando variante: {e}")
+        writer.abort()
+
+
+def open_disk_writer() -> Optional[DiskWriter]:
+    """Temporal para copiar el cuerpo al caché en disco; None si no hay disco disponible"""
+    if disk_cache is None:
+        return None
+    try:
+        return disk_cache.open_writer()
+    except (OSError, sqlite3.Error) as e:
+        print(f"[DiskCache] No disponible: {e}")
+        return None
+
+
+async def stream_upstream(response: httpx.Response, cache_key: str, content_type: str,
+                          content_length: Optional[int], flight: Optional[asyncio.Future] = None,
+                          cacheable: bool = True, body: Optional[AsyncIterator[bytes]] = None,
+                          committed: bool = True):
+    """
+    Reenvía el cuerpo del origen bloque a bloque (body, si read_head ya
+    leyó el principio).
+    
+    Si el total supera MAX_FILE_SIZE (solo sin Content-Length y más allá de
+    STREAM_PREBUFFER_SIZE) se deja de leer y no se cachea nada. Con las
+    cabeceras ya enviadas (committed) la respuesta termina ahí con una
+    línea en el log; si no, se lanza un 413.
+    Mientras el objeto quepa en CACHE_MAX_OBJECT_SIZE los bloques se guardan
+    para cachearlo al terminar y entregarlo a las peticiones agrupadas.
+    Todo cuerpo completo se copia además al caché en disco; las respuestas
+    parciales (cacheable=False) solo se reenvían.
+    """
+    received = 0
+    chunks: Optional[List[bytes]] = []
+    if not cacheable or (content_length is not None and content_length > config.CACHE_MAX_OBJECT_SIZE):
+        chunks = None
+    writer = open_disk_writer() if cacheable else None
+    started = time.perf_counter()
+    
+    try:
+        async for chunk in body or response.aiter_bytes(config.STREAM_CHUNK_SIZE):
+            received += len(chunk)
+            if received > config.MAX_FILE_SIZE:
+                if not committed:
+                    raise_too_large()
+                print(f"[MediaProxy] {response.url.host}: más de {config.MAX_FILE_SIZE} bytes "
+                      f"sin Content-Length; respuesta cortada")
+                return
+            if chunks is not None:
+                if received <= config.CACHE_MAX_OBJECT_SIZE:
+                    chunks.append(chunk)
+                else:
+                    chunks = None
+            if writer is not None:
+                try:
+                    await writer.write(chunk)
+                except OSError as e:
+                    print(f"[DiskCache] Error escribiendo: {e}")
+                    writer.abort()
+                    writer = None
+            yield chunk
+        upstream_etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if chunks is not None:
+            entry = cache.set(cache_key, b''.join(chunks), content_type, upstream_etag, last_modified)
+            chunks = None
+            if entry is not None:
+                singleflight.resolve(cache_key, flight, entry)
+        if writer is not None:
+            try:
+                await writer.commit(cache_key, content_type, upstream_etag, last_modified)
+            except (OSError, sqlite3.Error) as e:
+                print(f"[DiskCache] Error publicando objeto: {e}")
+                writer.abort()
+            writer = None
+    finally:
+        observe_stage('upstream_download', started)
+        if writer is not None:
+            writer.abort()
+        if body is not None:
+            await body.aclose()
+        await response.aclose()
+        # Abortado o sin cachear: las peticiones agrupadas hacen su propio fetch
+        singleflight.resolve(cache_key, flight)
+
+
+batch_semaphore = asyncio.Semaphore(config.BATCH_CONCURRENCY)
+batch_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+@app.post("/api/media-proxy/batch")
+async def media_proxy_batch(body: dict, request: Request):
+    """
+    Precarga una lista de URLs en el caché y devuelve el estado de cada una
+    
+    Body:
+        {"urls": ["https://i.imgur.com/a.jpg", ...], "thumbnails": false}
+    
+    Con "thumbnails": true se incluyen miniaturas pequeñas como data URI.
+    
+    Ejemplo:
+        curl -X POST http://localhost:8000/api/media-proxy/batch \
+          -H "Content-Type: application/json" \
+          -d '{"urls": ["https://i.imgur.com/abc123.jpg"], "thumbnails": true}'
+    """
+    urls = body.get('urls')
+    if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls):
+        raise HTTPException(status_code=400, detail="Campo 'urls' (lista de strings) requerido")
+    urls = list(dict.fromkeys(urls))
+    if len(urls) > config.BATCH_MAX_URLS:
         raise HTTPException(
             status_code=413,
-            detail=f"Archivo muy grande (máx {config.MAX_FILE_SIZE / 1024 / 1024}MB)"
+            detail=f"Demasiadas URLs (máx {config.BATCH_MAX_URLS})"
+        )
+    
+    thumbnail_spec = None
+    if body.get('thumbnails'):
+        size = config.BATCH_THUMBNAIL_SIZE
+        thumbnail_spec = build_transform_spec(
+            size, size, 'cover', None, None, request.headers.get('accept', '')
         )
     
-    # 10. Guardar en caché
-    cache.set(cache_key, content, content_type)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(warm_url(url, thumbnail_spec) for url in urls))
     
-    # 11. Responder
-    return Response(
-        content=content,
-        media_type=content_type,
-        headers={
-            'Cache-Control': f'public, max-age={config.CACHE_MAX_AGE}',
-            'X-Cache': 'MISS',
-            'Access-Control-Allow-Origin': '*',
-            'X-Content-Type-Options': 'nosniff'
+    summary: Dict[str, int] = {}
+    for result in results:
+        key = result.get('cache') or 'ERROR'
+        summary[key] = summary.get(key, 0) + 1
+    
+    return JSONResponse({
+        'success': True,
+        'data': {
+            'results': results,
+            'summary': summary,
+            'elapsedMs': round((time.perf_counter() - started) * 1000, 1)
         }
-    )
+    })
+
+
+async def warm_url(url: str, thumbnail_spec: Optional[TransformSpec]) -> Dict:
+    """Valida y cachea una URL del lote; los errores se reportan, no se lanzan"""
+    result: Dict = {'url': url, 'proxyUrl': f'/api/media-proxy?url={quote(url, safe="")}'}
+    try:
+        parsed = await validate_media_url(url)
+        cache_key = hashlib.md5(url.encode()).hexdigest()
+        host = parsed.hostname or parsed.netloc
+        host_semaphore = batch_host_semaphores.setdefault(
+            host, asyncio.Semaphore(config.BATCH_PER_HOST)
+        )
+        async with batch_semaphore, host_semaphore:
+            entry, cache_status = await load_original(url, parsed, cache_key, keep_body=False)
+            result.update({
+                'status': 200,
+                'cache': cache_status,
+                'size': entry.size,
+                'contentType': entry.content_type,
+                'etag': entry.etag or None,
+            })
+            if thumbnail_spec is not None:
+                result['thumbnail'] = await inline_thumbnail(url, parsed, cache_key, thumbnail_spec)
+    except HTTPException as e:
+        result.update({'status': e.status_code, 'error': e.detail})
+    except Exception as e:
+        result.update({'status': 502, 'error': str(e)})
+    return result
+
+
+async def inline_thumbnail(url: str, parsed, cache_key: str, spec: TransformSpec) -> Optional[str]:
+    """Miniatura como data URI si es una imagen transformable y cabe en BATCH_INLINE_MAX_BYTES"""
+    try:
+        variant, cache_status = await load_variant(url, parsed, cache_key, spec)
+    except HTTPException:
+        return None
+    if cache_status == 'BYPASS' or variant.size > config.BATCH_INLINE_MAX_BYTES:
+        return None
+    content = variant.content
+    if content is None:
+        content = await run_in_threadpool(variant.path.read_bytes)
+    return f'data:{variant.content_type};base64,{base64.b64encode(content).decode()}'
 
 
 @app.post("/api/validate-iframe")
@@ -509,16 +2789,37 @@ async def health():
     }
 
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Métricas en formato de exposición de Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
 @app.get("/api/media-proxy/stats")
 async def stats():
     """Estadísticas del proxy"""
     return {
         "cache_size": cache.size(),
-        "max_cache_size": 100,
-        "allowed_domains_count": len(config.ALLOWED_DOMAINS),
+        "cache_bytes": cache.size_bytes(),
+        "max_cache_bytes": config.CACHE_MAX_BYTES,
+        "cache": cache.stats(),
+        "allowed_domains_count": len(whitelist.domains),
+        "whitelist_source": whitelist.source,
         "max_file_size_mb": config.MAX_FILE_SIZE / 1024 / 1024,
         "cache_max_age_days": config.CACHE_MAX_AGE / 86400,
-        "timeout_seconds": config.TIMEOUT
+        "timeout_seconds": config.TIMEOUT,
+        "http2": config.HTTP2 and HTTP2_AVAILABLE,
+        "upstream": upstream_metrics.snapshot(),
+        "pool": pool_connections_by_host(),
+        "singleflight": singleflight.stats(),
+        "disk_cache": disk_cache.stats() if disk_cache is not None else None,
+        "revalidation": {**revalidation_stats, "in_flight": len(revalidation_tasks)},
+        "dns": dns_resolver.stats(),
+        "transform": {
+            "available": PIL_AVAILABLE,
+            "formats": [name for name in OUTPUT_FORMATS if output_format_available(name)],
+            **transform_stats
+        }
     }
 
 
@@ -528,17 +2829,43 @@ async def stats():
 
 @app.on_event("startup")
 async def startup_event():
-    """Inicia tarea de limpieza de caché"""
+    """Crea el cliente HTTP compartido, carga la whitelist e inicia las tareas periódicas"""
+    get_http_client()
+    reload_whitelist(force=True)
+    
+    async def watch_whitelist():
+        while True:
+            await asyncio.sleep(config.WHITELIST_RELOAD_INTERVAL)
+            reload_whitelist()
+    
+    if config.WHITELIST_FILE:
+        asyncio.create_task(watch_whitelist())
     
     async def cleanup_cache():
         while True:
             await asyncio.sleep(3600)  # Cada hora
             cache.clear_expired()
+            dns_resolver.clear_expired()
+            if disk_cache is not None:
+                await run_in_threadpool(disk_cache.clear_expired)
             print(f"[Cache] Limpieza completada. Tamaño: {cache.size()}")
     
     asyncio.create_task(cleanup_cache())
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Cierra las conexiones del cliente HTTP compartido y el índice del caché en disco"""
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+    if disk_cache is not None:
+        disk_cache.close()
+    if transform_pool is not None:
+        transform_pool.shutdown(wait=False, cancel_futures=True)
+
+
 # ============================================================================
 # EJECUCIÓN
 # ============================================================================
@@ -557,7 +2884,9 @@ if __name__ == "__main__":
     ║  Endpoints:                                                   ║
     ║  - GET  /api/media-proxy?url=<URL>                           ║
     ║  - POST /api/validate-iframe (body: {"url": "..."})          ║
+    ║  - POST /api/media-proxy/batch (body: {"urls": [...]})       ║
     ║  - GET  /api/media-proxy/stats                               ║
+    ║  - GET  /metrics (Prometheus)                                 ║
     ╚═══════════════════════════════════════════════════════════════╝
     """)
     
@@ -0,0 +1,14 @@
+-- CreateTable
+CREATE TABLE "subdivision_source_files" (
+    "path" TEXT NOT NULL,
+    "country_iso" TEXT NOT NULL,
+    "size" INTEGER NOT NULL,
+    "mtime_ns" BIGINT NOT NULL,
+    "content_hash" TEXT NOT NULL,
+    "synced_at" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "subdivision_source_files_pkey" PRIMARY KEY ("path")
+);
+
+-- CreateIndex
+CREATE INDEX "subdivision_source_files_country_iso_idx" ON "subdivision_source_files"("country_iso");
@@ -0,0 +1,17 @@
+-- AlterTable
+ALTER TABLE "subdivisions" ADD COLUMN     "area_km2" DOUBLE PRECISION,
+ADD COLUMN     "is_lowest_level" BOOLEAN NOT NULL DEFAULT false,
+ADD COLUMN     "max_latitude" DOUBLE PRECISION,
+ADD COLUMN     "max_longitude" DOUBLE PRECISION,
+ADD COLUMN     "min_latitude" DOUBLE PRECISION,
+ADD COLUMN     "min_longitude" DOUBLE PRECISION,
+ADD COLUMN     "parent_subdivision_id" TEXT;
+
+-- CreateIndex
+CREATE INDEX "subdivisions_bbox_idx" ON "subdivisions"("min_latitude", "max_latitude", "min_longitude", "max_longitude");
+
+-- CreateIndex
+CREATE INDEX "subdivisions_is_lowest_level_bbox_idx" ON "subdivisions"("is_lowest_level", "min_latitude", "max_latitude", "min_longitude", "max_longitude");
+
+-- CreateIndex
+CREATE INDEX "subdivisions_parent_subdivision_id_idx" ON "subdivisions"("parent_subdivision_id");
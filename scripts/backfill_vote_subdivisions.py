@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Rellena votes.subdivision_id a partir de latitude/longitude
+
+Recorre los votos por páginas de id (keyset: WHERE id > último ORDER BY id),
+localiza cada bloque de puntos con el índice espacial de subdivision_index.py
+(filtro por bbox y test de punto en polígono vectorizados) en un pool de
+procesos y escribe los resultados con UPDATE por lotes (executemany).
+
+Cada bloque se escribe en la misma transacción que su checkpoint
+(tabla vote_backfill_checkpoints), así que si el proceso se interrumpe la
+siguiente ejecución continúa desde el último bloque confirmado.
+
+Los votos fuera de cualquier subdivisión (mar, países sin geometría) se
+dejan en NULL. Si la subdivisión más específica no está en la tabla
+subdivisions se usa su antecesor más cercano que sí esté (ESP.1.2 -> ESP.1).
+
+Requisitos:
+    pip install numpy
+    python scripts/subdivision_index.py build   # o populate_subdivisions.py --build-index
+
+Uso:
+    python scripts/backfill_vote_subdivisions.py                  # Solo votos sin subdivisión
+    python scripts/backfill_vote_subdivisions.py --jobs 8 --chunk-size 250000
+    python scripts/backfill_vote_subdivisions.py --all            # Recalcula todos los votos
+    python scripts/backfill_vote_subdivisions.py --restart        # Ignora el checkpoint
+    python scripts/backfill_vote_subdivisions.py --dry-run        # Localiza pero no escribe
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Deque, Dict, Optional, Tuple
+
+import numpy as np
+
+from populate_subdivisions import DB_PATH, bulk_load_pragmas, get_db_connection
+from subdivision_index import INDEX_PATH, SubdivisionIndex
+
+DEFAULT_CHUNK_SIZE = 200_000
+
+# Bloques en vuelo por proceso: mientras se escribe uno ya se localizan los siguientes
+CHUNKS_IN_FLIGHT_PER_JOB = 2
+
+# A diferencia de la carga de subdivisiones, el journal se mantiene en disco:
+# si el proceso muere a mitad de un bloque, su transacción (con el checkpoint)
+# se deshace entera y la reanudación parte de un estado consistente
+BACKFILL_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': '-262144',  # 256 MB
+}
+
+CREATE_CHECKPOINT_SQL = """
+    CREATE TABLE IF NOT EXISTS "vote_backfill_checkpoints" (
+        "job" TEXT NOT NULL PRIMARY KEY,
+        "last_vote_id" INTEGER NOT NULL,
+        "processed" INTEGER NOT NULL,
+        "updated" INTEGER NOT NULL,
+        "unmatched" INTEGER NOT NULL,
+        "updated_at" DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+UPDATE_VOTE_SQL = "UPDATE votes SET subdivision_id = ? WHERE id = ?"
+
+
+# ============================================================================
+# LOCALIZACIÓN (PROCESOS DEL POOL)
+# ============================================================================
+
+_worker_index: Optional[SubdivisionIndex] = None
+
+
+def _init_worker(index_path: Path):
+    """Cada proceso carga el índice una sola vez"""
+    global _worker_index
+    _worker_index = SubdivisionIndex.load(index_path)
+
+
+def _locate_chunk(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Posición en index.ids de la subdivisión de cada punto (-1 si ninguna)"""
+    return _worker_index.locate_indices(lats, lons).astype(np.int32)
+
+
+# ============================================================================
+# BASE DE DATOS
+# ============================================================================
+
+def subdivision_row_ids(conn, index: SubdivisionIndex) -> np.ndarray:
+    """
+    subdivisions.id para cada geometría del índice (alineado con index.ids),
+    subiendo por la jerarquía de ids si la geometría no está en la tabla.
+    -1 si ni ella ni ningún antecesor existen
+    """
+    known = dict(conn.execute("SELECT subdivision_id, id FROM subdivisions"))
+    result = np.full(len(index.ids), -1, dtype=np.int64)
+    for position, subdivision_id in enumerate(index.ids.tolist()):
+        while subdivision_id:
+            if subdivision_id in known:
+                result[position] = known[subdivision_id]
+                break
+            subdivision_id = subdivision_id.rpartition('.')[0]
+    return result
+
+
+def job_name(all_votes: bool) -> str:
+    return 'all' if all_votes else 'null-only'
+
+
+def load_checkpoint(conn, job: str) -> Dict[str, int]:
+    empty = {'last_vote_id': 0, 'processed': 0, 'updated': 0, 'unmatched': 0}
+    try:
+        row = conn.execute("""
+            SELECT last_vote_id, processed, updated, unmatched
+            FROM vote_backfill_checkpoints WHERE job = ?
+        """, (job,)).fetchone()
+    except sqlite3.OperationalError:
+        # --dry-run sobre una BD que aún no tiene la tabla: se empieza de cero
+        return empty
+    return dict(row) if row else empty
+
+
+def save_checkpoint(conn, job: str, state: Dict[str, int]):
+    """Sin commit: va en la transacción del bloque"""
+    conn.execute("""
+        INSERT INTO vote_backfill_checkpoints (job, last_vote_id, processed, updated, unmatched, updated_at)
+        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(job) DO UPDATE SET
+            last_vote_id = excluded.last_vote_id,
+            processed = excluded.processed,
+            updated = excluded.updated,
+            unmatched = excluded.unmatched,
+            updated_at = excluded.updated_at
+    """, (job, state['last_vote_id'], state['processed'], state['updated'], state['unmatched']))
+
+
+def pending_updates(row_ids: np.ndarray, current: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Máscara de los votos a actualizar: los localizados y, con `current`
+    (modo --all), solo los que cambian de subdivisión
+    """
+    found = row_ids >= 0
+    if current is not None:
+        found &= row_ids != current
+    return found
+
+
+def write_chunk(conn, ids: np.ndarray, row_ids: np.ndarray):
+    """UPDATE por lotes de votes.subdivision_id (sin commit)"""
+    conn.executemany(UPDATE_VOTE_SQL, zip(row_ids.tolist(), ids.tolist()))
+
+
+# ============================================================================
+# BACKFILL
+# ============================================================================
+
+def backfill(conn, index: SubdivisionIndex, index_path: Path, jobs: int, chunk_size: int,
+             all_votes: bool = False, restart: bool = False, dry_run: bool = False,
+             limit: Optional[int] = None) -> Dict[str, int]:
+    """
+    Recorre los votos y asigna subdivision_id. Retorna los contadores finales
+    {'last_vote_id', 'processed', 'updated', 'unmatched'} de este trabajo
+    """
+    job = job_name(all_votes)
+    if not dry_run:
+        conn.executescript(CREATE_CHECKPOINT_SQL)
+    state = {'last_vote_id': 0, 'processed': 0, 'updated': 0, 'unmatched': 0}
+    if not restart:
+        state = load_checkpoint(conn, job)
+        if state['last_vote_id']:
+            print(f"   ↩️  Reanudando desde el voto {state['last_vote_id']} "
+                  f"({state['processed']} ya procesados)")
+
+    row_ids = subdivision_row_ids(conn, index)
+    missing = int((row_ids < 0).sum())
+    if missing:
+        print(f"   ⚠️  {missing} geometrías del índice sin fila en subdivisions (ni antecesor)")
+
+    # Con --all hace falta el valor actual para no reescribir lo que no cambia
+    columns = "id, latitude, longitude" + (", COALESCE(subdivision_id, -1)" if all_votes else "")
+    start = time.perf_counter()
+    session = {'processed': 0, 'updated': 0}
+    read_after = state['last_vote_id']
+    in_flight: Deque[Tuple[np.ndarray, Future]] = deque()
+
+    # Tuplas en vez de sqlite3.Row: NumPy las convierte directamente
+    reader = conn.cursor()
+    reader.row_factory = None
+
+    def read_next() -> Optional[np.ndarray]:
+        nonlocal read_after
+        if limit is not None and session['processed'] + sum(len(c) for c, _ in in_flight) >= limit:
+            return None
+        rows = reader.execute(f"""
+            SELECT {columns} FROM votes
+            WHERE id > ? {"" if all_votes else "AND subdivision_id IS NULL"}
+            ORDER BY id
+            LIMIT ?
+        """, (read_after, chunk_size)).fetchall()
+        if not rows:
+            return None
+        chunk = np.array(rows, dtype=np.float64)
+        read_after = int(chunk[-1, 0])
+        return chunk
+
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                   initargs=(index_path,)) if jobs > 1 else None
+
+    def submit(chunk: np.ndarray) -> Future:
+        if executor is not None:
+            return executor.submit(_locate_chunk, chunk[:, 1], chunk[:, 2])
+        future = Future()
+        future.set_result(index.locate_indices(chunk[:, 1], chunk[:, 2]).astype(np.int32))
+        return future
+
+    try:
+        with bulk_load_pragmas(conn, BACKFILL_PRAGMAS):
+            while True:
+                while len(in_flight) < max(1, jobs * CHUNKS_IN_FLIGHT_PER_JOB):
+                    chunk = read_next()
+                    if chunk is None:
+                        break
+                    in_flight.append((chunk, submit(chunk)))
+                if not in_flight:
+                    break
+
+                # Se escriben en orden de id para que el checkpoint sea monótono
+                chunk, future = in_flight.popleft()
+                features = future.result()
+                ids = chunk[:, 0].astype(np.int64)
+                located = np.where(features >= 0, row_ids[np.maximum(features, 0)], -1)
+                current = chunk[:, 3].astype(np.int64) if all_votes else None
+
+                pending = pending_updates(located, current)
+                updated = int(pending.sum())
+                state['last_vote_id'] = int(ids[-1])
+                state['processed'] += len(ids)
+                state['updated'] += updated
+                state['unmatched'] += int((located < 0).sum())
+                session['processed'] += len(ids)
+                session['updated'] += updated
+
+                # En dry-run solo se cuenta: ni UPDATE ni checkpoint, así no se
+                # toma el bloqueo de escritura de la BD
+                if not dry_run:
+                    write_chunk(conn, ids[pending], located[pending])
+                    save_checkpoint(conn, job, state)
+                    conn.commit()
+
+                elapsed = time.perf_counter() - start
+                print(f"   ✅ Hasta el voto {state['last_vote_id']}: {session['processed']} procesados, "
+                      f"{session['updated']} actualizados ({session['processed'] / elapsed * 60:,.0f} votos/min)")
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    state['seconds'] = time.perf_counter() - start
+    state['session_processed'] = session['processed']
+    return state
+
+
+def parse_args():
+    """Argumentos de línea de comandos"""
+    parser = argparse.ArgumentParser(description="Rellena votes.subdivision_id desde latitude/longitude")
+    parser.add_argument('--db', type=Path, default=DB_PATH,
+                        help=f"Base de datos SQLite (por defecto {DB_PATH})")
+    parser.add_argument('--index', type=Path, default=INDEX_PATH,
+                        help=f"Índice espacial (por defecto {INDEX_PATH})")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="Procesos que localizan bloques en paralelo (por defecto, uno por CPU)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"Votos por bloque leído y escrito (por defecto {DEFAULT_CHUNK_SIZE})")
+    parser.add_argument('--all', action='store_true',
+                        help="Recalcula todos los votos, no solo los que no tienen subdivisión")
+    parser.add_argument('--restart', action='store_true',
+                        help="Empieza desde el principio ignorando el checkpoint")
+    parser.add_argument('--limit', type=int,
+                        help="Detiene el trabajo tras (aprox.) este número de votos; se reanuda después")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Localiza los votos pero no escribe nada (ni el checkpoint)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    print("\n🗳️  BACKFILL DE SUBDIVISIONES DE VOTOS")
+    print("="*60)
+    print(f"💾 Base de datos: {args.db}")
+    print(f"🗺️  Índice: {args.index}")
+    if args.dry_run:
+        print("🧪 Modo dry-run: no se escribirá nada en la base de datos")
+    print("="*60)
+
+    try:
+        conn = get_db_connection(args.db)
+        index = SubdivisionIndex.load(args.index)
+    except FileNotFoundError as e:
+        print(f"\n❌ ERROR: {e}")
+        sys.exit(1)
+
+    try:
+        state = backfill(conn, index, args.index, max(1, args.jobs), args.chunk_size,
+                         args.all, args.restart, args.dry_run, args.limit)
+    except sqlite3.Error as e:
+        print(f"\n❌ Error de base de datos: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    rate = state['session_processed'] / state['seconds'] * 60 if state['seconds'] else 0
+    print("\n" + "="*60)
+    print("✅ BACKFILL COMPLETADO" + (" (dry-run, sin cambios en la BD)" if args.dry_run else ""))
+    print("="*60)
+    print(f"   {state['session_processed']} votos en {state['seconds']:.1f}s ({rate:,.0f} votos/min)")
+    print(f"   Total del trabajo: {state['processed']} procesados, {state['updated']} actualizados, "
+          f"{state['unmatched']} fuera de cualquier subdivisión")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""
+Genera variantes simplificadas por zoom de los TopoJSON de static/geojson
+
+Para cada archivo decodifica los arcos, calcula una sola vez el peso de
+Visvalingam de cada punto (área efectiva en grados Mercator²) y escribe una
+variante por zoom conservando los puntos cuyo peso supera el umbral de ese
+zoom. La simplificación se hace sobre los arcos compartidos, así que las
+fronteras entre subdivisiones vecinas se simplifican igual en ambos lados y
+la topología se conserva. Los extremos de cada arco nunca se eliminan.
+
+Salida (static/geojson-tiles/):
+- z{ZOOM}/{PAÍS}/{archivo}.topojson   variante simplificada
+- manifest.json                       hash de origen y bytes/puntos por variante
+
+Los anillos que tras simplificar y pasar a la rejilla del zoom quedan con
+menos de 3 vértices distintos o área nula se eliminan (con ellos el polígono
+si es el exterior); una geometría sin polígonos queda con type null.
+
+El front puede leer manifest.json y pedir la variante más ligera cuyo zoom
+sea >= al zoom actual, o el original de static/geojson si no hay ninguna.
+
+Requisitos:
+    pip install numpy
+
+Uso:
+    python scripts/build_geometry_tiles.py                  # Todos los países, incremental
+    python scripts/build_geometry_tiles.py --countries ESP,FRA --jobs 4
+    python scripts/build_geometry_tiles.py --zooms 2,4,6,8 --tolerance 0.5
+    python scripts/build_geometry_tiles.py --force          # Regenera aunque no haya cambios
+"""
+
+import argparse
+import heapq
+import json
+import math
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from populate_subdivisions import BASE_DIR, GEOJSON_DIR, file_hash
+from topojson_decoder import decode_arcs
+
+TILES_DIR = BASE_DIR / "static" / "geojson-tiles"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 2  # 2: sin anillos degenerados (dropped_rings)
+
+DEFAULT_ZOOMS = (2, 4, 6, 8)
+DEFAULT_TOLERANCE_PX = 1.0
+
+# Grados de longitud que ocupa un píxel a zoom 0 con teselas de 256 px
+DEGREES_PER_PIXEL_Z0 = 360.0 / 256
+
+# Límite de latitud de Web Mercator
+MAX_LATITUDE = 85.05112878
+
+
+# ============================================================================
+# SIMPLIFICACIÓN (VISVALINGAM-WHYATT)
+# ============================================================================
+
+def mercator(coords: np.ndarray) -> np.ndarray:
+    """lon/lat -> x/y Mercator en grados, para medir áreas como se ven en el mapa"""
+    lat = np.radians(np.clip(coords[:, 1], -MAX_LATITUDE, MAX_LATITUDE))
+    y = np.degrees(np.log(np.tan(np.pi / 4 + lat / 2)))
+    return np.column_stack((coords[:, 0], y))
+
+
+def triangle_area(xs: List[float], ys: List[float], a: int, b: int, c: int) -> float:
+    return abs((xs[b] - xs[a]) * (ys[c] - ys[a]) - (xs[c] - xs[a]) * (ys[b] - ys[a])) / 2
+
+
+def visvalingam_weights(points: np.ndarray) -> np.ndarray:
+    """
+    Área efectiva de cada punto de un arco: el área del triángulo que formaba
+    con sus vecinos cuando Visvalingam lo eliminó, forzada a ser monótona
+    (un punto nunca pesa menos que otro eliminado antes). Los extremos pesan inf
+    """
+    n = len(points)
+    weights = np.full(n, np.inf)
+    if n < 3:
+        return weights
+
+    xs = points[:, 0].tolist()
+    ys = points[:, 1].tolist()
+    prev = list(range(-1, n - 1))
+    nxt = list(range(1, n + 1))
+    current = [0.0] * n
+    removed = [False] * n
+
+    heap = []
+    for i in range(1, n - 1):
+        current[i] = triangle_area(xs, ys, i - 1, i, i + 1)
+        heap.append((current[i], i))
+    heapq.heapify(heap)
+
+    max_area = 0.0
+    while heap:
+        area, i = heapq.heappop(heap)
+        if removed[i] or area != current[i]:
+            continue  # Entrada obsoleta: el área se recalculó después
+        max_area = max(max_area, area)
+        weights[i] = max_area
+        removed[i] = True
+
+        p, q = prev[i], nxt[i]
+        nxt[p], prev[q] = q, p
+        if p > 0:
+            current[p] = triangle_area(xs, ys, prev[p], p, q)
+            heapq.heappush(heap, (current[p], p))
+        if q < n - 1:
+            current[q] = triangle_area(xs, ys, p, q, nxt[q])
+            heapq.heappush(heap, (current[q], q))
+
+    # Un arco cerrado es un anillo entero: se conservan siempre los dos
+    # puntos interiores más importantes para que no degenere en una línea
+    if n > 3 and points[0, 0] == points[-1, 0] and points[0, 1] == points[-1, 1]:
+        weights[np.argsort(weights[1:-1])[-2:] + 1] = np.inf
+    return weights
+
+
+def arc_weights(coords: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Pesos de todos los puntos, arco a arco, alineados con coords"""
+    projected = mercator(coords)
+    weights = np.empty(len(coords))
+    for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        weights[start:end] = visvalingam_weights(projected[start:end])
+    return weights
+
+
+def zoom_pixel(zoom: int) -> float:
+    """Grados de longitud por píxel a ese zoom"""
+    return DEGREES_PER_PIXEL_Z0 / (2 ** zoom)
+
+
+def zoom_min_area(zoom: int, tolerance_px: float) -> float:
+    """Área mínima (grados Mercator²) de un punto para sobrevivir a ese zoom"""
+    return (tolerance_px * zoom_pixel(zoom)) ** 2
+
+
+# ============================================================================
+# CODIFICACIÓN DE VARIANTES
+# ============================================================================
+
+def coarsen_transform(transform: Dict, zoom: int) -> Tuple[Dict, np.ndarray]:
+    """
+    Rejilla de cuantización más gruesa para zooms bajos: múltiplo entero de la
+    original con paso <= 1/10 de píxel. Al ser un múltiplo, los extremos
+    compartidos entre arcos siguen cayendo en la misma posición
+    """
+    scale = np.asarray(transform['scale'], dtype=np.float64)
+    factor = np.maximum(1, np.floor(zoom_pixel(zoom) / 10 / scale)).astype(np.int64)
+    return {**transform, 'scale': (scale * factor).tolist()}, factor
+
+
+def encode_arcs(coords: np.ndarray, offsets: np.ndarray, keep: np.ndarray,
+                transform: Optional[Dict], zoom: int) -> Tuple[List[list], Optional[Dict], List[np.ndarray]]:
+    """
+    Arcos con solo los puntos conservados. Con transform se recuperan las
+    posiciones cuantizadas exactas, se pasan a la rejilla del zoom y se
+    vuelven a codificar en delta; sin transform se redondean las coordenadas
+    a la precisión del zoom. En ambos casos sin puntos repetidos consecutivos.
+    Retorna (arcos, transform de la variante, posiciones absolutas de cada arco)
+    """
+    if transform:
+        scale = np.asarray(transform['scale'], dtype=np.float64)
+        translate = np.asarray(transform['translate'], dtype=np.float64)
+        transform, factor = coarsen_transform(transform, zoom)
+        values = np.rint(np.rint((coords - translate) / scale) / factor).astype(np.int64)
+    else:
+        values = np.round(coords, zoom_decimals(zoom))
+
+    arcs, positions = [], []
+    for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        arc = values[start:end][keep[start:end]]
+        if len(arc) > 1:
+            moved = np.diff(arc, axis=0).any(axis=1)
+            moved[-1] = True  # El extremo final se conserva siempre
+            arc = np.concatenate((arc[:1], arc[1:][moved]))
+        positions.append(arc)
+        if transform and len(arc) > 1:
+            arc = np.concatenate((arc[:1], np.diff(arc, axis=0)))
+        arcs.append(arc.tolist())
+    return arcs, transform, positions
+
+
+# ============================================================================
+# ANILLOS DEGENERADOS
+# ============================================================================
+
+def ring_positions(ring: List[int], positions: List[np.ndarray]) -> np.ndarray:
+    """Posiciones de un anillo (lista de índices de arco; ~i = arco i invertido)"""
+    parts = []
+    for i, index in enumerate(ring):
+        arc = positions[~index][::-1] if index < 0 else positions[index]
+        parts.append(arc if i == 0 else arc[1:])  # Los arcos comparten extremos
+    return np.concatenate(parts) if parts else np.empty((0, 2))
+
+
+def is_degenerate_ring(ring: List[int], positions: List[np.ndarray]) -> bool:
+    """
+    Anillo que tras simplificar y pasar a la rejilla del zoom ya no encierra
+    nada: menos de 3 vértices distintos o área nula (todos alineados)
+    """
+    points = ring_positions(ring, positions).astype(np.float64)
+    if len(np.unique(points, axis=0)) < 3:
+        return True
+    x, y = points[:, 0], points[:, 1]
+    return np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y) == 0
+
+
+def prune_polygon(polygon: List[List[int]], positions: List[np.ndarray]) -> Tuple[Optional[list], int]:
+    """Sin el anillo exterior el polígono entero sobra; los huecos degenerados se quitan"""
+    if not polygon or is_degenerate_ring(polygon[0], positions):
+        return None, len(polygon)
+    holes = [ring for ring in polygon[1:] if not is_degenerate_ring(ring, positions)]
+    return [polygon[0]] + holes, len(polygon) - 1 - len(holes)
+
+
+def prune_geometry(geometry: Dict, positions: List[np.ndarray]) -> Tuple[Dict, int]:
+    """
+    Copia de la geometría sin anillos degenerados. Si no queda ningún polígono
+    pasa a type null (se conservan id y properties).
+    Retorna (geometría, anillos eliminados)
+    """
+    geom_type = geometry.get('type')
+    if geom_type == 'GeometryCollection':
+        results = [prune_geometry(g, positions) for g in geometry.get('geometries', [])]
+        return {**geometry, 'geometries': [g for g, _ in results]}, sum(n for _, n in results)
+    if geom_type == 'Polygon':
+        polygons = [geometry.get('arcs', [])]
+    elif geom_type == 'MultiPolygon':
+        polygons = geometry.get('arcs', [])
+    else:
+        return geometry, 0
+
+    kept, dropped = [], 0
+    for polygon in polygons:
+        pruned, removed = prune_polygon(polygon, positions)
+        dropped += removed
+        if pruned:
+            kept.append(pruned)
+    if not dropped:
+        return geometry, 0
+
+    pruned = {k: v for k, v in geometry.items() if k != 'arcs'}
+    if not kept:
+        pruned['type'] = None
+    elif geom_type == 'Polygon':
+        pruned['arcs'] = kept[0]
+    else:
+        pruned['arcs'] = kept
+    return pruned, dropped
+
+
+def prune_objects(objects: Dict, positions: List[np.ndarray]) -> Tuple[Dict, int]:
+    """objects de la topología sin anillos degenerados. Retorna (objects, anillos eliminados)"""
+    pruned, dropped = {}, 0
+    for name, geometry in objects.items():
+        pruned[name], removed = prune_geometry(geometry, positions)
+        dropped += removed
+    return pruned, dropped
+
+
+def zoom_decimals(zoom: int) -> int:
+    """Decimales suficientes para una décima de píxel (archivos sin cuantizar)"""
+    return min(7, max(1, math.ceil(-math.log10(zoom_pixel(zoom) / 10))))
+
+
+def write_atomic(path: Path, payload: bytes):
+    """Escribe en un temporal y lo renombra: nunca queda un archivo a medias"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(payload)
+    os.replace(tmp, path)
+
+
+def variant_path(rel_path: str, zoom: int) -> str:
+    return f"z{zoom}/{rel_path}"
+
+
+def build_file(path: Path, rel_path: str, content_hash: str, zooms: List[int],
+               tolerance_px: float, tiles_dir: Path) -> Dict:
+    """Genera todas las variantes de un archivo y devuelve su entrada del manifest"""
+    with open(path, 'r', encoding='utf-8') as f:
+        topology = json.load(f)
+
+    arcs = topology.get('arcs') or []
+    transform = topology.get('transform')
+    coords, offsets = decode_arcs(arcs, transform)
+    weights = arc_weights(coords, offsets)
+
+    entry = {
+        'hash': content_hash,
+        'source_bytes': path.stat().st_size,
+        'points': len(coords),
+        'variants': {},
+    }
+    for zoom in zooms:
+        keep = weights >= zoom_min_area(zoom, tolerance_px)
+        variant = dict(topology)
+        variant['arcs'], variant_transform, positions = encode_arcs(coords, offsets, keep, transform, zoom)
+        if variant_transform:
+            variant['transform'] = variant_transform
+        variant['objects'], dropped_rings = prune_objects(topology.get('objects', {}), positions)
+        payload = json.dumps(variant, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+        out = variant_path(rel_path, zoom)
+        write_atomic(tiles_dir / out, payload)
+        entry['variants'][str(zoom)] = {
+            'path': out,
+            'bytes': len(payload),
+            'points': int(keep.sum()),
+            'dropped_rings': dropped_rings,
+        }
+    return entry
+
+
+# ============================================================================
+# PIPELINE POR PAÍS (INCREMENTAL)
+# ============================================================================
+
+def country_files(country_iso: str) -> List[Path]:
+    """TopoJSON publicados de un país; las copias *.backup.topojson no se sirven"""
+    country_dir = GEOJSON_DIR / country_iso
+    return sorted(p for p in country_dir.glob('*.topojson') if '.backup' not in p.name)
+
+
+def is_up_to_date(entry: Optional[Dict], content_hash: str, zooms: List[int], tiles_dir: Path) -> bool:
+    """Mismo hash de origen y todas las variantes presentes con el tamaño esperado"""
+    if not entry or entry.get('hash') != content_hash:
+        return False
+    for zoom in zooms:
+        variant = entry['variants'].get(str(zoom))
+        if not variant:
+            return False
+        out = tiles_dir / variant['path']
+        if not out.exists() or out.stat().st_size != variant['bytes']:
+            return False
+    return True
+
+
+def build_country(country_iso: str, known: Dict[str, Dict], zooms: List[int],
+                  tolerance_px: float, tiles_dir: Path, force: bool = False) -> Dict:
+    """
+    Procesa los archivos de un país. Devuelve las entradas del manifest del
+    país y cuántos archivos se generaron o se reutilizaron
+    """
+    entries, built, skipped = {}, 0, 0
+    for path in country_files(country_iso):
+        rel_path = path.relative_to(GEOJSON_DIR).as_posix()
+        content_hash = file_hash(path)
+        if not force and is_up_to_date(known.get(rel_path), content_hash, zooms, tiles_dir):
+            entries[rel_path] = known[rel_path]
+            skipped += 1
+            continue
+        entries[rel_path] = build_file(path, rel_path, content_hash, zooms, tolerance_px, tiles_dir)
+        built += 1
+    return {'entries': entries, 'built': built, 'skipped': skipped}
+
+
+def _build_country_worker(country_iso: str, known: Dict[str, Dict], zooms: List[int],
+                          tolerance_px: float, tiles_dir: Path, force: bool):
+    """Envoltorio para el pool: nunca propaga excepciones al proceso principal"""
+    start = time.perf_counter()
+    try:
+        result = build_country(country_iso, known, zooms, tolerance_px, tiles_dir, force)
+        return country_iso, result, time.perf_counter() - start, None
+    except Exception:
+        return country_iso, None, time.perf_counter() - start, traceback.format_exc()
+
+
+def load_tiles_manifest(tiles_dir: Path) -> Dict:
+    """Manifest anterior, o uno vacío si no existe o es de otra versión"""
+    try:
+        with open(tiles_dir / MANIFEST_NAME, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {'files': {}}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {'files': {}}
+    return manifest
+
+
+def remove_variants(entry: Dict, tiles_dir: Path):
+    for variant in entry.get('variants', {}).values():
+        (tiles_dir / variant['path']).unlink(missing_ok=True)
+
+
+def build_tiles(countries: List[str], zooms: List[int], tolerance_px: float, jobs: int,
+                tiles_dir: Path = TILES_DIR, force: bool = False, verbose: bool = True) -> Dict:
+    """Genera las variantes de los países indicados y reescribe el manifest"""
+    previous = load_tiles_manifest(tiles_dir)
+    params = {'zooms': zooms, 'tolerance_px': tolerance_px}
+    files = dict(previous.get('files', {}))
+
+    # Con otros zooms o tolerancia las variantes existentes ya no sirven
+    if previous.get('params') != params:
+        for entry in files.values():
+            remove_variants(entry, tiles_dir)
+        files = {}
+
+    by_country: Dict[str, Dict[str, Dict]] = {}
+    for rel_path, entry in files.items():
+        by_country.setdefault(rel_path.split('/', 1)[0], {})[rel_path] = entry
+
+    totals = {'built': 0, 'skipped': 0, 'errors': 0}
+    print(f"\n⚙️  Generando zooms {zooms} de {len(countries)} países con {jobs} procesos")
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_build_country_worker, iso, by_country.get(iso, {}),
+                            zooms, tolerance_px, tiles_dir, force)
+            for iso in countries
+        ]
+        for done, future in enumerate(as_completed(futures), start=1):
+            country_iso, result, seconds, error = future.result()
+            if error:
+                totals['errors'] += 1
+                print(f"\n❌ Error procesando {country_iso}:\n{error}")
+                continue
+
+            files.update(result['entries'])
+
+            totals['built'] += result['built']
+            totals['skipped'] += result['skipped']
+            if verbose and (result['built'] or done == len(countries)):
+                print(f"   [{done}/{len(countries)}] ✅ {country_iso}: {result['built']} generados, "
+                      f"{result['skipped']} sin cambios ({seconds:.1f}s)")
+
+    # Archivos que ya no existen en static/geojson (o que ahora son copias .backup)
+    for rel_path in [p for p in files if not (GEOJSON_DIR / p).exists() or '.backup' in p]:
+        remove_variants(files.pop(rel_path), tiles_dir)
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'params': params,
+        'zooms': [
+            {'zoom': zoom, 'dir': f"z{zoom}", 'min_area': zoom_min_area(zoom, tolerance_px)}
+            for zoom in zooms
+        ],
+        'files': dict(sorted(files.items())),
+    }
+    payload = json.dumps(manifest, indent=1, ensure_ascii=False).encode('utf-8')
+    write_atomic(tiles_dir / MANIFEST_NAME, payload)
+    return {**totals, 'manifest': manifest}
+
+
+def print_size_summary(manifest: Dict):
+    """Bytes totales del origen y de cada zoom"""
+    files = manifest['files'].values()
+    source = sum(entry['source_bytes'] for entry in files)
+    points = sum(entry['points'] for entry in files)
+    print(f"\n📦 Origen: {source / 1e6:.1f} MB, {points} puntos")
+    print(f"{'Zoom':<6} {'MB':>8} {'% bytes':>8} {'Puntos':>10} {'% puntos':>9} {'Anillos -':>10}")
+    print("-"*56)
+    for zoom in manifest['params']['zooms']:
+        variants = [entry['variants'][str(zoom)] for entry in files if str(zoom) in entry['variants']]
+        size = sum(v['bytes'] for v in variants)
+        kept = sum(v['points'] for v in variants)
+        dropped = sum(v.get('dropped_rings', 0) for v in variants)
+        print(f"z{zoom:<5} {size / 1e6:>8.1f} {size / source:>8.1%} {kept:>10} {kept / points:>9.1%} {dropped:>10}"
+              if source and points else f"z{zoom}")
+
+
+def parse_zooms(value: str) -> List[int]:
+    """'2, 4,6' -> [2, 4, 6]"""
+    return sorted({int(z) for z in value.split(',') if z.strip()})
+
+
+def parse_args():
+    """Argumentos de línea de comandos"""
+    parser = argparse.ArgumentParser(description="Genera variantes por zoom de static/geojson")
+    parser.add_argument('--countries', type=lambda v: [c.strip().upper() for c in v.split(',') if c.strip()],
+                        metavar='ISO3,...', help="Países a procesar (por defecto todos)")
+    parser.add_argument('--zooms', type=parse_zooms, default=list(DEFAULT_ZOOMS),
+                        help=f"Zooms a generar (por defecto {','.join(map(str, DEFAULT_ZOOMS))})")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE_PX,
+                        help="Tolerancia en píxeles: lado del área mínima conservada (por defecto 1)")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="Procesos en paralelo (por defecto, uno por CPU)")
+    parser.add_argument('--output-dir', type=Path, default=TILES_DIR,
+                        help=f"Directorio de salida (por defecto {TILES_DIR})")
+    parser.add_argument('--force', action='store_true',
+                        help="Regenera todas las variantes aunque el hash no haya cambiado")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="Sin detalle por país; solo errores y resumen")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    print("\n🗺️  PIRÁMIDE DE GEOMETRÍAS SIMPLIFICADAS")
+    print("="*60)
+    print(f"📂 Origen: {GEOJSON_DIR}")
+    print(f"💾 Salida: {args.output_dir}")
+    print("="*60)
+
+    if not GEOJSON_DIR.exists():
+        print(f"\n❌ ERROR: Directorio GeoJSON no encontrado: {GEOJSON_DIR}")
+        sys.exit(1)
+
+    countries = args.countries or sorted(d.name for d in GEOJSON_DIR.iterdir() if d.is_dir())
+    start = time.perf_counter()
+    result = build_tiles(countries, args.zooms, args.tolerance, max(1, args.jobs),
+                         args.output_dir, args.force, verbose=not args.quiet)
+
+    print("\n" + "="*60)
+    print(f"✅ {result['built']} archivos generados, {result['skipped']} sin cambios, "
+          f"{result['errors']} países con error ({time.perf_counter() - start:.1f}s)")
+    print_size_summary(result['manifest'])
+
+
+if __name__ == "__main__":
+    main()
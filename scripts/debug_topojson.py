@@ -2,14 +2,64 @@
 """
 Script para debugear archivos TopoJSON
 Ve qué estructura tienen y qué propiedades contienen
+
+Uso:
+    python scripts/debug_topojson.py                          # Vuelca ESP, ESP.1 y ESP.11
+    python scripts/debug_topojson.py static/geojson/FRA/FRA.topojson
+
+    # Perfil de todo static/geojson en paralelo, ordenado por coste de parseo
+    python scripts/debug_topojson.py --profile
+    python scripts/debug_topojson.py --profile --countries ESP,FRA --jobs 4
+    python scripts/debug_topojson.py --profile --sort size --output perfil.csv
+
+El perfil mide por archivo: tamaño, tiempo de parseo JSON y de decodificación
+de arcos, número de arcos y puntos, cuantización, geometrías, esquema de
+propiedades y geometrías sin las claves que necesita populate_subdivisions.py
+(ID_1/NAME_1 en {PAÍS}.topojson, ID_2/NAME_2 en {PAÍS}.{N}.topojson).
+Escribe el informe en JSON o CSV según la extensión de --output.
 """
 
+import argparse
+import csv
 import json
+import os
+import sys
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional
 
 BASE_DIR = Path(__file__).parent.parent
 GEOJSON_DIR = BASE_DIR / "static" / "geojson"
 
+DEFAULT_FILES = [
+    GEOJSON_DIR / "ESP" / "ESP.topojson",     # Nivel 1
+    GEOJSON_DIR / "ESP" / "ESP.1.topojson",   # Nivel 2 de Andalucía
+    GEOJSON_DIR / "ESP" / "ESP.11.topojson",  # Nivel 2 de Madrid
+]
+
+# Claves que lee populate_subdivisions.py según el tipo de archivo.
+# NAME_* se acepta en mayúsculas o minúsculas, igual que en el loader
+REQUIRED_KEYS = {
+    'main': ('ID_1', 'NAME_1'),
+    'level3': ('ID_2', 'NAME_2'),
+}
+
+SORT_KEYS = {
+    'parse': lambda r: r['parse_ms'] + r['decode_ms'],
+    'size': lambda r: r['size_bytes'],
+    'points': lambda r: r['points'],
+}
+
+CSV_COLUMNS = (
+    'rank', 'path', 'country', 'kind', 'size_bytes', 'parse_ms', 'decode_ms',
+    'arcs', 'points', 'bytes_per_point', 'quantized', 'quantization',
+    'objects', 'geometries', 'geometry_types', 'property_keys', 'schemas',
+    'missing_keys', 'error',
+)
+
 def analyze_topojson(file_path: Path):
     """Analiza un archivo TopoJSON"""
     print(f"\n{'='*60}")
@@ -56,30 +106,245 @@ def analyze_topojson(file_path: Path):
                         for k, v in props.items():
                             print(f"            {k}: {v}")
 
+# ============================================================================
+# PERFIL DEL CORPUS
+# ============================================================================
+
+def file_kind(path: Path) -> str:
+    """'main' para {PAÍS}.topojson, 'level3' para {PAÍS}.{N}.topojson"""
+    return 'main' if path.stem == path.parent.name else 'level3'
+
+def has_key(props: Dict, key: str) -> bool:
+    """Clave presente y no vacía (NAME_* en cualquiera de las dos grafías)"""
+    if key.startswith('NAME_'):
+        return bool(props.get(key) or props.get(key.lower()))
+    return bool(props.get(key))
+
+def quantization(transform: Optional[Dict], coords) -> Optional[int]:
+    """
+    TopoJSON no guarda el parámetro de cuantización; se estima como el número
+    de pasos de la rejilla que ocupan las coordenadas decodificadas
+    """
+    if not transform or not len(coords):
+        return None
+    scale = transform.get('scale') or [1, 1]
+    translate = transform.get('translate') or [0, 0]
+    steps = [
+        (coords[:, axis].max() - translate[axis]) / scale[axis]
+        for axis in (0, 1) if scale[axis]
+    ]
+    return int(round(max(steps))) + 1 if steps else None
+
+def profile_file(path: Path) -> Dict:
+    """Perfil de un archivo; los errores se devuelven en el propio resultado"""
+    # Importado aquí para que el volcado de archivos no requiera numpy
+    from topojson_decoder import decode_arcs
+    
+    result = {
+        'path': str(path.relative_to(GEOJSON_DIR)),
+        'country': path.parent.name,
+        'kind': file_kind(path),
+        'size_bytes': path.stat().st_size,
+        'parse_ms': 0.0, 'decode_ms': 0.0,
+        'arcs': 0, 'points': 0, 'bytes_per_point': None,
+        'quantized': False, 'quantization': None,
+        'objects': 0, 'geometries': 0,
+        'geometry_types': {}, 'property_keys': {}, 'schemas': 0,
+        'missing_keys': {}, 'error': None,
+    }
+    try:
+        start = time.perf_counter()
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        result['parse_ms'] = (time.perf_counter() - start) * 1000
+        
+        arcs = data.get('arcs') or []
+        transform = data.get('transform')
+        start = time.perf_counter()
+        coords, _offsets = decode_arcs(arcs, transform)
+        result['decode_ms'] = (time.perf_counter() - start) * 1000
+        
+        result['arcs'] = len(arcs)
+        result['points'] = len(coords)
+        if result['points']:
+            result['bytes_per_point'] = round(result['size_bytes'] / result['points'], 1)
+        result['quantized'] = transform is not None
+        result['quantization'] = quantization(transform, coords)
+        
+        objects = data.get('objects') or {}
+        types, keys, schemas, missing = Counter(), Counter(), set(), Counter()
+        required = REQUIRED_KEYS[result['kind']]
+        for obj in objects.values():
+            for geom in obj.get('geometries', []):
+                props = geom.get('properties') or {}
+                types[geom.get('type')] += 1
+                keys.update(props.keys())
+                schemas.add(tuple(sorted(props)))
+                missing.update(key for key in required if not has_key(props, key))
+                result['geometries'] += 1
+        
+        result['objects'] = len(objects)
+        result['geometry_types'] = dict(types.most_common())
+        result['property_keys'] = dict(sorted(keys.items()))
+        result['schemas'] = len(schemas)
+        result['missing_keys'] = dict(missing)
+    except Exception:
+        result['error'] = traceback.format_exc(limit=1).strip().splitlines()[-1]
+    
+    result['parse_ms'] = round(result['parse_ms'], 2)
+    result['decode_ms'] = round(result['decode_ms'], 2)
+    return result
+
+def corpus_files(countries: Optional[List[str]] = None) -> List[Path]:
+    """Todos los .topojson de static/geojson (o de los países indicados)"""
+    dirs = [GEOJSON_DIR / iso for iso in countries] if countries else [GEOJSON_DIR]
+    return sorted(path for d in dirs for path in d.rglob('*.topojson'))
+
+def profile_corpus(files: List[Path], jobs: int) -> List[Dict]:
+    """Perfila los archivos en un pool de procesos (secuencial con jobs=1)"""
+    if jobs <= 1:
+        return [profile_file(path) for path in files]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(profile_file, files, chunksize=8))
+
+def rank_results(results: List[Dict], sort: str) -> List[Dict]:
+    """Ordena de mayor a menor coste y numera; los errores van al final"""
+    ranked = sorted(results, key=lambda r: (r['error'] is None, SORT_KEYS[sort](r)), reverse=True)
+    for rank, result in enumerate(ranked, start=1):
+        result['rank'] = rank
+    return ranked
+
+def corpus_totals(results: List[Dict]) -> Dict:
+    """Totales del corpus y frecuencia de cada clave de propiedades"""
+    keys = Counter()
+    for result in results:
+        keys.update(result['property_keys'])
+    return {
+        'files': len(results),
+        'errors': sum(1 for r in results if r['error']),
+        'size_bytes': sum(r['size_bytes'] for r in results),
+        'parse_ms': round(sum(r['parse_ms'] for r in results), 1),
+        'decode_ms': round(sum(r['decode_ms'] for r in results), 1),
+        'arcs': sum(r['arcs'] for r in results),
+        'points': sum(r['points'] for r in results),
+        'geometries': sum(r['geometries'] for r in results),
+        'files_missing_keys': sum(1 for r in results if r['missing_keys']),
+        'unquantized_files': sum(1 for r in results if not r['quantized'] and not r['error']),
+        'property_keys': dict(keys.most_common()),
+    }
+
+def csv_value(value):
+    """Diccionarios como 'clave=valor;...' para que el CSV siga siendo plano"""
+    if isinstance(value, dict):
+        return ';'.join(f"{k}={v}" for k, v in value.items())
+    return '' if value is None else value
+
+def write_report(path: Path, results: List[Dict], totals: Dict, sort: str, elapsed: float):
+    """JSON con totales y archivos, o CSV con una fila por archivo"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix.lower() == '.csv':
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_COLUMNS)
+            for result in results:
+                writer.writerow([csv_value(result.get(column)) for column in CSV_COLUMNS])
+        return
+    
+    report = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'geojson_dir': str(GEOJSON_DIR),
+        'sort': sort,
+        'elapsed_s': round(elapsed, 2),
+        'totals': totals,
+        'files': results,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+def print_profile_summary(results: List[Dict], totals: Dict, top: int):
+    """Los archivos más caros de parsear, los más pesados y los que tienen problemas"""
+    print(f"\n⏱️  Top {top} por coste de parseo + decodificación:")
+    print(f"{'Archivo':<32} {'MB':>7} {'Parse ms':>10} {'Decode ms':>10} {'Puntos':>10} {'Geoms':>7}")
+    print("-"*80)
+    by_cost = sorted((r for r in results if not r['error']), key=SORT_KEYS['parse'], reverse=True)
+    for r in by_cost[:top]:
+        print(f"{r['path']:<32} {r['size_bytes'] / 1e6:>7.2f} {r['parse_ms']:>10.1f} "
+              f"{r['decode_ms']:>10.1f} {r['points']:>10} {r['geometries']:>7}")
+    
+    print(f"\n📦 Top {top} por tamaño:")
+    for r in sorted(results, key=SORT_KEYS['size'], reverse=True)[:top]:
+        print(f"   {r['path']:<32} {r['size_bytes'] / 1e6:>7.2f} MB "
+              f"({r['bytes_per_point'] or '-'} bytes/punto)")
+    
+    missing = [r for r in results if r['missing_keys']]
+    if missing:
+        print(f"\n⚠️  {len(missing)} archivos con geometrías sin claves requeridas:")
+        for r in missing[:top]:
+            print(f"   {r['path']:<32} {csv_value(r['missing_keys'])}")
+    
+    for r in (r for r in results if r['error']):
+        print(f"\n❌ {r['path']}: {r['error']}")
+    
+    print("\n" + "="*60)
+    print(f"📊 {totals['files']} archivos · {totals['size_bytes'] / 1e6:.1f} MB · "
+          f"{totals['points']} puntos · {totals['geometries']} geometrías")
+    print(f"   Parseo {totals['parse_ms'] / 1000:.1f}s · decodificación {totals['decode_ms'] / 1000:.1f}s "
+          f"(suma de todos los procesos)")
+    if totals['unquantized_files']:
+        print(f"   {totals['unquantized_files']} archivos sin cuantizar")
+
+def run_profile(args):
+    """Modo --profile: perfila el corpus y escribe el informe"""
+    files = corpus_files(args.countries)
+    if not files:
+        print(f"\n❌ No hay archivos .topojson en {GEOJSON_DIR}")
+        sys.exit(1)
+    
+    print(f"\n🔍 PERFIL DE {len(files)} ARCHIVOS TOPOJSON ({args.jobs} procesos)")
+    print("="*60)
+    
+    start = time.perf_counter()
+    results = rank_results(profile_corpus(files, args.jobs), args.sort)
+    elapsed = time.perf_counter() - start
+    totals = corpus_totals(results)
+    
+    print_profile_summary(results, totals, args.top)
+    write_report(args.output, results, totals, args.sort, elapsed)
+    print(f"\n💾 Informe guardado en {args.output} ({elapsed:.1f}s)")
+
+def parse_args():
+    """Argumentos de línea de comandos"""
+    parser = argparse.ArgumentParser(description="Inspecciona o perfila los TopoJSON de static/geojson")
+    parser.add_argument('files', nargs='*', type=Path,
+                        help="Archivos a volcar (por defecto ESP, ESP.1 y ESP.11)")
+    parser.add_argument('--profile', action='store_true',
+                        help="Perfila todo el corpus en paralelo en lugar de volcar archivos")
+    parser.add_argument('--countries', type=lambda v: [c.strip().upper() for c in v.split(',') if c.strip()],
+                        metavar='ISO3,...', help="Limita el perfil a estos países")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="Procesos del perfil (por defecto, uno por CPU)")
+    parser.add_argument('--sort', choices=sorted(SORT_KEYS), default='parse',
+                        help="Orden del informe: coste de parseo, tamaño o puntos (por defecto parse)")
+    parser.add_argument('--output', type=Path, default=Path('topojson-profile.json'),
+                        help="Informe .json o .csv (por defecto topojson-profile.json)")
+    parser.add_argument('--top', type=int, default=15,
+                        help="Archivos a mostrar en cada ranking por pantalla")
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    if args.profile:
+        run_profile(args)
+        return
+    
     print("\n🔍 DEBUG DE ARCHIVOS TOPOJSON")
     print("="*60)
     
-    # Analizar ESP.topojson (nivel 1)
-    esp_main = GEOJSON_DIR / "ESP" / "ESP.topojson"
-    if esp_main.exists():
-        analyze_topojson(esp_main)
-    else:
-        print(f"\n❌ No se encontró: {esp_main}")
-    
-    # Analizar ESP.1.topojson (nivel 2 de Andalucía)
-    esp_1 = GEOJSON_DIR / "ESP" / "ESP.1.topojson"
-    if esp_1.exists():
-        analyze_topojson(esp_1)
-    else:
-        print(f"\n❌ No se encontró: {esp_1}")
-    
-    # Analizar ESP.11.topojson (nivel 2 de Madrid)
-    esp_11 = GEOJSON_DIR / "ESP" / "ESP.11.topojson"
-    if esp_11.exists():
-        analyze_topojson(esp_11)
-    else:
-        print(f"\n❌ No se encontró: {esp_11}")
+    for path in args.files or DEFAULT_FILES:
+        if path.exists():
+            analyze_topojson(path)
+        else:
+            print(f"\n❌ No se encontró: {path}")
     
     print("\n" + "="*60)
     print("✅ Análisis completado")
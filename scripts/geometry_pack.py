@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+"""
+Formato binario compacto de geometrías de subdivisiones con lector mmap
+
+Empaqueta todos los TopoJSON publicados de static/geojson en un solo archivo
+columnar, sin volver a parsear JSON al leerlo:
+
+- arcs.coords        int32 Nx2   posiciones cuantizadas absolutas (sin delta)
+- arcs.offsets       int64       arco i = coords[offsets[i]:offsets[i+1]]
+- rings.arcs         int32       referencias a arcos de cada anillo (~i = invertido)
+- rings.offsets      int64       anillo r = rings.arcs[offsets[r]:offsets[r+1]]
+- polygons.offsets   int64       anillos de cada polígono
+- features.offsets   int64       polígonos de cada geometría
+- features.*         file/id/level/bbox de cada geometría
+- props.offsets      int64       propiedades de cada geometría
+- props.items        int32 Kx3   (clave, valor, valor_es_json) como índices de strings
+- strings.*          tabla de strings UTF-8 deduplicada
+- files.*            ruta, transform (scale, translate) y arcos de cada archivo de origen
+
+El lector mapea el archivo en memoria y expone cada sección como un array
+NumPy sobre el mmap: abrirlo cuesta milisegundos y solo se copian datos al
+pedir coordenadas en grados o propiedades.
+
+Requisitos:
+    pip install numpy
+
+Uso:
+    python scripts/geometry_pack.py build
+    python scripts/geometry_pack.py info
+    python scripts/geometry_pack.py show ESP.11.1
+
+    from geometry_pack import GeometryPack
+    with GeometryPack.load() as pack:
+        i = pack.feature_index('ESP.11.1')
+        pack.properties(i)                      # dict de propiedades
+        pack.polygons(i)                        # mismo formato que TopologyDecoder.polygons
+        pack.arc(pack.feature(i).ring_arcs[0])  # vista int32 del arco, sin copia
+"""
+
+import argparse
+import json
+import mmap
+import struct
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from populate_subdivisions import BASE_DIR, GEOJSON_DIR
+from topojson_decoder import Polygons, decode_arcs
+
+PACK_PATH = BASE_DIR / "prisma" / "subdivisions.geopack"
+
+PACK_MAGIC = b'VTGPACK\x00'
+PACK_VERSION = 1
+HEADER = struct.Struct('<8sII')          # magic, versión, número de secciones
+SECTION = struct.Struct('<24s8sQQQ')     # nombre, dtype, offset, filas, columnas
+ALIGNMENT = 64
+
+# Rejilla para archivos sin transform: 2^30 pasos sobre su bbox caben en int32
+UNQUANTIZED_STEPS = 1 << 30
+
+
+# ============================================================================
+# CONSTRUCCIÓN
+# ============================================================================
+
+def published_files(countries: Optional[List[str]] = None) -> List[Path]:
+    """TopoJSON publicados (sin las copias *.backup.topojson), país a país"""
+    if countries is None:
+        countries = sorted(d.name for d in GEOJSON_DIR.iterdir() if d.is_dir())
+    return [
+        path
+        for country_iso in countries
+        for path in sorted((GEOJSON_DIR / country_iso).glob('*.topojson'))
+        if '.backup' not in path.name
+    ]
+
+
+def quantized_arcs(topology: Dict) -> Tuple[np.ndarray, np.ndarray, Tuple[float, float, float, float]]:
+    """
+    Posiciones enteras absolutas de todos los arcos y el transform que las
+    convierte en grados: (coords int32 Nx2, offsets, (sx, sy, tx, ty)).
+    Los archivos sin transform se cuantizan sobre su bbox
+    """
+    arcs = topology.get('arcs') or []
+    transform = topology.get('transform')
+    if transform:
+        # Con scale 1 y translate 0 el decoder solo deshace el delta
+        coords, offsets = decode_arcs(arcs, {'scale': (1.0, 1.0), 'translate': (0.0, 0.0)})
+        sx, sy = transform.get('scale', (1.0, 1.0))
+        tx, ty = transform.get('translate', (0.0, 0.0))
+        return np.rint(coords).astype(np.int32), offsets, (sx, sy, tx, ty)
+
+    coords, offsets = decode_arcs(arcs)
+    if not len(coords):
+        return np.empty((0, 2), dtype=np.int32), offsets, (1.0, 1.0, 0.0, 0.0)
+    low = coords.min(axis=0)
+    scale = np.maximum((coords.max(axis=0) - low) / UNQUANTIZED_STEPS, 1e-12)
+    ints = np.rint((coords - low) / scale).astype(np.int32)
+    return ints, offsets, (float(scale[0]), float(scale[1]), float(low[0]), float(low[1]))
+
+
+def geometry_rings(geometry: Dict) -> List[List[list]]:
+    """Referencias a arcos por polígono y anillo de Polygon/MultiPolygon/GeometryCollection"""
+    geom_type = geometry.get('type')
+    arcs = geometry.get('arcs') or []
+    if geom_type == 'Polygon':
+        return [arcs]
+    if geom_type == 'MultiPolygon':
+        return arcs
+    if geom_type == 'GeometryCollection':
+        return [p for child in geometry.get('geometries', []) for p in geometry_rings(child)]
+    return []
+
+
+class _PackBuffer:
+    """Acumula las columnas del pack mientras se recorren los archivos"""
+
+    def __init__(self):
+        self.strings: Dict[str, int] = {}
+        self.file_paths = array('i')
+        self.file_transforms: List[Tuple[float, float, float, float]] = []
+        self.file_arcs = array('q')
+        self.arc_coords: List[np.ndarray] = []
+        self.arc_lengths: List[np.ndarray] = []
+        self.arc_count = 0
+        self.ring_arcs = array('i')
+        self.ring_sizes = array('q')
+        self.polygon_sizes = array('q')
+        self.feature_sizes = array('q')
+        self.feature_file = array('i')
+        self.feature_id = array('i')
+        self.feature_level = array('b')
+        self.feature_arcs: List[List[int]] = []
+        self.prop_sizes = array('q')
+        self.props = array('i')
+
+    def string(self, value: str) -> int:
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+        return index
+
+    def add_file(self, path: Path):
+        with open(path, 'r', encoding='utf-8') as f:
+            topology = json.load(f)
+
+        coords, offsets, transform = quantized_arcs(topology)
+        file_index = len(self.file_paths)
+        self.file_paths.append(self.string(path.relative_to(GEOJSON_DIR).as_posix()))
+        self.file_transforms.append(transform)
+        self.arc_coords.append(coords)
+        self.arc_lengths.append(np.diff(offsets))
+        self.file_arcs.append(len(offsets) - 1)
+        base = self.arc_count
+        self.arc_count += len(offsets) - 1
+
+        # Mismos criterios que el loader: objeto principal, ID_1 en el archivo
+        # del país (nivel 2) e ID_2 en los archivos de nivel 3
+        is_main = path.stem == path.parent.name
+        id_key, level = ('ID_1', 2) if is_main else ('ID_2', 3)
+        objects = topology.get('objects') or {}
+        main_object = next(iter(objects.values()), {})
+
+        for geometry in main_object.get('geometries', []):
+            props = geometry.get('properties') or {}
+            used = []
+            polygons = geometry_rings(geometry)
+            for polygon in polygons:
+                for ring in polygon:
+                    for ref in ring:
+                        arc = base + ref if ref >= 0 else base + ~ref
+                        self.ring_arcs.append(arc if ref >= 0 else ~arc)
+                        used.append(arc)
+                    self.ring_sizes.append(len(ring))
+                self.polygon_sizes.append(len(polygon))
+            self.feature_sizes.append(len(polygons))
+            self.feature_file.append(file_index)
+            self.feature_id.append(self.string(str(props.get(id_key) or '')))
+            self.feature_level.append(level)
+            self.feature_arcs.append(used)
+
+            for key, value in props.items():
+                is_json = not isinstance(value, str)
+                text = json.dumps(value, ensure_ascii=False) if is_json else value
+                self.props.extend((self.string(key), self.string(text), int(is_json)))
+            self.prop_sizes.append(len(props))
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Columnas finales del pack"""
+        def offsets(sizes) -> np.ndarray:
+            result = np.zeros(len(sizes) + 1, dtype=np.int64)
+            np.cumsum(np.frombuffer(sizes, dtype=np.int64), out=result[1:])
+            return result
+
+        coords = np.concatenate(self.arc_coords) if self.arc_coords else np.empty((0, 2), np.int32)
+        arc_offsets = np.zeros(self.arc_count + 1, dtype=np.int64)
+        if self.arc_count:
+            np.cumsum(np.concatenate(self.arc_lengths), out=arc_offsets[1:])
+
+        encoded = [s.encode('utf-8') for s in self.strings]
+        string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=string_offsets[1:])
+
+        file_transforms = np.asarray(self.file_transforms, dtype=np.float64).reshape(-1, 4)
+        return {
+            'files.path': np.frombuffer(self.file_paths, dtype=np.int32),
+            'files.transform': file_transforms,
+            'files.arcs': offsets(self.file_arcs),
+            'arcs.coords': coords,
+            'arcs.offsets': arc_offsets,
+            'rings.arcs': np.frombuffer(self.ring_arcs, dtype=np.int32),
+            'rings.offsets': offsets(self.ring_sizes),
+            'polygons.offsets': offsets(self.polygon_sizes),
+            'features.offsets': offsets(self.feature_sizes),
+            'features.file': np.frombuffer(self.feature_file, dtype=np.int32),
+            'features.id': np.frombuffer(self.feature_id, dtype=np.int32),
+            'features.level': np.frombuffer(self.feature_level, dtype=np.int8),
+            'features.bbox': self.feature_bboxes(coords, arc_offsets, file_transforms),
+            'props.offsets': offsets(self.prop_sizes),
+            'props.items': np.frombuffer(self.props, dtype=np.int32).reshape(-1, 3),
+            'strings.offsets': string_offsets,
+            'strings.data': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        }
+
+    def feature_bboxes(self, coords: np.ndarray, arc_offsets: np.ndarray,
+                       file_transforms: np.ndarray) -> np.ndarray:
+        """(min_lon, min_lat, max_lon, max_lat) de cada geometría; NaN si no tiene polígonos"""
+        bboxes = np.full((len(self.feature_arcs), 4), np.nan)
+        nonempty = arc_offsets[1:] > arc_offsets[:-1]
+        if not nonempty.any():
+            return bboxes
+        starts = arc_offsets[:-1][nonempty]
+        arc_min = np.full((self.arc_count, 2), np.iinfo(np.int32).max, dtype=np.int64)
+        arc_max = np.full((self.arc_count, 2), np.iinfo(np.int32).min, dtype=np.int64)
+        arc_min[nonempty] = np.minimum.reduceat(coords, starts, axis=0)
+        arc_max[nonempty] = np.maximum.reduceat(coords, starts, axis=0)
+
+        for i, used in enumerate(self.feature_arcs):
+            used = [arc for arc in used if nonempty[arc]]
+            if not used:
+                continue
+            sx, sy, tx, ty = file_transforms[self.feature_file[i]]
+            low = arc_min[used].min(axis=0)
+            high = arc_max[used].max(axis=0)
+            bboxes[i] = (low[0] * sx + tx, low[1] * sy + ty, high[0] * sx + tx, high[1] * sy + ty)
+        return bboxes
+
+
+def write_pack(path: Path, arrays: Dict[str, np.ndarray]):
+    """Cabecera + directorio de secciones + datos alineados a 64 bytes"""
+    position = HEADER.size + SECTION.size * len(arrays)
+    directory, layout = [], []
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values)
+        values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+        position += -position % ALIGNMENT
+        rows = values.shape[0] if values.ndim else 1
+        cols = values.shape[1] if values.ndim > 1 else 1
+        directory.append(SECTION.pack(name.encode('ascii'), values.dtype.str.encode('ascii'),
+                                      position, rows, cols))
+        layout.append((position, values))
+        position += values.nbytes
+
+    tmp_path = path.with_suffix('.tmp')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(PACK_MAGIC, PACK_VERSION, len(arrays)))
+        for entry in directory:
+            f.write(entry)
+        for offset, values in layout:
+            f.write(b'\x00' * (offset - f.tell()))
+            f.write(values.tobytes())
+    tmp_path.replace(path)
+
+
+def build_pack(countries: Optional[List[str]] = None, path: Path = PACK_PATH,
+               verbose: bool = True) -> Dict[str, float]:
+    """
+    Construye y guarda el pack.
+    Retorna: estadísticas {'files', 'features', 'points', 'bytes', 'seconds'}
+    """
+    start = time.perf_counter()
+    buffer = _PackBuffer()
+    files = published_files(countries)
+    for source in files:
+        buffer.add_file(source)
+
+    if not buffer.feature_file:
+        raise ValueError("No se encontraron geometrías para empaquetar")
+
+    arrays = buffer.arrays()
+    write_pack(path, arrays)
+
+    stats = {
+        'files': len(files),
+        'features': len(buffer.feature_file),
+        'points': int(arrays['arcs.offsets'][-1]),
+        'bytes': path.stat().st_size,
+        'seconds': time.perf_counter() - start,
+    }
+    if verbose:
+        print(f"   📦 Pack de geometrías: {stats['files']} archivos, {stats['features']} geometrías, "
+              f"{stats['points']} puntos, {stats['bytes'] / 1e6:.1f} MB "
+              f"en {stats['seconds']:.1f}s -> {path}")
+    return stats
+
+
+# ============================================================================
+# LECTURA
+# ============================================================================
+
+class PackedFeature(NamedTuple):
+    """Vistas sin copia de una geometría del pack"""
+    index: int
+    subdivision_id: str
+    level: int
+    file: int
+    bbox: np.ndarray            # (min_lon, min_lat, max_lon, max_lat)
+    ring_arcs: np.ndarray       # Referencias a arcos de todos sus anillos
+    ring_offsets: np.ndarray    # Anillo k = ring_arcs[ring_offsets[k]:ring_offsets[k+1]] (relativo)
+    polygon_offsets: np.ndarray  # Polígono p = anillos [polygon_offsets[p]:polygon_offsets[p+1]] (relativo)
+
+
+class GeometryPack:
+    """Pack de geometrías mapeado en memoria; las secciones son arrays sobre el mmap"""
+
+    def __init__(self, path: Path = PACK_PATH):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = HEADER.unpack_from(self._mm, 0)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            self._mm.close()
+            raise ValueError(f"{path} no es un pack de geometrías v{PACK_VERSION}")
+
+        self.sections: Dict[str, np.ndarray] = {}
+        for n in range(count):
+            name, dtype, offset, rows, cols = SECTION.unpack_from(self._mm, HEADER.size + n * SECTION.size)
+            values = np.frombuffer(self._mm, dtype=np.dtype(dtype.rstrip(b'\x00').decode('ascii')),
+                                   count=rows * cols, offset=offset)
+            self.sections[name.rstrip(b'\x00').decode('ascii')] = values.reshape(rows, cols) if cols > 1 else values
+
+        s = self.sections
+        self.file_paths = s['files.path']
+        self.file_transforms = s['files.transform']
+        self.file_arcs = s['files.arcs']
+        self.arc_coords = s['arcs.coords']
+        self.arc_offsets = s['arcs.offsets']
+        self.ring_arcs = s['rings.arcs']
+        self.ring_offsets = s['rings.offsets']
+        self.polygon_offsets = s['polygons.offsets']
+        self.feature_offsets = s['features.offsets']
+        self.feature_files = s['features.file']
+        self.feature_ids = s['features.id']
+        self.feature_levels = s['features.level']
+        self.feature_bboxes = s['features.bbox']
+        self.prop_offsets = s['props.offsets']
+        self.prop_items = s['props.items']
+        self.string_offsets = s['strings.offsets']
+        self.string_data = s['strings.data']
+        self._ids: Optional[Dict[str, int]] = None
+
+    @classmethod
+    def load(cls, path: Path = PACK_PATH) -> 'GeometryPack':
+        if not path.exists():
+            raise FileNotFoundError(
+                f"Pack de geometrías no encontrado en {path}. "
+                "Ejecuta: python scripts/geometry_pack.py build"
+            )
+        return cls(path)
+
+    def close(self):
+        """Libera el mmap; las vistas que sigan vivas fuera del pack lo mantienen abierto"""
+        self.sections = {}
+        for name in list(vars(self)):
+            if isinstance(getattr(self, name), np.ndarray):
+                setattr(self, name, None)
+        try:
+            self._mm.close()
+        except BufferError:
+            pass
+
+    def __enter__(self) -> 'GeometryPack':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.feature_files)
+
+    # --- Strings y propiedades ---
+
+    def string(self, index: int) -> str:
+        start, end = self.string_offsets[index], self.string_offsets[index + 1]
+        return self.string_data[start:end].tobytes().decode('utf-8')
+
+    def file_path(self, file: int) -> str:
+        return self.string(self.file_paths[file])
+
+    def feature_id(self, index: int) -> str:
+        return self.string(self.feature_ids[index])
+
+    def feature_index(self, subdivision_id: str) -> Optional[int]:
+        """Posición de una geometría por subdivision_id (si se repite, la primera)"""
+        if self._ids is None:
+            self._ids = {}
+            for index, string in enumerate(self.feature_ids.tolist()):
+                self._ids.setdefault(self.string(string), index)
+        return self._ids.get(subdivision_id)
+
+    def properties(self, index: int) -> Dict:
+        items = self.prop_items[self.prop_offsets[index]:self.prop_offsets[index + 1]]
+        result = {}
+        for key, value, is_json in items.tolist():
+            text = self.string(value)
+            result[self.string(key)] = json.loads(text) if is_json else text
+        return result
+
+    # --- Geometría ---
+
+    def feature(self, index: int) -> PackedFeature:
+        p0, p1 = self.feature_offsets[index], self.feature_offsets[index + 1]
+        r0, r1 = self.polygon_offsets[p0], self.polygon_offsets[p1]
+        a0 = self.ring_offsets[r0]
+        return PackedFeature(
+            index,
+            self.feature_id(index),
+            int(self.feature_levels[index]),
+            int(self.feature_files[index]),
+            self.feature_bboxes[index],
+            self.ring_arcs[a0:self.ring_offsets[r1]],
+            self.ring_offsets[r0:r1 + 1] - a0,
+            self.polygon_offsets[p0:p1 + 1] - r0,
+        )
+
+    def arc(self, ref: int) -> np.ndarray:
+        """Posiciones cuantizadas (int32) de un arco; ~i es el arco i invertido. Sin copia"""
+        if ref < 0:
+            i = ~ref
+            return self.arc_coords[self.arc_offsets[i]:self.arc_offsets[i + 1]][::-1]
+        return self.arc_coords[self.arc_offsets[ref]:self.arc_offsets[ref + 1]]
+
+    def _ring_positions(self, ring: int) -> np.ndarray:
+        """Une los arcos de un anillo sin repetir los puntos de unión"""
+        refs = self.ring_arcs[self.ring_offsets[ring]:self.ring_offsets[ring + 1]].tolist()
+        if not refs:
+            return np.empty((0, 2), dtype=np.int32)
+        parts = [self.arc(ref) if n == 0 else self.arc(ref)[1:] for n, ref in enumerate(refs)]
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    def _degrees(self, positions: np.ndarray, file: int) -> np.ndarray:
+        sx, sy, tx, ty = self.file_transforms[file]
+        result = positions.astype(np.float64)
+        result *= (sx, sy)
+        result += (tx, ty)
+        return result
+
+    def arc_degrees(self) -> np.ndarray:
+        """
+        Todas las posiciones de arcs.coords en grados (Nx2 float64, alineado
+        con arc_offsets) en una sola operación vectorizada
+        """
+        points = np.diff(self.arc_offsets[self.file_arcs])
+        transforms = np.repeat(self.file_transforms, points, axis=0)
+        result = self.arc_coords.astype(np.float64)
+        result *= transforms[:, :2]
+        result += transforms[:, 2:]
+        return result
+
+    def ring(self, ring: int) -> np.ndarray:
+        """Anillo global `ring` en grados (lon, lat)"""
+        polygon = np.searchsorted(self.polygon_offsets, ring, 'right') - 1
+        feature = np.searchsorted(self.feature_offsets, polygon, 'right') - 1
+        return self._degrees(self._ring_positions(ring), int(self.feature_files[feature]))
+
+    def polygons(self, index: int) -> Polygons:
+        """Polígonos en grados, en el mismo formato que TopologyDecoder.polygons"""
+        file = int(self.feature_files[index])
+        p0, p1 = self.feature_offsets[index], self.feature_offsets[index + 1]
+        return [
+            [self._degrees(self._ring_positions(ring), file)
+             for ring in range(self.polygon_offsets[polygon], self.polygon_offsets[polygon + 1])]
+            for polygon in range(p0, p1)
+        ]
+
+    def iter_features(self) -> Iterable[PackedFeature]:
+        for index in range(len(self)):
+            yield self.feature(index)
+
+
+def print_info(pack: GeometryPack, path: Path):
+    size = path.stat().st_size
+    print(f"📦 {path} ({size / 1e6:.1f} MB)")
+    print(f"   {len(pack.file_paths)} archivos · {len(pack)} geometrías · "
+          f"{len(pack.polygon_offsets) - 1} polígonos · {len(pack.ring_offsets) - 1} anillos · "
+          f"{len(pack.arc_offsets) - 1} arcos · {len(pack.arc_coords)} puntos · "
+          f"{len(pack.string_offsets) - 1} strings")
+    print(f"\n{'Sección':<20} {'dtype':>8} {'Forma':>16} {'KB':>10}")
+    print("-"*58)
+    for name, values in pack.sections.items():
+        print(f"{name:<20} {values.dtype.str:>8} {str(values.shape):>16} {values.nbytes / 1024:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack binario de geometrías de subdivisiones")
+    parser.add_argument('--pack', type=Path, default=PACK_PATH, help="Ruta del pack")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help="Construye el pack desde static/geojson")
+    build.add_argument('--countries', help="Códigos ISO3 separados por coma (por defecto todos)")
+
+    commands.add_parser('info', help="Secciones, tamaños y tiempo de apertura")
+
+    show = commands.add_parser('show', help="Propiedades y geometría de una subdivisión")
+    show.add_argument('subdivision_id')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        countries = [c.strip().upper() for c in args.countries.split(',')] if args.countries else None
+        build_pack(countries, args.pack)
+        return
+
+    start = time.perf_counter()
+    with GeometryPack.load(args.pack) as pack:
+        opened_ms = (time.perf_counter() - start) * 1000
+        if args.command == 'info':
+            print_info(pack, args.pack)
+            print(f"\n⏱️  Apertura: {opened_ms:.2f} ms")
+            return
+
+        index = pack.feature_index(args.subdivision_id)
+        if index is None:
+            print(f"❌ {args.subdivision_id} no está en el pack")
+            return
+        feature = pack.feature(index)
+        polygons = pack.polygons(index)
+        print(f"📌 {feature.subdivision_id} (nivel {feature.level}) en {pack.file_path(feature.file)}")
+        print(f"   bbox: {feature.bbox.round(5).tolist()}")
+        print(f"   {len(polygons)} polígonos, {sum(len(r) for p in polygons for r in p)} puntos")
+        for key, value in pack.properties(index).items():
+            print(f"   {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,28 +9,169 @@ Estructura esperada:
 - static/geojson/{COUNTRY}/{COUNTRY}.topojson          → Nivel 1
 - static/geojson/{COUNTRY}/{COUNTRY}.{N}.topojson      → Nivel 2 y 3
 
+Requisitos:
+    pip install numpy
+
 Uso:
-    python scripts/populate_subdivisions.py
+    python scripts/populate_subdivisions.py                 # Menú interactivo (solo en terminal)
+    python scripts/populate_subdivisions.py --countries ESP,FRA
+    python scripts/populate_subdivisions.py --all --jobs 8 --quiet
+    python scripts/populate_subdivisions.py --all --incremental   # Solo archivos cambiados
+    python scripts/populate_subdivisions.py --all --dry-run       # Parsea sin escribir en la BD
+    python scripts/populate_subdivisions.py --build-index   # + índice espacial para geocoding offline
+    python scripts/populate_subdivisions.py --db /ruta/otra.db
+
+Además del centroide, cada fila guarda el bbox (min/max lat/lon), el área en
+km², el subdivision_id del padre y is_lowest_level. Los índices de bbox y
+jerarquía se crean al final de la carga.
+
+Al terminar muestra por país el tiempo de parseo, decodificación de
+geometrías e inserción, y el número de filas.
 """
 
-import json
+import argparse
+import hashlib
 import sqlite3
-import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
-import math
+from typing import Dict, List, NamedTuple, Tuple, Optional, Set
+
+from topojson_decoder import (
+    TopologyDecoder, moments_centroid, polygons_area_km2, polygons_bbox, polygons_moments,
+    stream_topology,
+)
 
 # Configuración
 BASE_DIR = Path(__file__).parent.parent
 GEOJSON_DIR = BASE_DIR / "static" / "geojson"
 DB_PATH = BASE_DIR / "prisma" / "dev.db"
 
-def calculate_centroid(geometry) -> Tuple[float, float]:
+# Orden de columnas de cada fila generada por los procesadores de nivel
+SUBDIVISION_COLUMNS = (
+    'subdivision_id', 'level',
+    'level1_id', 'level2_id', 'level3_id',
+    'name', 'name_local', 'name_variant',
+    'type_english',
+    'hasc', 'iso', 'country_code',
+    'latitude', 'longitude',
+    'min_latitude', 'max_latitude', 'min_longitude', 'max_longitude',
+    'area_km2', 'parent_subdivision_id', 'is_lowest_level',
+)
+
+# Columnas calculadas que pueden faltar en una BD anterior a su migración.
+# Mismo tipo que el modelo Subdivision de prisma/schema.prisma
+SUBDIVISION_EXTRA_COLUMNS = {
+    'min_latitude': 'REAL',
+    'max_latitude': 'REAL',
+    'min_longitude': 'REAL',
+    'max_longitude': 'REAL',
+    'area_km2': 'REAL',
+    'parent_subdivision_id': 'TEXT',
+    'is_lowest_level': 'BOOLEAN NOT NULL DEFAULT false',
+}
+
+# Índices de consultas espaciales y jerárquicas (mismos nombres que los @@index
+# del modelo). Se borran antes de una carga completa y se crean al final, que
+# es mucho más rápido que mantenerlos fila a fila
+SUBDIVISION_INDEXES = {
+    'subdivisions_bbox_idx': '(min_latitude, max_latitude, min_longitude, max_longitude)',
+    'subdivisions_is_lowest_level_bbox_idx':
+        '(is_lowest_level, min_latitude, max_latitude, min_longitude, max_longitude)',
+    'subdivisions_parent_subdivision_id_idx': '(parent_subdivision_id)',
+}
+
+INSERT_SUBDIVISION_SQL = f"""
+    INSERT INTO subdivisions ({', '.join(SUBDIVISION_COLUMNS)})
+    VALUES ({', '.join('?' * len(SUBDIVISION_COLUMNS))})
+"""
+
+# UPSERT por subdivision_id para --incremental. Solo reescribe la fila si algún
+# valor cambió, y nunca cambia su id (al que apuntan votes.subdivision_id).
+# is_lowest_level depende de otros archivos: lo recalcula refresh_lowest_level
+UPSERT_COLUMNS = [c for c in SUBDIVISION_COLUMNS[1:] if c != 'is_lowest_level']
+UPSERT_SUBDIVISION_SQL = INSERT_SUBDIVISION_SQL + f"""
+    ON CONFLICT(subdivision_id) DO UPDATE SET
+        {', '.join(f'{c} = excluded.{c}' for c in UPSERT_COLUMNS)}
+    WHERE {' OR '.join(f'{c} IS NOT excluded.{c}' for c in UPSERT_COLUMNS)}
+"""
+
+# Mismo DDL que el modelo SubdivisionSourceFile de prisma/schema.prisma, para
+# poder usar --incremental aunque todavía no se haya hecho db push
+CREATE_MANIFEST_SQL = """
+    CREATE TABLE IF NOT EXISTS "subdivision_source_files" (
+        "path" TEXT NOT NULL PRIMARY KEY,
+        "country_iso" TEXT NOT NULL,
+        "size" INTEGER NOT NULL,
+        "mtime_ns" BIGINT NOT NULL,
+        "content_hash" TEXT NOT NULL,
+        "synced_at" DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS "subdivision_source_files_country_iso_idx"
+        ON "subdivision_source_files"("country_iso");
+"""
+
+SubdivisionRow = Tuple
+
+# Posiciones dentro de SubdivisionRow que se completan al final del país
+PARENT_COLUMN = SUBDIVISION_COLUMNS.index('parent_subdivision_id')
+LOWEST_LEVEL_COLUMN = SUBDIVISION_COLUMNS.index('is_lowest_level')
+
+# (min_lat, max_lat, min_lon, max_lon); todo None si la geometría no tiene puntos
+Bbox = Tuple[Optional[float], Optional[float], Optional[float], Optional[float]]
+EMPTY_BBOX: Bbox = (None, None, None, None)
+
+
+class StageClock:
+    """Acumula el tiempo de una etapa (p. ej. decodificación de geometrías) del país en curso"""
+    
+    def __init__(self):
+        self.seconds = 0.0
+    
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - start
+
+# Reconstrucción de anillos y centroides. Cada proceso del pool tiene el suyo
+decode_clock = StageClock()
+
+
+class SourceFile(NamedTuple):
+    """Estado de un archivo de static/geojson tal como se guarda en el manifest"""
+    path: str  # Relativo a GEOJSON_DIR, con '/'
+    size: int
+    mtime_ns: int
+    content_hash: str
+
+# Filas por llamada a executemany
+INSERT_BATCH_SIZE = 5000
+
+# Perfil de PRAGMAs para carga masiva. Solo se activa mientras se carga y se
+# restauran los valores originales al terminar (Prisma espera el modo por defecto)
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'temp_store': 'MEMORY',
+}
+
+def calculate_centroid(geometry, decoder: Optional[TopologyDecoder] = None) -> Tuple[float, float]:
     """
     Calcula el centroide de una geometría TopoJSON
     Retorna (latitude, longitude)
     """
-    # Si la geometría está vacía o es TopoJSON comprimido, retornar 0,0
+    # Geometría TopoJSON basada en arcos: centroide ponderado por área
+    if geometry and decoder is not None and ('arcs' in geometry or geometry.get('type') == 'GeometryCollection'):
+        with decode_clock.measure():
+            return decoder.centroid(geometry)
+    
+    # Si la geometría está vacía o no hay decodificador, retornar 0,0
     if not geometry or 'arcs' in geometry or 'type' not in geometry:
         return (0.0, 0.0)
     
@@ -64,370 +205,919 @@ def calculate_centroid(geometry) -> Tuple[float, float]:
     
     return (avg_lat, avg_lon)
 
-def get_db_connection():
+class GeometryMeasures(NamedTuple):
+    """Todo lo que se calcula de una geometría con una sola decodificación"""
+    moments: Tuple[float, float, float]  # Para acumular el centroide del país
+    centroid: Tuple[float, float]        # (latitude, longitude)
+    bbox: Bbox
+    area_km2: Optional[float]
+
+def measure_geometry(geometry, decoder: Optional[TopologyDecoder] = None) -> GeometryMeasures:
+    """
+    Centroide, bbox y área de una geometría TopoJSON. Las geometrías sin
+    arcos (GeoJSON embebido o vacías) solo tienen centroide aproximado
+    """
+    if not (geometry and decoder is not None
+            and ('arcs' in geometry or geometry.get('type') == 'GeometryCollection')):
+        return GeometryMeasures((0.0, 0.0, 0.0), calculate_centroid(geometry, decoder), EMPTY_BBOX, None)
+    
+    with decode_clock.measure():
+        polygons = decoder.polygons(geometry)
+        moments = polygons_moments(polygons)
+        bbox = polygons_bbox(polygons)
+        centroid = moments_centroid(*moments)
+        if centroid is None:
+            # Líneas, puntos o polígonos degenerados: mismo fallback que TopologyDecoder.centroid
+            centroid = decoder.centroid(geometry)
+        return GeometryMeasures(
+            moments,
+            centroid,
+            (bbox[1], bbox[3], bbox[0], bbox[2]) if bbox else EMPTY_BBOX,
+            polygons_area_km2(polygons) if polygons else None,
+        )
+
+def merge_bboxes(bboxes: List[Bbox]) -> Bbox:
+    """Bbox que contiene a todas las dadas (ignora las vacías)"""
+    bboxes = [b for b in bboxes if b[0] is not None]
+    if not bboxes:
+        return EMPTY_BBOX
+    return (
+        min(b[0] for b in bboxes), max(b[1] for b in bboxes),
+        min(b[2] for b in bboxes), max(b[3] for b in bboxes),
+    )
+
+def mark_lowest_levels(rows: List[SubdivisionRow]) -> List[SubdivisionRow]:
+    """is_lowest_level = ninguna otra fila del país la tiene como padre"""
+    parents = {row[PARENT_COLUMN] for row in rows}
+    return [
+        row[:LOWEST_LEVEL_COLUMN] + (row[0] not in parents,) + row[LOWEST_LEVEL_COLUMN + 1:]
+        for row in rows
+    ]
+
+def get_db_connection(db_path: Path = DB_PATH):
     """Conecta a la base de datos SQLite"""
-    if not DB_PATH.exists():
-        raise FileNotFoundError(f"Base de datos no encontrada en {DB_PATH}")
+    if not db_path.exists():
+        raise FileNotFoundError(f"Base de datos no encontrada en {db_path}")
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(db_path)
     conn.row_factory = sqlite3.Row
     # Asegurar que SQLite use UTF-8
     conn.execute("PRAGMA encoding = 'UTF-8'")
     return conn
 
-def clear_subdivisions(conn, country_iso: str):
-    """Elimina todas las subdivisiones de un país para repoblar"""
-    print(f"   🗑️  Limpiando subdivisiones existentes...")
-    # Eliminar país y todas sus subdivisiones
-    conn.execute("DELETE FROM subdivisions WHERE subdivision_id = ? OR subdivision_id LIKE ?", 
-                 (country_iso, f"{country_iso}.%"))
-    conn.commit()
+@contextmanager
+def bulk_load_pragmas(conn, pragmas: Dict[str, str] = BULK_LOAD_PRAGMAS):
+    """Activa `pragmas` (por defecto BULK_LOAD_PRAGMAS) durante la carga y restaura los valores previos"""
+    previous = {
+        name: conn.execute(f"PRAGMA {name}").fetchone()[0]
+        for name in pragmas
+    }
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    try:
+        yield conn
+    finally:
+        conn.commit()
+        for name, value in previous.items():
+            conn.execute(f"PRAGMA {name} = {value}")
 
-def create_country_level(conn, country_iso: str, topojson_path: Path) -> int:
+def clear_subdivisions(conn, country_iso: str, verbose: bool = True):
     """
-    Crea el registro de nivel 1 para el país (ej: ESP)
-    Retorna: db_id del país
+    Elimina todas las subdivisiones de un país para repoblar.
+    No hace commit: se ejecuta dentro de la transacción de write_country
     """
-    print(f"\n   📁 Creando nivel 1 (país): {country_iso}")
-    
-    with open(topojson_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
-    # Obtener nombre del país desde el primer registro
-    objects = data.get('objects', {})
-    if objects:
-        main_object = objects[list(objects.keys())[0]]
-        geometries = main_object.get('geometries', [])
-        if geometries:
-            props = geometries[0].get('properties', {})
-            country_name = props.get('country', props.get('CountryNew', country_iso))
-        else:
-            country_name = country_iso
-    else:
-        country_name = country_iso
+    if verbose:
+        print(f"   🗑️  Limpiando subdivisiones existentes...")
+    # Eliminar país y todas sus subdivisiones. El rango ['ESP.', 'ESP/') equivale a
+    # LIKE 'ESP.%' pero usa el índice único de subdivision_id en vez de recorrer la tabla
+    conn.execute("""
+        DELETE FROM subdivisions
+        WHERE subdivision_id = ? OR (subdivision_id >= ? AND subdivision_id < ?)
+    """, (country_iso, f"{country_iso}.", f"{country_iso}/"))
+
+def create_country_level(country_iso: str, country_name: str, lat: float, lon: float,
+                         verbose: bool = True, bbox: Bbox = EMPTY_BBOX,
+                         area_km2: Optional[float] = None) -> SubdivisionRow:
+    """
+    Genera la fila de nivel 1 para el país (ej: ESP)
+    Retorna: tupla de columnas lista para INSERT_SUBDIVISION_SQL
+    """
+    if verbose:
+        print(f"   ✅ {country_iso}: {country_name} (nivel 1)")
     
-    # Insertar país como nivel 1
-    cursor = conn.execute("""
-        INSERT INTO subdivisions (
-            subdivision_id, level,
-            level1_id, level2_id, level3_id,
-            name, name_local, name_variant,
-            type_english,
-            hasc, iso, country_code,
-            latitude, longitude
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+    return (
         country_iso, 1,  # Nivel 1 = país
         None, None, None,
         country_name, None, None,
         'Country',
         None, country_iso, None,
-        0.0, 0.0  # Coordenadas se pueden calcular después
-    ))
-    
-    country_db_id = cursor.lastrowid
-    print(f"   ✅ {country_iso}: {country_name} (nivel 1)")
-    conn.commit()
-    return country_db_id
+        lat, lon,
+        *bbox,
+        area_km2, None, False
+    )
 
-def process_level2(conn, country_iso: str, topojson_path: Path) -> Dict[str, int]:
+def build_level2_row(geom: Dict, decoder: TopologyDecoder,
+                     measures: Optional[GeometryMeasures] = None) -> Optional[SubdivisionRow]:
     """
-    Procesa nivel 2 desde {COUNTRY}.topojson (comunidades/estados)
-    Retorna: dict de subdivision_id -> db_id
+    Fila de nivel 2 (comunidad/estado) para una geometría de {COUNTRY}.topojson.
+    `measures` evita volver a decodificar si quien llama ya la midió
     """
-    print(f"\n   📁 Procesando nivel 2 (comunidades): {topojson_path.name}")
+    props = geom.get('properties', {})
     
-    with open(topojson_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    # Extraer información
+    id_1_full = props.get('ID_1')  # Viene como "ESP.1", "ESP.2", etc.
     
-    # Obtener el objeto principal (usualmente el primer objeto)
-    objects = data.get('objects', {})
-    if not objects:
-        print(f"   ⚠️  No hay objetos en el TopoJSON")
-        return {}
+    if not id_1_full:
+        print(f"   ⚠️  Geometría sin ID_1, saltando")
+        return None
+    
+    # El ID_1 ya viene en formato completo (ESP.1), usarlo directamente
+    subdivision_id = id_1_full
+    
+    # Mapear campos del schema
+    name = props.get('name_1', props.get('NAME_1', subdivision_id))
+    name_local = props.get('nl_name_1', props.get('NL_NAME_1'))
+    name_variant = props.get('varname_1', props.get('VARNAME_1'))
+    type_english = props.get('engtype_1', props.get('ENGTYPE_1'))
+    hasc = props.get('hasc_1', props.get('HASC_1'))
+    iso = props.get('iso_1', props.get('ISO_1'))
+    country_code = props.get('cc_1', props.get('CC_1'))
     
-    main_object = objects[list(objects.keys())[0]]
-    geometries = main_object.get('geometries', [])
+    # Extraer IDs numéricos (ESP.1 -> level1Id="1")
+    id_parts = id_1_full.split('.')
+    level1_id = id_parts[1] if len(id_parts) > 1 else id_parts[0]  # Extraer "1" de "ESP.1"
+    level2_id = None
+    level3_id = None
     
-    print(f"   📊 Encontradas {len(geometries)} subdivisiones nivel 2")
+    if measures is None:
+        measures = measure_geometry(geom.get('geometry', geom), decoder)
+    
+    # Calcular centroide (simplificado, usar coordenadas de propiedades si están)
+    lat = float(props.get('latitude', 0)) if props.get('latitude') else 0.0
+    lon = float(props.get('longitude', 0)) if props.get('longitude') else 0.0
+    
+    # Si no hay coordenadas en propiedades, usar el centroide de la geometría
+    if lat == 0 and lon == 0:
+        lat, lon = measures.centroid
+    
+    return (
+        subdivision_id, 2,  # NIVEL 2 (comunidades/estados)
+        level1_id, level2_id, level3_id,
+        name, name_local, name_variant,
+        type_english,
+        hasc, iso, country_code,
+        lat, lon,
+        *measures.bbox,
+        measures.area_km2, id_parts[0], False  # Padre: el país; is_lowest_level al final
+    )
+
+def process_main_file(country_iso: str, topojson_path: Path, verbose: bool = True) -> List[SubdivisionRow]:
+    """
+    Procesa {COUNTRY}.topojson en una sola pasada en streaming: genera el
+    nivel 1 (país) y el nivel 2 (comunidades/estados) a la vez.
+    Retorna: [fila del país] + filas de nivel 2
+    """
+    if verbose:
+        print(f"\n   📁 Procesando nivel 1 y 2: {topojson_path.name}")
     
-    subdivision_ids = {}
+    country_name = None
+    moments = [0.0, 0.0, 0.0]  # Área y momentos acumulados de todo el país
+    bboxes = []
+    area_km2 = 0.0
+    level2_rows = []
     
-    for geom in geometries:
+    for geom, decoder in stream_topology(topojson_path):
         props = geom.get('properties', {})
         
-        # Extraer información
-        id_1_full = props.get('ID_1')  # Viene como "ESP.1", "ESP.2", etc.
-        
-        if not id_1_full:
-            print(f"   ⚠️  Geometría sin ID_1, saltando")
-            continue
-        
-        # El ID_1 ya viene en formato completo (ESP.1), usarlo directamente
-        subdivision_id = id_1_full
-        
-        # Mapear campos del schema
-        name = props.get('name_1', props.get('NAME_1', subdivision_id))
-        name_local = props.get('nl_name_1', props.get('NL_NAME_1'))
-        name_variant = props.get('varname_1', props.get('VARNAME_1'))
-        type_english = props.get('engtype_1', props.get('ENGTYPE_1'))
-        hasc = props.get('hasc_1', props.get('HASC_1'))
-        iso = props.get('iso_1', props.get('ISO_1'))
-        country_code = props.get('cc_1', props.get('CC_1'))
-        
-        # Extraer IDs numéricos (ESP.1 -> level1Id="1")
-        id_parts = id_1_full.split('.')
-        level1_id = id_parts[1] if len(id_parts) > 1 else id_parts[0]  # Extraer "1" de "ESP.1"
-        level2_id = None
-        level3_id = None
-        
-        # Calcular centroide (simplificado, usar coordenadas de propiedades si están)
-        lat = float(props.get('latitude', 0)) if props.get('latitude') else 0.0
-        lon = float(props.get('longitude', 0)) if props.get('longitude') else 0.0
-        
-        # Si no hay coordenadas en propiedades, intentar calcular
-        if lat == 0 and lon == 0:
-            lat, lon = calculate_centroid(geom.get('geometry', {}))
-        
-        # Insertar en BD como nivel 2
-        cursor = conn.execute("""
-            INSERT INTO subdivisions (
-                subdivision_id, level,
-                level1_id, level2_id, level3_id,
-                name, name_local, name_variant,
-                type_english,
-                hasc, iso, country_code,
-                latitude, longitude
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            subdivision_id, 2,  # NIVEL 2 (comunidades/estados)
-            level1_id, level2_id, level3_id,
-            name, name_local, name_variant,
-            type_english,
-            hasc, iso, country_code,
-            lat, lon
-        ))
+        # Nombre del país desde el primer registro
+        if country_name is None:
+            country_name = props.get('country', props.get('CountryNew', country_iso))
         
-        db_id = cursor.lastrowid
-        subdivision_ids[subdivision_id] = db_id
+        # Centroide, bbox y área del país = los de todas sus subdivisiones juntas
+        measures = measure_geometry(geom.get('geometry', geom), decoder)
+        for i, value in enumerate(measures.moments):
+            moments[i] += value
+        bboxes.append(measures.bbox)
+        area_km2 += measures.area_km2 or 0.0
         
-        print(f"   ✅ {subdivision_id}: {name}")
+        row = build_level2_row(geom, decoder, measures)
+        if row:
+            level2_rows.append(row)
+            if verbose:
+                print(f"   ✅ {row[0]}: {row[5]}")
     
-    conn.commit()
-    return subdivision_ids
-
-def process_level3(conn, country_iso: str, level2_ids: Dict[str, int], geojson_dir: Path):
-    """
-    Procesa nivel 3 desde archivos {COUNTRY}.{N}.topojson (provincias)
-    """
-    print(f"\n   📁 Buscando archivos de nivel 3 (provincias)...")
+    if country_name is None:
+        print(f"   ⚠️  No hay geometrías en el TopoJSON")
+        country_name = country_iso
+    
+    lat, lon = moments_centroid(*moments) or (0.0, 0.0)
+    
+    if verbose:
+        print(f"   📊 Encontradas {len(level2_rows)} subdivisiones nivel 2")
     
+    country = create_country_level(country_iso, country_name, lat, lon, verbose,
+                                   merge_bboxes(bboxes), area_km2 or None)
+    return [country] + level2_rows
+
+def find_level3_files(country_iso: str, geojson_dir: Path) -> List[Path]:
+    """Archivos de nivel 3 de un país: {COUNTRY}.{N}.topojson, ordenados"""
     # Buscar archivos tipo ESP.1.topojson, ESP.2.topojson, etc.
     pattern = f"{country_iso}.*.topojson"
     level2_files = list(geojson_dir.glob(pattern))
     
     # Filtrar solo archivos con un número después del país
-    level2_files = [f for f in level2_files if f.stem != country_iso]
+    return sorted(f for f in level2_files if f.stem != country_iso)
+
+def build_level3_row(geom: Dict, decoder: TopologyDecoder,
+                     parent_id: Optional[str] = None) -> Optional[SubdivisionRow]:
+    """
+    Fila de nivel 3 (provincia) para una geometría de {COUNTRY}.{N}.topojson.
+    El padre es la subdivisión de nivel 2 del archivo (por defecto, la que
+    indica el propio ID_2: ESP.1.2 -> ESP.1)
+    """
+    props = geom.get('properties', {})
     
-    print(f"   📊 Encontrados {len(level2_files)} archivos de nivel 3")
+    # Extraer IDs (vienen completos: ESP.1.1, ESP.1.2, etc.)
+    id_2_full = props.get('ID_2')  # Formato: ESP.1.1, ESP.11.1, etc.
     
-    for topojson_path in sorted(level2_files):
-        # Extraer el nivel 1 del nombre del archivo (ej: ESP.1 -> 1)
-        parts = topojson_path.stem.split('.')
-        if len(parts) < 2:
-            continue
-        
-        level1_num = parts[1]
-        subdivision_l2_id = f"{country_iso}.{level1_num}"
-        
-        parent_id = level2_ids.get(subdivision_l2_id)
-        if not parent_id:
-            print(f"   ⚠️  No se encontró padre para {subdivision_l2_id}, saltando {topojson_path.name}")
-            continue
-        
+    # Todos estos son nivel 3 ahora
+    if not id_2_full:
+        # No tiene ID suficiente
+        return None
+    
+    # Es nivel 3 (provincia)
+    level = 3
+    subdivision_id = id_2_full
+    # Mapear campos del schema
+    name = props.get('name_2', props.get('NAME_2', subdivision_id))
+    name_local = props.get('nl_name_2', props.get('NL_NAME_2'))
+    name_variant = props.get('varname_2', props.get('VARNAME_2'))
+    type_english = props.get('engtype_2', props.get('ENGTYPE_2'))
+    hasc = props.get('hasc_2', props.get('HASC_2'))
+    iso = None
+    country_code = props.get('cc_2', props.get('CC_2'))
+    
+    # Extraer IDs numéricos de ESP.1.2 -> level1Id="1", level2Id="2"
+    parts = id_2_full.split('.')
+    level1_id = parts[1] if len(parts) > 1 else None
+    level2_id = parts[2] if len(parts) > 2 else None
+    level3_id = None
+    
+    measures = measure_geometry(geom.get('geometry', geom), decoder)
+    
+    # Calcular centroide
+    lat = float(props.get('latitude', 0)) if props.get('latitude') else 0.0
+    lon = float(props.get('longitude', 0)) if props.get('longitude') else 0.0
+    
+    if lat == 0 and lon == 0:
+        lat, lon = measures.centroid
+    
+    return (
+        subdivision_id, level,
+        level1_id, level2_id, level3_id,
+        name, name_local, name_variant,
+        type_english,
+        hasc, iso, country_code,
+        lat, lon,
+        *measures.bbox,
+        measures.area_km2, parent_id or '.'.join(parts[:2]), False
+    )
+
+def process_level3_file(country_iso: str, topojson_path: Path, level2_ids: Set[str],
+                        verbose: bool = True) -> List[SubdivisionRow]:
+    """
+    Procesa un archivo {COUNTRY}.{N}.topojson (provincias de una comunidad)
+    en streaming, geometría a geometría
+    Retorna: lista de filas para INSERT_SUBDIVISION_SQL
+    """
+    # Extraer el nivel 1 del nombre del archivo (ej: ESP.1 -> 1)
+    parts = topojson_path.stem.split('.')
+    if len(parts) < 2:
+        return []
+    
+    level1_num = parts[1]
+    subdivision_l2_id = f"{country_iso}.{level1_num}"
+    
+    if subdivision_l2_id not in level2_ids:
+        print(f"   ⚠️  No se encontró padre para {subdivision_l2_id}, saltando {topojson_path.name}")
+        return []
+    
+    if verbose:
         print(f"\n   📄 Procesando: {topojson_path.name}")
-        
-        with open(topojson_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        objects = data.get('objects', {})
-        if not objects:
-            continue
-        
-        main_object = objects[list(objects.keys())[0]]
-        geometries = main_object.get('geometries', [])
-        
-        print(f"      📊 Encontradas {len(geometries)} geometrías")
-        
-        level3_count = 0
-        
-        for geom in geometries:
-            props = geom.get('properties', {})
-            
-            # Extraer IDs (vienen completos: ESP.1.1, ESP.1.2, etc.)
-            id_2_full = props.get('ID_2')  # Formato: ESP.1.1, ESP.11.1, etc.
-            
-            # Todos estos son nivel 3 ahora
-            if id_2_full:
-                # Es nivel 3 (provincia)
-                level = 3
-                subdivision_id = id_2_full
-                # Mapear campos del schema
-                name = props.get('name_2', props.get('NAME_2', subdivision_id))
-                name_local = props.get('nl_name_2', props.get('NL_NAME_2'))
-                name_variant = props.get('varname_2', props.get('VARNAME_2'))
-                type_english = props.get('engtype_2', props.get('ENGTYPE_2'))
-                hasc = props.get('hasc_2', props.get('HASC_2'))
-                iso = None
-                country_code = props.get('cc_2', props.get('CC_2'))
-                
-                # Extraer IDs numéricos de ESP.1.2 -> level1Id="1", level2Id="2"
-                parts = id_2_full.split('.')
-                level1_id = parts[1] if len(parts) > 1 else None
-                level2_id = parts[2] if len(parts) > 2 else None
-                level3_id = None
-                
-                level3_count += 1
-            else:
-                # No tiene ID suficiente
-                continue
-            
-            # Calcular centroide
-            lat = float(props.get('latitude', 0)) if props.get('latitude') else 0.0
-            lon = float(props.get('longitude', 0)) if props.get('longitude') else 0.0
-            
-            if lat == 0 and lon == 0:
-                lat, lon = calculate_centroid(geom.get('geometry', {}))
-            
-            # Insertar en BD
-            try:
-                conn.execute("""
-                    INSERT INTO subdivisions (
-                        subdivision_id, level,
-                        level1_id, level2_id, level3_id,
-                        name, name_local, name_variant,
-                        type_english,
-                        hasc, iso, country_code,
-                        latitude, longitude
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    subdivision_id, level,
-                    level1_id, level2_id, level3_id,
-                    name, name_local, name_variant,
-                    type_english,
-                    hasc, iso, country_code,
-                    lat, lon
-                ))
-            except sqlite3.IntegrityError as e:
-                print(f"      ⚠️  Ya existe: {subdivision_id}")
-                continue
-        
-        conn.commit()
-        print(f"      ✅ Nivel 3: {level3_count}")
+    
+    rows = []
+    for geom, decoder in stream_topology(topojson_path):
+        row = build_level3_row(geom, decoder, subdivision_l2_id)
+        if row:
+            rows.append(row)
+    
+    if verbose:
+        print(f"      ✅ Nivel 3: {len(rows)}")
+    
+    return rows
 
-def process_country(conn, country_iso: str):
-    """Procesa un país completo"""
-    print(f"\n{'='*60}")
-    print(f"🌍 Procesando: {country_iso}")
-    print('='*60)
+def process_level3(country_iso: str, level2_ids: Set[str], geojson_dir: Path,
+                   verbose: bool = True) -> List[SubdivisionRow]:
+    """
+    Procesa nivel 3 desde archivos {COUNTRY}.{N}.topojson (provincias)
+    Retorna: lista de filas para INSERT_SUBDIVISION_SQL
+    """
+    if verbose:
+        print(f"\n   📁 Buscando archivos de nivel 3 (provincias)...")
+    
+    level2_files = find_level3_files(country_iso, geojson_dir)
+    
+    if verbose:
+        print(f"   📊 Encontrados {len(level2_files)} archivos de nivel 3")
     
+    rows = []
+    for topojson_path in level2_files:
+        rows.extend(process_level3_file(country_iso, topojson_path, level2_ids, verbose))
+    return rows
+
+def new_timing() -> Dict[str, float]:
+    """Contadores de tiempo (ms) y filas de un país para el resumen final"""
+    return {'parse_ms': 0.0, 'decode_ms': 0.0, 'insert_ms': 0.0, 'rows': 0}
+
+def collect_country_rows(country_iso: str, verbose: bool = True,
+                         timing: Optional[Dict[str, float]] = None) -> Optional[List[SubdivisionRow]]:
+    """
+    Lee y parsea todos los archivos de un país sin tocar la base de datos.
+    Es seguro ejecutarla en un proceso del pool (--jobs).
+    Si se pasa `timing` (ver new_timing) se rellenan parse_ms y decode_ms.
+    Retorna: filas en orden de inserción (país, nivel 2, nivel 3) o None si
+    faltan archivos
+    """
+    start = time.perf_counter()
+    decode_clock.seconds = 0.0
+    try:
+        return _collect_country_rows(country_iso, verbose)
+    finally:
+        if timing is not None:
+            elapsed = time.perf_counter() - start
+            timing['decode_ms'] += decode_clock.seconds * 1000
+            timing['parse_ms'] += (elapsed - decode_clock.seconds) * 1000
+
+def _collect_country_rows(country_iso: str, verbose: bool) -> Optional[List[SubdivisionRow]]:
     # Directorio del país
     country_dir = GEOJSON_DIR / country_iso
     if not country_dir.exists():
         print(f"❌ Directorio no encontrado: {country_dir}")
-        return
+        return None
     
     # Archivo principal del país
     main_file = country_dir / f"{country_iso}.topojson"
     if not main_file.exists():
         print(f"❌ Archivo principal no encontrado: {main_file}")
-        return
+        return None
+    
+    # Crear nivel 1 (país) y nivel 2 (comunidades/estados) con un único parseo
+    rows = process_main_file(country_iso, main_file, verbose)
+    level2_rows = rows[1:]
+    
+    if not level2_rows:
+        print(f"⚠️  No se procesaron subdivisiones nivel 2 ({country_iso})")
+        return rows
     
-    # Limpiar subdivisiones existentes
-    clear_subdivisions(conn, country_iso)
+    # Procesar nivel 3 (provincias)
+    level2_ids = {row[0] for row in level2_rows}
+    rows.extend(process_level3(country_iso, level2_ids, country_dir, verbose))
+    
+    return rows
+
+def dedupe_rows(rows: List[SubdivisionRow]) -> Tuple[List[SubdivisionRow], int]:
+    """
+    Descarta filas con subdivision_id repetido (gana la primera aparición).
+    Retorna: (filas únicas, número de descartadas)
+    """
+    seen = set()
+    unique = []
+    for row in rows:
+        if row[0] in seen:
+            continue
+        seen.add(row[0])
+        unique.append(row)
+    return unique, len(rows) - len(unique)
+
+def write_country(conn, country_iso: str, rows: List[SubdivisionRow], sources: List[SourceFile],
+                  verbose: bool = True, dry_run: bool = False) -> int:
+    """
+    Reemplaza las subdivisiones de un país en una única transacción:
+    DELETE + INSERT por lotes con executemany. Único punto que escribe en la BD.
+    `sources` (ver scan_country_files) llega ya calculado junto a las filas:
+    aquí solo se guarda en el manifest, sin leer ni hashear archivos.
+    Con dry_run no toca la BD.
+    Retorna: número de filas insertadas (o que se insertarían)
+    """
+    rows, duplicates = dedupe_rows(rows)
+    if duplicates:
+        print(f"      ⚠️  {country_iso}: {duplicates} subdivisiones repetidas ignoradas")
+    rows = mark_lowest_levels(rows)
     
-    # Crear nivel 1 (país)
-    country_id = create_country_level(conn, country_iso, main_file)
+    if dry_run:
+        return len(rows)
     
-    # Procesar nivel 2 (comunidades/estados)
-    level2_ids = process_level2(conn, country_iso, main_file)
+    try:
+        clear_subdivisions(conn, country_iso, verbose)
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            conn.executemany(INSERT_SUBDIVISION_SQL, rows[start:start + INSERT_BATCH_SIZE])
+        # Dejar constancia de lo cargado para que --incremental parta de aquí
+        record_manifest(conn, country_iso, sources)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     
-    if not level2_ids:
-        print(f"⚠️  No se procesaron subdivisiones nivel 2")
+    return len(rows)
+
+def file_hash(path: Path) -> str:
+    """SHA-256 del contenido de un archivo"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def country_source_paths(country_iso: str) -> List[Path]:
+    """Archivos de un país que alimentan subdivisions (principal + nivel 3)"""
+    country_dir = GEOJSON_DIR / country_iso
+    main_file = country_dir / f"{country_iso}.topojson"
+    if not main_file.exists():
+        return []
+    return [main_file] + find_level3_files(country_iso, country_dir)
+
+def ensure_subdivision_columns(conn, commit: bool = True):
+    """
+    Añade a subdivisions las columnas calculadas que le falten (BD sin migrar).
+    Con commit=False los ALTER quedan en una transacción abierta que el
+    llamador confirma o deshace (dry-run)
+    """
+    existing = {row['name'] for row in conn.execute("PRAGMA table_info(subdivisions)")}
+    missing = [name for name in SUBDIVISION_EXTRA_COLUMNS if name not in existing]
+    if not missing:
         return
+    if not conn.in_transaction:
+        # sqlite3 solo abre transacción implícita antes de DML, no de un ALTER
+        conn.execute("BEGIN")
+    for name in missing:
+        conn.execute(f'ALTER TABLE "subdivisions" ADD COLUMN "{name}" {SUBDIVISION_EXTRA_COLUMNS[name]}')
+    if commit:
+        conn.commit()
+
+def drop_subdivision_indexes(conn):
+    """Quita los índices de SUBDIVISION_INDEXES antes de una carga completa"""
+    for name in SUBDIVISION_INDEXES:
+        conn.execute(f'DROP INDEX IF EXISTS "{name}"')
+    conn.commit()
+
+def create_subdivision_indexes(conn):
+    """Crea los índices de SUBDIVISION_INDEXES y actualiza las estadísticas del planificador"""
+    for name, columns in SUBDIVISION_INDEXES.items():
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "subdivisions" {columns}')
+    conn.execute('ANALYZE "subdivisions"')
+    conn.commit()
+
+def refresh_lowest_level(conn, country_iso: str):
+    """
+    Recalcula is_lowest_level de un país desde la BD (sin commit). Lo usa
+    --incremental, donde un archivo de nivel 3 puede cambiar sin re-parsear
+    el de su padre
+    """
+    conn.execute("""
+        UPDATE subdivisions
+        SET is_lowest_level = NOT EXISTS (
+            SELECT 1 FROM subdivisions child
+            WHERE child.parent_subdivision_id = subdivisions.subdivision_id
+        )
+        WHERE subdivision_id = ? OR (subdivision_id >= ? AND subdivision_id < ?)
+    """, (country_iso, f"{country_iso}.", f"{country_iso}/"))
+
+def ensure_manifest_table(conn):
+    """Crea subdivision_source_files si la BD aún no la tiene"""
+    conn.executescript(CREATE_MANIFEST_SQL)
+
+def load_manifest(conn, country_iso: str) -> Dict[str, SourceFile]:
+    """Entradas del manifest de un país indexadas por path"""
+    try:
+        cursor = conn.execute("""
+            SELECT path, size, mtime_ns, content_hash
+            FROM subdivision_source_files
+            WHERE country_iso = ?
+        """, (country_iso,))
+    except sqlite3.OperationalError:
+        # --dry-run sobre una BD que aún no tiene la tabla: todo cuenta como nuevo
+        return {}
+    return {row['path']: SourceFile(*row) for row in cursor}
+
+def scan_source_file(path: Path, known: Optional[SourceFile] = None) -> SourceFile:
+    """
+    Estado actual de un archivo. Si tamaño y mtime coinciden con el manifest
+    se reutiliza el hash guardado sin volver a leer el archivo
+    """
+    stat = path.stat()
+    rel_path = path.relative_to(GEOJSON_DIR).as_posix()
+    if known and known.size == stat.st_size and known.mtime_ns == stat.st_mtime_ns:
+        return known
+    return SourceFile(rel_path, stat.st_size, stat.st_mtime_ns, file_hash(path))
+
+def scan_country_files(paths: List[Path], manifest: Dict[str, SourceFile]) -> List[SourceFile]:
+    """Estado actual de los archivos de un país, reutilizando hashes del manifest"""
+    return [scan_source_file(p, manifest.get(p.relative_to(GEOJSON_DIR).as_posix())) for p in paths]
+
+def record_manifest(conn, country_iso: str, files: List[SourceFile]):
+    """Guarda el estado de los archivos de un país (sin commit)"""
+    conn.execute("DELETE FROM subdivision_source_files WHERE country_iso = ?", (country_iso,))
+    conn.executemany("""
+        INSERT INTO subdivision_source_files (path, country_iso, size, mtime_ns, content_hash)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(f.path, country_iso, f.size, f.mtime_ns, f.content_hash) for f in files])
+
+def delete_stale_rows(conn, country_iso: str, prefix: str, level: int, keep: Set[str]) -> Tuple[int, int]:
+    """
+    Borra filas de un nivel bajo `prefix` que ya no aparecen en el archivo,
+    salvo las que tienen votos (votes.subdivision_id es onDelete: Restrict).
+    Retorna: (borradas, conservadas por tener votos)
+    """
+    cursor = conn.execute("""
+        SELECT s.id, s.subdivision_id,
+               EXISTS (SELECT 1 FROM votes v WHERE v.subdivision_id = s.id) AS has_votes
+        FROM subdivisions s
+        WHERE s.level = ? AND s.subdivision_id >= ? AND s.subdivision_id < ?
+    """, (level, prefix, prefix[:-1] + '/'))
     
-    # Procesar nivel 3 (provincias)
-    process_level3(conn, country_iso, level2_ids, country_dir)
+    stale = [row for row in cursor if row['subdivision_id'] not in keep]
+    deletable = [(row['id'],) for row in stale if not row['has_votes']]
+    conn.executemany("DELETE FROM subdivisions WHERE id = ?", deletable)
+    return len(deletable), len(stale) - len(deletable)
+
+def sync_country(conn, country_iso: str, verbose: bool = True, dry_run: bool = False,
+                 timing: Optional[Dict[str, float]] = None) -> Optional[Dict[str, int]]:
+    """
+    Sincronización incremental de un país: solo re-parsea los archivos cuyo
+    contenido cambió respecto al manifest y hace UPSERT de sus filas.
+    Nunca borra y reinserta todo, así los ids referenciados por votes se conservan.
+    Las provincias de archivos borrados o de comunidades que ya no están en el
+    archivo principal se eliminan (o se conservan y avisan si tienen votos).
+    Con dry_run los cambios se calculan dentro de la transacción y se deshacen.
+    Retorna: contadores {'changed_files', 'upserted', 'deleted', 'kept'} o None
+    """
+    if timing is None:
+        timing = new_timing()
+    paths = country_source_paths(country_iso)
+    if not paths:
+        print(f"❌ Archivo principal no encontrado para {country_iso}")
+        return None
     
-    # Mostrar resumen
+    manifest = load_manifest(conn, country_iso)
+    current = scan_country_files(paths, manifest)
+    changed = [
+        (path, source) for path, source in zip(paths, current)
+        if manifest.get(source.path, SourceFile('', 0, 0, '')).content_hash != source.content_hash
+    ]
+    # Archivos de nivel 3 cargados antes y que ya no existen
+    removed = sorted(set(manifest) - {source.path for source in current})
+    stats = {'changed_files': len(changed) + len(removed), 'upserted': 0, 'deleted': 0, 'kept': 0}
+    
+    if not changed and not removed:
+        # Solo pueden haber cambiado mtimes (touch, checkout): refrescar el manifest
+        if not dry_run and {f.path: f for f in current} != manifest:
+            record_manifest(conn, country_iso, current)
+            conn.commit()
+        return stats
+    
+    main_file = paths[0]
+    rows = []
+    stale_checks = []  # (prefijo, nivel, ids vigentes)
+    parse_start = time.perf_counter()
+    decode_clock.seconds = 0.0
+    
+    try:
+        cursor = conn.execute("""
+            SELECT subdivision_id FROM subdivisions
+            WHERE level = 2 AND subdivision_id >= ? AND subdivision_id < ?
+        """, (f"{country_iso}.", f"{country_iso}/"))
+        level2_ids = {row['subdivision_id'] for row in cursor}
+        
+        for rel_path in removed:
+            stale_checks.append((f"{Path(rel_path).stem}.", 3, set()))
+        
+        if changed and changed[0][0] == main_file:
+            rows.extend(process_main_file(country_iso, main_file, verbose))
+            previous_level2_ids = level2_ids
+            level2_ids = {row[0] for row in rows[1:]}
+            # Las provincias de una comunidad que desaparece se quedan sin padre
+            for parent_id in sorted(previous_level2_ids - level2_ids):
+                stale_checks.append((f"{parent_id}.", 3, set()))
+            stale_checks.append((f"{country_iso}.", 2, level2_ids))
+            # ...y las de una que aparece se cargan aunque su archivo no cambiara
+            new_parents = level2_ids - previous_level2_ids
+            changed += [
+                (path, source) for path, source in zip(paths[1:], current[1:])
+                if path.stem in new_parents and (path, source) not in changed
+            ]
+        
+        for path, _ in changed:
+            if path == main_file:
+                continue
+            file_rows = process_level3_file(country_iso, path, level2_ids, verbose)
+            rows.extend(file_rows)
+            stale_checks.append((f"{path.stem}.", 3, {row[0] for row in file_rows}))
+        
+        rows, duplicates = dedupe_rows(rows)
+        if duplicates:
+            print(f"      ⚠️  {country_iso}: {duplicates} subdivisiones repetidas ignoradas")
+        
+        insert_start = time.perf_counter()
+        timing['decode_ms'] += decode_clock.seconds * 1000
+        timing['parse_ms'] += (insert_start - parse_start - decode_clock.seconds) * 1000
+        
+        if dry_run:
+            # main no migra en dry-run: las columnas se añaden aquí y se deshacen con el resto
+            ensure_subdivision_columns(conn, commit=False)
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            cursor = conn.executemany(UPSERT_SUBDIVISION_SQL, rows[start:start + INSERT_BATCH_SIZE])
+            stats['upserted'] += max(cursor.rowcount, 0)
+        
+        for prefix, level, keep in stale_checks:
+            deleted, kept = delete_stale_rows(conn, country_iso, prefix, level, keep)
+            stats['deleted'] += deleted
+            stats['kept'] += kept
+        
+        refresh_lowest_level(conn, country_iso)
+        if dry_run:
+            # Sin manifest: en dry-run la tabla puede no existir todavía
+            conn.rollback()
+        else:
+            record_manifest(conn, country_iso, current)
+            conn.commit()
+        timing['insert_ms'] += (time.perf_counter() - insert_start) * 1000
+        timing['rows'] += stats['upserted']
+    except Exception:
+        conn.rollback()
+        raise
+    
+    if stats['kept']:
+        print(f"      ⚠️  {country_iso}: {stats['kept']} subdivisiones obsoletas conservadas porque tienen votos")
+    return stats
+
+def sync_countries(conn, countries: List[str], verbose: bool = True, dry_run: bool = False,
+                   timings: Optional[Dict[str, Dict[str, float]]] = None):
+    """Modo --incremental: sincroniza cada país y resume lo que cambió"""
+    totals = {'changed_files': 0, 'upserted': 0, 'deleted': 0, 'kept': 0}
+    if timings is None:
+        timings = {}
+    
+    for country_iso in countries:
+        try:
+            timing = timings.setdefault(country_iso, new_timing())
+            stats = sync_country(conn, country_iso, verbose, dry_run, timing)
+        except Exception as e:
+            print(f"\n❌ Error sincronizando {country_iso}: {e}")
+            traceback.print_exc()
+            continue
+        if not stats:
+            continue
+        for key in totals:
+            totals[key] += stats[key]
+        if stats['changed_files']:
+            print(f"   🔄 {country_iso}: {stats['changed_files']} archivos cambiados, "
+                  f"{stats['upserted']} filas actualizadas, {stats['deleted']} borradas")
+    
+    print(f"\n📋 Incremental: {totals['changed_files']} archivos cambiados, "
+          f"{totals['upserted']} filas actualizadas, {totals['deleted']} borradas, "
+          f"{totals['kept']} obsoletas con votos conservadas")
+
+def print_country_summary(conn, country_iso: str):
+    """Muestra el número de subdivisiones por nivel de un país"""
     cursor = conn.execute("""
         SELECT level, COUNT(*) as count 
         FROM subdivisions 
-        WHERE subdivision_id = ? OR subdivision_id LIKE ? 
+        WHERE subdivision_id = ? OR (subdivision_id >= ? AND subdivision_id < ?)
         GROUP BY level
-    """, (country_iso, f"{country_iso}.%"))
+    """, (country_iso, f"{country_iso}.", f"{country_iso}/"))
     
     print(f"\n📊 Resumen para {country_iso}:")
     for row in cursor:
         print(f"   Nivel {row['level']}: {row['count']} subdivisiones")
 
+def process_country(conn, country_iso: str, verbose: bool = True, dry_run: bool = False,
+                    timing: Optional[Dict[str, float]] = None):
+    """Procesa un país completo"""
+    if timing is None:
+        timing = new_timing()
+    
+    if verbose:
+        print(f"\n{'='*60}")
+        print(f"🌍 Procesando: {country_iso}")
+        print('='*60)
+    
+    # Estado de los archivos antes de parsearlos: si cambian entretanto,
+    # --incremental los verá distintos al manifest
+    sources = [] if dry_run else scan_country_files(
+        country_source_paths(country_iso), load_manifest(conn, country_iso)
+    )
+    rows = collect_country_rows(country_iso, verbose, timing)
+    if rows is None:
+        return
+    
+    # Limpiar subdivisiones existentes e insertar en la misma transacción
+    start = time.perf_counter()
+    timing['rows'] += write_country(conn, country_iso, rows, sources, verbose, dry_run)
+    timing['insert_ms'] += (time.perf_counter() - start) * 1000
+    
+    # Mostrar resumen
+    if verbose and not dry_run:
+        print_country_summary(conn, country_iso)
+
+def _collect_country_worker(country_iso: str, scan_sources: bool = True):
+    """
+    Envoltorio para el pool: nunca propaga excepciones al proceso escritor.
+    Los hashes del manifest también se calculan aquí, en paralelo, para que
+    el escritor no vuelva a leer los archivos
+    """
+    timing = new_timing()
+    try:
+        sources = scan_country_files(country_source_paths(country_iso), {}) if scan_sources else []
+        rows = collect_country_rows(country_iso, False, timing)
+        return country_iso, rows, sources, timing, None
+    except Exception:
+        return country_iso, None, [], timing, traceback.format_exc()
+
+def process_countries_parallel(conn, countries: List[str], jobs: int, dry_run: bool = False,
+                               timings: Optional[Dict[str, Dict[str, float]]] = None):
+    """
+    Parsea los países en un pool de procesos y escribe desde este proceso.
+    SQLite solo admite un escritor, así que los workers únicamente devuelven
+    tuplas y la inserción se hace aquí a medida que van terminando.
+    """
+    if timings is None:
+        timings = {}
+    print(f"\n⚙️  Parseando {len(countries)} países con {jobs} procesos")
+    
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_collect_country_worker, iso, not dry_run) for iso in countries]
+        
+        for done, future in enumerate(as_completed(futures), start=1):
+            country_iso, rows, sources, timing, error = future.result()
+            timings[country_iso] = timing
+            
+            if error:
+                print(f"\n❌ Error procesando {country_iso}:\n{error}")
+                continue
+            if rows is None:
+                continue
+            
+            start = time.perf_counter()
+            try:
+                inserted = write_country(conn, country_iso, rows, sources, verbose=False, dry_run=dry_run)
+            except sqlite3.Error as e:
+                print(f"\n❌ Error escribiendo {country_iso}: {e}")
+                continue
+            timing['insert_ms'] += (time.perf_counter() - start) * 1000
+            timing['rows'] += inserted
+            print(f"   [{done}/{len(countries)}] ✅ {country_iso}: {inserted} subdivisiones")
+
+def print_timing_summary(timings: Dict[str, Dict[str, float]]):
+    """Tabla de tiempos por país (ordenada por tiempo total) y totales"""
+    if not timings:
+        return
+    
+    def total(t):
+        return t['parse_ms'] + t['decode_ms'] + t['insert_ms']
+    
+    print("\n⏱️  Tiempos por país:")
+    print(f"{'País':<8} {'Parse ms':>10} {'Decode ms':>10} {'Insert ms':>10} {'Filas':>8}")
+    print("-"*60)
+    for country_iso, t in sorted(timings.items(), key=lambda item: total(item[1]), reverse=True):
+        print(f"{country_iso:<8} {t['parse_ms']:>10.1f} {t['decode_ms']:>10.1f} "
+              f"{t['insert_ms']:>10.1f} {int(t['rows']):>8}")
+    
+    sums = {key: sum(t[key] for t in timings.values()) for key in new_timing()}
+    print("-"*60)
+    print(f"{'TOTAL':<8} {sums['parse_ms']:>10.1f} {sums['decode_ms']:>10.1f} "
+          f"{sums['insert_ms']:>10.1f} {int(sums['rows']):>8}")
+
+def all_countries() -> List[str]:
+    """Todos los países con directorio en static/geojson"""
+    return sorted(d.name for d in GEOJSON_DIR.iterdir() if d.is_dir())
+
+def ask_countries() -> List[str]:
+    """Menú interactivo cuando se ejecuta sin --countries/--all desde una terminal"""
+    print("\n¿Qué países quieres procesar?")
+    print("1. Solo España (ESP)")
+    print("2. Todos los países")
+    print("3. Lista personalizada")
+    
+    choice = input("\nOpción (1/2/3) [1]: ").strip() or "1"
+    
+    if choice == "2":
+        return all_countries()
+    if choice == "3":
+        custom = input("Introduce códigos ISO3 separados por coma (ej: ESP,FRA,USA): ").strip()
+        return parse_country_list(custom)
+    return ['ESP']
+
+def parse_country_list(value: str) -> List[str]:
+    """'esp, fra' -> ['ESP', 'FRA']"""
+    return [c.strip().upper() for c in value.split(',') if c.strip()]
+
+def parse_args():
+    """Argumentos de línea de comandos"""
+    parser = argparse.ArgumentParser(description="Pobla la tabla subdivisions desde static/geojson")
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument('--countries', type=parse_country_list, metavar='ISO3,...',
+                           help="Países a procesar separados por coma (ej: ESP,FRA,USA)")
+    selection.add_argument('--all', action='store_true',
+                           help="Procesa todos los países de static/geojson")
+    parser.add_argument('--db', type=Path, default=DB_PATH,
+                        help=f"Base de datos SQLite (por defecto {DB_PATH})")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Procesos para parsear países en paralelo (por defecto 1: secuencial)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Solo re-parsea archivos cambiados (según subdivision_source_files) "
+                             "y hace UPSERT sin borrar filas con votos")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Parsea y calcula todo pero no escribe en la base de datos")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="Sin detalle por archivo/subdivisión; solo errores y resúmenes")
+    parser.add_argument('--build-index', action='store_true',
+                        help="Al terminar, reconstruye el índice espacial (scripts/subdivision_index.py)")
+    return parser.parse_args()
+
 def main():
     """Función principal"""
+    args = parse_args()
+    verbose = not args.quiet
+    
     print("\n🚀 SCRIPT DE POBLACIÓN DE SUBDIVISIONES")
     print("="*60)
     print(f"📂 Directorio GeoJSON: {GEOJSON_DIR}")
-    print(f"💾 Base de datos: {DB_PATH}")
+    print(f"💾 Base de datos: {args.db}")
+    if args.dry_run:
+        print("🧪 Modo dry-run: no se escribirá nada en la base de datos")
     print("="*60)
     
     # Validar que existen los directorios
     if not GEOJSON_DIR.exists():
         print(f"\n❌ ERROR: Directorio GeoJSON no encontrado: {GEOJSON_DIR}")
-        return
+        sys.exit(1)
     
-    if not DB_PATH.exists():
-        print(f"\n❌ ERROR: Base de datos no encontrada: {DB_PATH}")
+    if not args.db.exists():
+        print(f"\n❌ ERROR: Base de datos no encontrada: {args.db}")
         print("   Ejecuta primero: npm run db:migrate")
-        return
+        sys.exit(1)
+    
+    # Países: flags > menú interactivo (solo con terminal) > España por defecto
+    if args.all:
+        countries_to_process = all_countries()
+    elif args.countries:
+        countries_to_process = args.countries
+    elif sys.stdin.isatty():
+        countries_to_process = ask_countries()
+    else:
+        countries_to_process = ['ESP']
+    print(f"\n📋 Se procesarán {len(countries_to_process)} países")
     
     # Conectar a BD
-    conn = get_db_connection()
+    conn = get_db_connection(args.db)
+    if not args.dry_run:
+        ensure_manifest_table(conn)
+        ensure_subdivision_columns(conn)
+    if not args.dry_run and not args.incremental:
+        # En una carga completa los índices se crean al final, no fila a fila
+        drop_subdivision_indexes(conn)
+    
+    timings: Dict[str, Dict[str, float]] = {}
     
     try:
-        # Procesar España por defecto (puedes añadir más países)
-        countries_to_process = ['ESP']
-        
-        # Preguntar al usuario qué países procesar
-        print("\n¿Qué países quieres procesar?")
-        print("1. Solo España (ESP)")
-        print("2. Todos los países")
-        print("3. Lista personalizada")
-        
-        choice = input("\nOpción (1/2/3) [1]: ").strip() or "1"
+        # Procesar cada país (dry-run no cambia journal_mode ni synchronous del fichero)
+        with nullcontext(conn) if args.dry_run else bulk_load_pragmas(conn):
+            if args.incremental:
+                sync_countries(conn, countries_to_process, verbose, args.dry_run, timings)
+            elif args.jobs > 1 and len(countries_to_process) > 1:
+                process_countries_parallel(conn, countries_to_process, args.jobs, args.dry_run, timings)
+            else:
+                for country_iso in countries_to_process:
+                    try:
+                        timing = timings.setdefault(country_iso, new_timing())
+                        process_country(conn, country_iso, verbose, args.dry_run, timing)
+                    except Exception as e:
+                        print(f"\n❌ Error procesando {country_iso}: {e}")
+                        traceback.print_exc()
+                        continue
         
-        if choice == "2":
-            # Obtener todos los países de los directorios
-            countries_to_process = [d.name for d in GEOJSON_DIR.iterdir() if d.is_dir()]
-            countries_to_process.sort()
-            print(f"\n📋 Se procesarán {len(countries_to_process)} países")
-        elif choice == "3":
-            custom = input("Introduce códigos ISO3 separados por coma (ej: ESP,FRA,USA): ").strip()
-            countries_to_process = [c.strip().upper() for c in custom.split(',')]
-        
-        # Procesar cada país
-        for country_iso in countries_to_process:
-            try:
-                process_country(conn, country_iso)
-            except Exception as e:
-                print(f"\n❌ Error procesando {country_iso}: {e}")
-                import traceback
-                traceback.print_exc()
-                continue
+        if not args.dry_run:
+            start = time.perf_counter()
+            create_subdivision_indexes(conn)
+            print(f"\n🗂️  Índices de bbox y jerarquía creados en {time.perf_counter() - start:.1f}s")
         
         # Resumen final
         print("\n" + "="*60)
-        print("✅ PROCESO COMPLETADO")
+        print("✅ PROCESO COMPLETADO" + (" (dry-run, sin cambios en la BD)" if args.dry_run else ""))
         print("="*60)
         
+        print_timing_summary(timings)
+        
         # Obtener resumen por país procesado
         summary_data = []
         for country_iso in countries_to_process:
@@ -437,8 +1127,8 @@ def main():
                     COUNT(CASE WHEN level = 2 THEN 1 END) as level2,
                     COUNT(CASE WHEN level = 3 THEN 1 END) as level3
                 FROM subdivisions
-                WHERE subdivision_id = ? OR subdivision_id LIKE ?
-            """, (country_iso, f"{country_iso}.%"))
+                WHERE subdivision_id = ? OR (subdivision_id >= ? AND subdivision_id < ?)
+            """, (country_iso, f"{country_iso}.", f"{country_iso}/"))
             row = cursor.fetchone()
             if row:
                 summary_data.append({
@@ -448,11 +1138,18 @@ def main():
                     'level3': row['level3']
                 })
         
-        print("\n📊 Resumen por país:")
-        print(f"{'País':<20} {'Nivel 1':<10} {'Nivel 2':<10} {'Nivel 3':<10}")
-        print("-"*60)
-        for row in summary_data:
-            print(f"{row['iso3']:<20} {row['level1']:<10} {row['level2']:<10} {row['level3']:<10}")
+        if verbose:
+            print("\n📊 Resumen por país:")
+            print(f"{'País':<20} {'Nivel 1':<10} {'Nivel 2':<10} {'Nivel 3':<10}")
+            print("-"*60)
+            for row in summary_data:
+                print(f"{row['iso3']:<20} {row['level1']:<10} {row['level2']:<10} {row['level3']:<10}")
+        
+        if args.build_index:
+            # Importación diferida: subdivision_index importa este módulo
+            from subdivision_index import build_index
+            print()
+            build_index()
         
         print("\n💡 Siguiente paso:")
         print("   Ejecuta: npm run db:debug-geocode")
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Índice espacial de subdivisiones para geocodificar votos sin servicios externos
+
+Decodifica los polígonos de static/geojson (nivel 2 de {COUNTRY}.topojson y
+nivel 3 de {COUNTRY}.{N}.topojson), los organiza en un árbol de bounding
+boxes empaquetado con STR (Sort-Tile-Recursive) y lo guarda en disco.
+La consulta filtra por bbox recorriendo el árbol y confirma con un test
+exacto de punto en polígono (regla par-impar, así los huecos quedan fuera).
+
+Requisitos:
+    pip install numpy
+
+Uso:
+    python scripts/subdivision_index.py build
+    python scripts/subdivision_index.py locate 40.4168 -3.7038
+
+    from subdivision_index import SubdivisionIndex
+    index = SubdivisionIndex.load()
+    index.locate(40.4168, -3.7038)            # -> 'ESP.8.1'
+    index.locate_many(lats, lons)             # arrays NumPy -> array de ids
+"""
+
+import argparse
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from populate_subdivisions import BASE_DIR, GEOJSON_DIR, find_level3_files
+from topojson_decoder import close_ring, stream_topology
+
+INDEX_PATH = BASE_DIR / "prisma" / "subdivisions.index.npz"
+
+# Hijos por nodo del árbol STR
+NODE_CAPACITY = 16
+
+# Máximo de celdas punto×arista evaluadas de golpe en el test de polígono
+PIP_CHUNK_CELLS = 4_000_000
+
+
+# ============================================================================
+# CONSTRUCCIÓN
+# ============================================================================
+
+class _FeatureBuffer:
+    """Acumula anillos y metadatos de las geometrías durante la construcción"""
+
+    def __init__(self):
+        self.ids: List[str] = []
+        self.levels: List[int] = []
+        self.bboxes: List[Tuple[float, float, float, float]] = []
+        self.feature_rings: List[int] = [0]
+        self.ring_sizes: List[int] = []
+        self.rings: List[np.ndarray] = []
+        self._seen = set()
+
+    def add(self, subdivision_id: str, level: int, polygons) -> bool:
+        # Igual que el loader: si un id se repite entre archivos gana el primero
+        if subdivision_id in self._seen:
+            return False
+        rings = [close_ring(ring) for polygon in polygons for ring in polygon if len(ring) >= 3]
+        if not rings:
+            return False
+        points = np.concatenate(rings)
+        min_lon, min_lat = points.min(axis=0)
+        max_lon, max_lat = points.max(axis=0)
+        self._seen.add(subdivision_id)
+        self.ids.append(subdivision_id)
+        self.levels.append(level)
+        self.bboxes.append((min_lon, min_lat, max_lon, max_lat))
+        self.rings.extend(rings)
+        self.ring_sizes.extend(len(r) for r in rings)
+        self.feature_rings.append(len(self.ring_sizes))
+        return True
+
+
+def iter_country_features(country_iso: str) -> Iterable[Tuple[str, int, list]]:
+    """
+    (subdivision_id, nivel, polígonos) de un país, con los mismos criterios
+    que populate_subdivisions.py (ID_1 en el archivo principal, ID_2 en los de
+    nivel 3 y solo archivos cuyo padre existe)
+    """
+    country_dir = GEOJSON_DIR / country_iso
+    main_file = country_dir / f"{country_iso}.topojson"
+    if not main_file.exists():
+        return
+
+    level2_ids = set()
+    for geom, decoder in stream_topology(main_file):
+        subdivision_id = geom.get('properties', {}).get('ID_1')
+        if subdivision_id:
+            level2_ids.add(subdivision_id)
+            yield subdivision_id, 2, decoder.polygons(geom)
+
+    for path in find_level3_files(country_iso, country_dir):
+        parts = path.stem.split('.')
+        if len(parts) < 2 or f"{country_iso}.{parts[1]}" not in level2_ids:
+            continue
+        for geom, decoder in stream_topology(path):
+            subdivision_id = geom.get('properties', {}).get('ID_2')
+            if subdivision_id:
+                yield subdivision_id, 3, decoder.polygons(geom)
+
+
+def str_pack(bboxes: np.ndarray, capacity: int = NODE_CAPACITY) -> Tuple[np.ndarray, List[Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Empaqueta bounding boxes con Sort-Tile-Recursive: las hojas se ordenan
+    en franjas verticales por x y dentro de cada franja por y. Los niveles
+    superiores agrupan nodos consecutivos de ese orden, que ya son vecinos.
+    Retorna: (orden de las hojas, niveles del árbol de abajo arriba). Cada
+    nivel es (bboxes de sus nodos, punteros) donde los hijos del nodo i son
+    las entradas [ptr[i], ptr[i+1]) del nivel inferior (o de las hojas)
+    """
+    count = len(bboxes)
+    centers = (bboxes[:, :2] + bboxes[:, 2:]) / 2
+    slab_size = capacity * int(np.ceil(np.sqrt(-(-count // capacity))))
+    by_x = np.argsort(centers[:, 0], kind='stable')
+    leaf_order = np.concatenate([
+        slab[np.argsort(centers[slab, 1], kind='stable')]
+        for slab in (by_x[i:i + slab_size] for i in range(0, count, slab_size))
+    ])
+
+    entries = bboxes[leaf_order]
+    levels = []
+    while True:
+        ptr = np.append(np.arange(0, len(entries), capacity), len(entries))
+        node_boxes = np.column_stack([
+            np.minimum.reduceat(entries[:, 0], ptr[:-1]),
+            np.minimum.reduceat(entries[:, 1], ptr[:-1]),
+            np.maximum.reduceat(entries[:, 2], ptr[:-1]),
+            np.maximum.reduceat(entries[:, 3], ptr[:-1]),
+        ])
+        levels.append((node_boxes, ptr))
+        if len(node_boxes) == 1:
+            return leaf_order, levels
+        entries = node_boxes
+
+
+def build_index(countries: Optional[List[str]] = None, path: Path = INDEX_PATH,
+                verbose: bool = True) -> Dict[str, float]:
+    """
+    Construye y guarda el índice espacial.
+    Retorna: estadísticas {'features', 'points', 'seconds'}
+    """
+    start = time.perf_counter()
+    if countries is None:
+        countries = sorted(d.name for d in GEOJSON_DIR.iterdir() if d.is_dir())
+
+    buffer = _FeatureBuffer()
+    for country_iso in countries:
+        for subdivision_id, level, polygons in iter_country_features(country_iso):
+            buffer.add(subdivision_id, level, polygons)
+
+    if not buffer.ids:
+        raise ValueError("No se encontraron geometrías para indexar")
+
+    bboxes = np.asarray(buffer.bboxes, dtype=np.float64)
+    leaf_order, levels = str_pack(bboxes)
+
+    ring_offsets = np.zeros(len(buffer.ring_sizes) + 1, dtype=np.int64)
+    np.cumsum(buffer.ring_sizes, out=ring_offsets[1:])
+
+    arrays = {
+        'ids': np.asarray(buffer.ids),
+        'levels': np.asarray(buffer.levels, dtype=np.int8),
+        'bboxes': bboxes,
+        'feature_rings': np.asarray(buffer.feature_rings, dtype=np.int64),
+        'ring_offsets': ring_offsets,
+        'coords': np.concatenate(buffer.rings),
+        'leaf_order': leaf_order.astype(np.int64),
+        'tree_depth': np.int64(len(levels)),
+    }
+    for depth, (node_boxes, ptr) in enumerate(levels):
+        arrays[f'tree_boxes_{depth}'] = node_boxes
+        arrays[f'tree_ptr_{depth}'] = ptr.astype(np.int64)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp.npz')
+    np.savez(tmp_path, **arrays)
+    tmp_path.replace(path)
+
+    stats = {
+        'features': len(buffer.ids),
+        'points': int(ring_offsets[-1]),
+        'seconds': time.perf_counter() - start,
+    }
+    if verbose:
+        print(f"   🗺️  Índice espacial: {stats['features']} subdivisiones, "
+              f"{stats['points']} puntos en {stats['seconds']:.1f}s -> {path}")
+    return stats
+
+
+# ============================================================================
+# CONSULTA
+# ============================================================================
+
+class SubdivisionIndex:
+    """Índice cargado desde disco; localiza puntos (lat, lon) en subdivisiones"""
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.ids = arrays['ids']
+        self.levels = arrays['levels']
+        self.bboxes = arrays['bboxes']
+        self.feature_rings = arrays['feature_rings']
+        self.ring_offsets = arrays['ring_offsets']
+        self.coords = arrays['coords']
+        self.leaf_order = arrays['leaf_order']
+        depth = int(arrays['tree_depth'])
+        self.tree = [(arrays[f'tree_boxes_{d}'], arrays[f'tree_ptr_{d}']) for d in range(depth)]
+        self._edges: Dict[int, Tuple[np.ndarray, ...]] = {}
+
+    @classmethod
+    def load(cls, path: Path = INDEX_PATH) -> 'SubdivisionIndex':
+        if not path.exists():
+            raise FileNotFoundError(
+                f"Índice espacial no encontrado en {path}. "
+                "Ejecuta: python scripts/subdivision_index.py build"
+            )
+        with np.load(path) as data:
+            return cls({key: data[key] for key in data.files})
+
+    def locate(self, lat: float, lon: float) -> Optional[str]:
+        """subdivision_id más específico que contiene el punto, o None"""
+        result = self.locate_indices(np.array([lat]), np.array([lon]))[0]
+        return str(self.ids[result]) if result >= 0 else None
+
+    def locate_many(self, lats, lons) -> np.ndarray:
+        """Versión por lotes de locate: array de subdivision_id ('' si no hay)"""
+        indices = self.locate_indices(lats, lons)
+        result = np.full(len(indices), '', dtype=self.ids.dtype)
+        found = indices >= 0
+        result[found] = self.ids[indices[found]]
+        return result
+
+    def locate_indices(self, lats, lons) -> np.ndarray:
+        """
+        Índice de geometría (posición en self.ids) que contiene cada punto, -1
+        si ninguna. Si varias lo contienen gana la de nivel más profundo.
+        Recorre el árbol con el subconjunto de puntos que cae en cada nodo,
+        así el coste es proporcional a los nodos realmente visitados
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        best = np.full(len(lats), -1, dtype=np.int64)
+        best_level = np.full(len(lats), -1, dtype=np.int8)
+        if not len(lats):
+            return best
+
+        root_depth = len(self.tree) - 1
+        stack = [(root_depth, 0, np.arange(len(lats)))]
+        while stack:
+            depth, node, points = stack.pop()
+            _, ptr = self.tree[depth]
+            first, last = ptr[node], ptr[node + 1]
+            child_boxes = self.tree[depth - 1][0] if depth > 0 else None
+
+            for child in range(first, last):
+                if depth > 0:
+                    box = child_boxes[child]
+                else:
+                    feature = self.leaf_order[child]
+                    box = self.bboxes[feature]
+                px, py = lons[points], lats[points]
+                inside = points[(px >= box[0]) & (px <= box[2]) & (py >= box[1]) & (py <= box[3])]
+                if not len(inside):
+                    continue
+                if depth > 0:
+                    stack.append((depth - 1, child, inside))
+                    continue
+                level = self.levels[feature]
+                candidates = inside[best_level[inside] < level]
+                if not len(candidates):
+                    continue
+                hits = candidates[self._contains(feature, lons[candidates], lats[candidates])]
+                best[hits] = feature
+                best_level[hits] = level
+        return best
+
+    def _feature_edges(self, feature: int) -> Tuple[np.ndarray, ...]:
+        """Aristas (x1, y1, x2, y2) de todos los anillos de una geometría, cacheadas"""
+        edges = self._edges.get(feature)
+        if edges is None:
+            first, last = self.feature_rings[feature], self.feature_rings[feature + 1]
+            starts = self.ring_offsets[first:last]
+            ends = self.ring_offsets[first + 1:last + 1]
+            a = np.concatenate([self.coords[s:e - 1] for s, e in zip(starts, ends)])
+            b = np.concatenate([self.coords[s + 1:e] for s, e in zip(starts, ends)])
+            edges = (a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+            self._edges[feature] = edges
+        return edges
+
+    def _contains(self, feature: int, px: np.ndarray, py: np.ndarray) -> np.ndarray:
+        """Test par-impar vectorizado de varios puntos contra una geometría"""
+        x1, y1, x2, y2 = self._feature_edges(feature)
+        result = np.zeros(len(px), dtype=bool)
+        step = max(1, PIP_CHUNK_CELLS // max(len(x1), 1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for start in range(0, len(px), step):
+                qx = px[start:start + step, None]
+                qy = py[start:start + step, None]
+                straddles = (y1 > qy) != (y2 > qy)
+                cross_x = x1 + (qy - y1) * (x2 - x1) / (y2 - y1)
+                crossings = np.count_nonzero(straddles & (qx < cross_x), axis=1)
+                result[start:start + step] = (crossings % 2) == 1
+        return result
+
+
+# ============================================================================
+# CLI
+# ============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Índice espacial de subdivisiones")
+    parser.add_argument('--index', type=Path, default=INDEX_PATH, help="Ruta del índice")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help="Construye el índice desde static/geojson")
+    build.add_argument('--countries', help="Códigos ISO3 separados por coma (por defecto todos)")
+
+    locate = commands.add_parser('locate', help="Localiza un punto")
+    locate.add_argument('lat', type=float)
+    locate.add_argument('lon', type=float)
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        countries = [c.strip().upper() for c in args.countries.split(',')] if args.countries else None
+        build_index(countries, args.index)
+    else:
+        index = SubdivisionIndex.load(args.index)
+        print(index.locate(args.lat, args.lon) or "❌ Fuera de cualquier subdivisión")
+
+
+if __name__ == "__main__":
+    main()
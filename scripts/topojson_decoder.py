@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""
+Decodificador TopoJSON vectorizado con NumPy
+
+Convierte los arcos cuantizados de un Topology en coordenadas absolutas
+(lon, lat) y reconstruye anillos/polígonos a partir de referencias de arcos,
+incluidas las negativas (~i = arco i invertido).
+
+Lo usan populate_subdivisions.py y el resto de herramientas de geometría de
+scripts/. Requiere: pip install numpy
+
+Uso:
+    from topojson_decoder import TopologyDecoder
+
+    decoder = TopologyDecoder(data)          # data = json.load(...) del .topojson
+    lat, lon = decoder.centroid(geometry)    # geometry = objects.X.geometries[i]
+
+    # O sin cargar el archivo entero en memoria:
+    for geometry, decoder in stream_topology(path):
+        lat, lon = decoder.centroid(geometry)
+"""
+
+import json
+from array import array
+from itertools import chain
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# Lista de polígonos; cada polígono es una lista de anillos (arrays Nx2 lon/lat).
+# El primer anillo de cada polígono es el exterior y el resto son huecos
+Polygons = List[List[np.ndarray]]
+
+EMPTY_RING = np.empty((0, 2), dtype=np.float64)
+
+# Radio medio de la Tierra (IUGG), para áreas en km²
+EARTH_RADIUS_KM = 6371.0088
+
+
+def decode_arcs(arcs: List[list], transform: Optional[Dict] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decodifica todos los arcos de una topología de una sola vez.
+
+    Con transform los puntos vienen cuantizados y codificados en delta: se
+    hace una suma acumulada por arco y se aplica scale/translate. Sin transform
+    las coordenadas ya son absolutas.
+
+    Retorna: (coords Nx2 float64 con todos los puntos, offsets de tamaño
+    len(arcs)+1 tal que el arco i es coords[offsets[i]:offsets[i+1]])
+    """
+    lengths = np.fromiter((len(arc) for arc in arcs), dtype=np.int64, count=len(arcs))
+
+    # Algunos generadores añaden una tercera coordenada (z); solo usamos x, y
+    flat = np.fromiter(
+        chain.from_iterable((point[0], point[1]) for point in chain.from_iterable(arcs)),
+        dtype=np.float64,
+        count=int(lengths.sum()) * 2,
+    )
+    return decode_flat_arcs(flat, lengths, transform)
+
+
+def decode_flat_arcs(flat: np.ndarray, lengths: np.ndarray,
+                     transform: Optional[Dict] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Igual que decode_arcs pero partiendo de los puntos ya aplanados
+    (x0, y0, x1, y1, ...) y del número de puntos de cada arco
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    if offsets[-1] == 0:
+        return EMPTY_RING.copy(), offsets
+
+    flat = np.asarray(flat, dtype=np.float64).reshape(-1, 2)
+    if not transform:
+        return flat, offsets
+
+    # Delta-decoding: suma acumulada global menos el acumulado previo a cada arco
+    cumulative = np.cumsum(flat, axis=0)
+    starts = offsets[:-1]
+    base = np.zeros((len(lengths), 2), dtype=np.float64)
+    nonzero = starts > 0
+    base[nonzero] = cumulative[starts[nonzero] - 1]
+    coords = cumulative - np.repeat(base, lengths, axis=0)
+
+    scale = np.asarray(transform.get('scale', (1.0, 1.0)), dtype=np.float64)
+    translate = np.asarray(transform.get('translate', (0.0, 0.0)), dtype=np.float64)
+    coords *= scale
+    coords += translate
+    return coords, offsets
+
+
+class TopologyDecoder:
+    """Decodifica geometrías de un Topology ya cargado (dict de json.load)"""
+
+    def __init__(self, topology: Dict):
+        self.transform = topology.get('transform')
+        self.coords, self.offsets = decode_arcs(topology.get('arcs', []), self.transform)
+
+    @classmethod
+    def from_flat(cls, flat: np.ndarray, lengths: np.ndarray,
+                  transform: Optional[Dict] = None) -> 'TopologyDecoder':
+        """Crea el decodificador a partir de arcos ya aplanados (ver stream_topology)"""
+        decoder = cls.__new__(cls)
+        decoder.transform = transform
+        decoder.coords, decoder.offsets = decode_flat_arcs(flat, lengths, transform)
+        return decoder
+
+    def arc(self, index: int) -> np.ndarray:
+        """Coordenadas de un arco; los índices negativos (~i) devuelven el arco i invertido"""
+        if index < 0:
+            i = ~index
+            return self.coords[self.offsets[i]:self.offsets[i + 1]][::-1]
+        return self.coords[self.offsets[index]:self.offsets[index + 1]]
+
+    def ring(self, arc_indices: Iterable[int]) -> np.ndarray:
+        """
+        Une los arcos de un anillo. Cada arco empieza en el último punto del
+        anterior, así que ese punto repetido se descarta
+        """
+        parts = []
+        for n, index in enumerate(arc_indices):
+            coords = self.arc(index)
+            parts.append(coords if n == 0 else coords[1:])
+        if not parts:
+            return EMPTY_RING
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    def point(self, position: list) -> np.ndarray:
+        """Posición de un Point/MultiPoint (cuantizada pero sin delta)"""
+        xy = np.asarray(position[:2], dtype=np.float64)
+        if self.transform:
+            xy = xy * np.asarray(self.transform['scale']) + np.asarray(self.transform['translate'])
+        return xy
+
+    def polygons(self, geometry: Dict) -> Polygons:
+        """Polígonos (con sus anillos) de una geometría Polygon/MultiPolygon/GeometryCollection"""
+        geom_type = geometry.get('type')
+        arcs = geometry.get('arcs') or []
+
+        if geom_type == 'Polygon':
+            return [[self.ring(ring) for ring in arcs]]
+        if geom_type == 'MultiPolygon':
+            return [[self.ring(ring) for ring in polygon] for polygon in arcs]
+        if geom_type == 'GeometryCollection':
+            return [p for child in geometry.get('geometries', []) for p in self.polygons(child)]
+        return []
+
+    def points(self, geometry: Dict) -> np.ndarray:
+        """Todos los vértices de la geometría (Nx2), útil para bbox o como fallback"""
+        geom_type = geometry.get('type')
+        if geom_type == 'Point':
+            return self.point(geometry['coordinates']).reshape(1, 2)
+        if geom_type == 'MultiPoint':
+            return np.array([self.point(p) for p in geometry.get('coordinates', [])]).reshape(-1, 2)
+        if geom_type in ('LineString', 'MultiLineString'):
+            arcs = geometry.get('arcs') or []
+            lines = [arcs] if geom_type == 'LineString' else arcs
+            rings = [self.ring(line) for line in lines]
+        else:
+            rings = [ring for polygon in self.polygons(geometry) for ring in polygon]
+        rings = [r for r in rings if len(r)]
+        return np.concatenate(rings) if rings else EMPTY_RING
+
+    def moments(self, geometry: Dict) -> Tuple[float, float, float]:
+        """
+        (área, momento_x, momento_y) de la geometría. Se pueden sumar entre
+        geometrías para obtener el centroide de un conjunto (ver moments_centroid)
+        """
+        return polygons_moments(self.polygons(geometry))
+
+    def centroid(self, geometry: Dict) -> Tuple[float, float]:
+        """
+        Centroide ponderado por área de todos los polígonos de la geometría.
+        Los huecos restan área. Si el área es nula (líneas, puntos o
+        polígonos degenerados) usa la media de los vértices.
+        Retorna (latitude, longitude); (0.0, 0.0) si la geometría está vacía
+        """
+        polygons = self.polygons(geometry)
+        result = polygons_centroid(polygons) if polygons else None
+        if result is not None:
+            return result
+
+        points = self.points(geometry)
+        if not len(points):
+            return (0.0, 0.0)
+        lon, lat = points.mean(axis=0)
+        return (float(lat), float(lon))
+
+
+def ring_moments(rings: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Área con signo y momentos (shoelace) de varios anillos a la vez.
+    Retorna arrays (area, momento_x, momento_y) con un valor por anillo
+    """
+    rings = [close_ring(r) for r in rings]
+    sizes = np.fromiter((max(len(r) - 1, 0) for r in rings), dtype=np.int64, count=len(rings))
+    valid = sizes > 0
+    area = np.zeros(len(rings))
+    mx = np.zeros(len(rings))
+    my = np.zeros(len(rings))
+    if not valid.any():
+        return area, mx, my
+
+    a = np.concatenate([r[:-1] for r, ok in zip(rings, valid) if ok])
+    b = np.concatenate([r[1:] for r, ok in zip(rings, valid) if ok])
+    cross = a[:, 0] * b[:, 1] - b[:, 0] * a[:, 1]
+
+    starts = np.zeros(int(valid.sum()), dtype=np.int64)
+    np.cumsum(sizes[valid][:-1], out=starts[1:])
+    area[valid] = np.add.reduceat(cross, starts) / 2.0
+    mx[valid] = np.add.reduceat((a[:, 0] + b[:, 0]) * cross, starts) / 6.0
+    my[valid] = np.add.reduceat((a[:, 1] + b[:, 1]) * cross, starts) / 6.0
+    return area, mx, my
+
+
+def polygons_moments(polygons: Polygons) -> Tuple[float, float, float]:
+    """
+    Área total y momentos de un conjunto de polígonos.
+    No depende de la orientación de los anillos: el exterior suma y los
+    huecos restan. Retorna (área, momento_x, momento_y)
+    """
+    rings = []
+    role = []  # +1 anillo exterior, -1 hueco
+    for polygon in polygons:
+        for i, ring in enumerate(polygon):
+            rings.append(ring)
+            role.append(1.0 if i == 0 else -1.0)
+    if not rings:
+        return (0.0, 0.0, 0.0)
+
+    area, mx, my = ring_moments(rings)
+    weight = np.asarray(role) * np.sign(area)
+    return (float(np.sum(weight * area)), float(np.sum(weight * mx)), float(np.sum(weight * my)))
+
+
+def moments_centroid(area: float, mx: float, my: float) -> Optional[Tuple[float, float]]:
+    """(latitude, longitude) a partir de momentos acumulados; None si el área es nula"""
+    if abs(area) < 1e-12:
+        return None
+    return (my / area, mx / area)
+
+
+def polygons_centroid(polygons: Polygons) -> Optional[Tuple[float, float]]:
+    """
+    Centroide ponderado por área de un conjunto de polígonos.
+    Retorna (latitude, longitude) o None si el área es nula
+    """
+    return moments_centroid(*polygons_moments(polygons))
+
+
+def polygons_area_km2(polygons: Polygons) -> float:
+    """
+    Área en km² de un conjunto de polígonos. Se proyectan con la sinusoidal
+    (equivalente: conserva áreas en cualquier latitud) y se aplica el mismo
+    shoelace que polygons_moments, con los huecos restando
+    """
+    projected = []
+    for polygon in polygons:
+        rings = []
+        for ring in polygon:
+            lat = np.radians(ring[:, 1])
+            rings.append(np.column_stack((np.radians(ring[:, 0]) * np.cos(lat), lat)) * EARTH_RADIUS_KM)
+        projected.append(rings)
+    return abs(polygons_moments(projected)[0])
+
+
+def polygons_bbox(polygons: Polygons) -> Optional[Tuple[float, float, float, float]]:
+    """(min_lon, min_lat, max_lon, max_lat) de todos los anillos; None si no hay puntos"""
+    rings = [ring for polygon in polygons for ring in polygon if len(ring)]
+    if not rings:
+        return None
+    points = np.concatenate(rings)
+    min_lon, min_lat = points.min(axis=0)
+    max_lon, max_lat = points.max(axis=0)
+    return (float(min_lon), float(min_lat), float(max_lon), float(max_lat))
+
+
+def close_ring(ring: np.ndarray) -> np.ndarray:
+    """Asegura que el último punto del anillo coincide con el primero"""
+    if len(ring) > 1 and not np.array_equal(ring[0], ring[-1]):
+        return np.vstack([ring, ring[:1]])
+    return ring
+
+
+# ============================================================================
+# LECTURA EN STREAMING
+# ============================================================================
+
+class JsonStream:
+    """
+    Lector JSON incremental sobre un archivo de texto.
+
+    Navega objetos y arrays sin materializarlos: solo se decodifica de una vez
+    cada elemento que se pide (un arco, una geometría...), así la memoria
+    depende del tamaño del elemento y no del archivo.
+    """
+
+    def __init__(self, f, chunk_size: int = 1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        """Lee otro bloque descartando lo ya consumido. False si no quedan datos"""
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Siguiente carácter significativo sin consumirlo ('' al final)"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"JSON inválido: se esperaba '{char}' en la posición {self.pos}")
+        self.pos += 1
+
+    def value(self):
+        """Decodifica el siguiente valor completo"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # Un número que termina justo en el borde del bloque puede estar cortado
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _separator(self, closing: str) -> bool:
+        """Consume ',' o el cierre. True si hay otro elemento"""
+        char = self.peek()
+        self.pos += 1
+        if char == ',':
+            return True
+        if char == closing:
+            return False
+        raise ValueError(f"JSON inválido: se esperaba ',' o '{closing}'")
+
+    def iter_array(self) -> Iterator[None]:
+        """
+        Recorre un array: en cada iteración el llamador debe consumir
+        exactamente un elemento (con value() o navegándolo)
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if not self._separator(']'):
+                return
+
+    def iter_values(self) -> Iterator:
+        """Decodifica un array elemento a elemento"""
+        for _ in self.iter_array():
+            yield self.value()
+
+    def iter_object(self) -> Iterator[str]:
+        """
+        Recorre un objeto devolviendo sus claves: el llamador debe consumir
+        el valor de cada una antes de pedir la siguiente
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if not self._separator('}'):
+                return
+
+
+def stream_topology(path: Path) -> Iterator[Tuple[Dict, 'TopologyDecoder']]:
+    """
+    Lee un .topojson en streaming y devuelve (geometría, decoder) para cada
+    geometría del objeto principal (el primero de `objects`).
+
+    Los arcos se acumulan directamente en arrays compactos sin crear listas de
+    Python por punto. Con el orden habitual (arcs, transform, objects) cada
+    geometría se entrega en cuanto se lee; si `objects` aparece antes que
+    `arcs`/`transform`, las geometrías (solo propiedades y referencias a
+    arcos) se retienen hasta el final del archivo.
+    """
+    flat = array('d')
+    lengths = array('q')
+    header = {}
+    pending = []
+    decoder = None
+
+    def build_decoder() -> TopologyDecoder:
+        return TopologyDecoder.from_flat(
+            np.frombuffer(flat, dtype=np.float64),
+            np.frombuffer(lengths, dtype=np.int64),
+            header.get('transform'),
+        )
+
+    with open(path, 'r', encoding='utf-8') as f:
+        stream = JsonStream(f)
+        for key in stream.iter_object():
+            if key == 'arcs':
+                for arc in stream.iter_values():
+                    lengths.append(len(arc))
+                    for point in arc:
+                        flat.append(point[0])
+                        flat.append(point[1])
+                header['arcs'] = True
+            elif key == 'objects':
+                if 'arcs' in header and 'transform' in header:
+                    decoder = build_decoder()
+                for n, _name in enumerate(stream.iter_object()):
+                    if n > 0:
+                        stream.value()  # Solo se usa el objeto principal
+                        continue
+                    for object_key in stream.iter_object():
+                        if object_key != 'geometries':
+                            stream.value()
+                            continue
+                        for geometry in stream.iter_values():
+                            if decoder is not None:
+                                yield geometry, decoder
+                            else:
+                                pending.append(geometry)
+            else:
+                header[key] = stream.value()
+
+    if pending:
+        decoder = build_decoder()
+        for geometry in pending:
+            yield geometry, decoder